@@ -1,15 +1,16 @@
 import numpy as np
 import pandas as pd
-import tfs
-import yaml
 import re
 from pathlib import Path
 
-from typing import Any, Dict, Optional
+from typing import Any, Dict, Optional, Tuple
  
-import xtrack as xt
+from aper_package.utils import find_s_value, shift_by, merge_twiss_and_aper, lazy_import
+from aper_package.collimator_database import CollimatorDatabase, load_collimator_database
 
-from aper_package.utils import *
+# Loaded on first use
+xt = lazy_import('xtrack')
+tfs = lazy_import('tfs')
 
 import warnings
 warnings.simplefilter(action='ignore', category=FutureWarning)
@@ -30,8 +31,12 @@ class ApertureData:
 
         # Create a progress label
         self.label = label
+
+        # Incremented whenever the twiss changes, results derived from it can be cached against it
+        self.twiss_version = 0
     
-        # Load line data
+        # Load line data, the paths are kept to load copies of the lines in other processes
+        self.path_b1, self.path_b2 = path_b1, path_b2
         self.line_b1, self.line_b2 = self._load_lines_data(path_b1, path_b2)
 
         # Define gamma and length of the accelerator using loaded line
@@ -143,6 +148,35 @@ class ApertureData:
             self._distance_to_nominal('horizontal')
             self._distance_to_nominal('vertical')
 
+        self.twiss_version += 1
+
+    def twiss_orbit(self) -> Tuple[pd.DataFrame, pd.DataFrame]:
+        """Compute only the closed orbit of both beams, e.g. for fitting.
+
+        Unlike `twiss`, the stored twiss DataFrames, sigma, envelopes and
+        distances to the nominal orbit are not updated, call `twiss` once done.
+
+        Returns:
+            Tuple[pd.DataFrame, pd.DataFrame]: 
+                Columns s, name, x and y for beam 1 and beam 2, cycled like the twiss data.
+        """
+        tw_b1 = self.line_b1.twiss(skip_global_quantities=True)
+        tw_b2 = self.line_b2.twiss(skip_global_quantities=True, reverse=True)
+
+        # Only the columns needed to compare with the measurements
+        orbit_b1, orbit_b2 = [
+            pd.DataFrame({'s': tw['s'], 'name': tw['name'], 'x': tw['x'], 'y': tw['y']}) 
+            for tw in [tw_b1, tw_b2]
+            ]
+
+        # Check if the data had been cycled, the shift is found from beam 1 like in `twiss`
+        if hasattr(self, 'first_element'):
+            shift = -orbit_b1.loc[orbit_b1['name'] == self.first_element, 's'].values[0]
+            orbit_b1 = shift_by(orbit_b1, shift, 's')
+            orbit_b2 = shift_by(orbit_b2, shift, 's')
+
+        return orbit_b1, orbit_b2
+
     def _process_twiss(self, twiss_df: pd.DataFrame) -> pd.DataFrame:
         """Process the twiss DataFrame to remove unnecessary elements and columns.
 
@@ -298,6 +332,8 @@ class ApertureData:
                         except Exception as e:
                             self.print_to_label(f"Error shifting {attr}: {e}")
 
+            self.twiss_version += 1
+
     def envelope(self, n: float) -> None:
         """Calculate the envelope edges for the twiss DataFrames 
         based on the envelope size.
@@ -469,10 +505,30 @@ class ApertureData:
             # Update the 'current value' to reflect the reset
             acb_knobs_df.at[row.name, 'current value'] = row['initial value']
 
-    def load_aperture(self, path_b1: str, path_b2: Optional[str]=None) -> None:
+    def load_aperture(self, 
+                      path_b1: str, 
+                      path_b2: Optional[str]=None,
+                      tol_path_b1: Optional[str]=None,
+                      tol_path_b2: Optional[str]=None,
+                      tolerances: Optional[bool]=True) -> None:
+        """Load aperture data and the aperture tolerances.
+
+        Parameters:
+            path_b1, path_b2: Paths to the aperture TFS files, see _load_aperture_data.
+            tol_path_b1: Path to the MAD-X file with aperture tolerances for beam 1,
+                    if not given, the as-built tolerances from test_data are used.
+            tol_path_b2: Path to the tolerances for beam 2, if not given, 
+                    the path will be created by replacing .b1. with .b2. in the file name.
+            tolerances: If False, no tolerances are loaded and n1 is not defined 
+                    unless the tolerances are given to calculate_n1.
+        """
         # Load and process aperture data
         self.aper_b1, self.aper_b2 = self._load_aperture_data(path_b1, path_b2)
-        self._load_aperture_tolerance()
+
+        if tolerances: self._load_aperture_tolerance(tol_path_b1, tol_path_b2)
+        else:
+            for aper in [self.aper_b1, self.aper_b2]:
+                aper[['APER_TOL_1', 'APER_TOL_2', 'APER_TOL_3']] = np.nan
     
     def _load_aperture_data(self, path_b1, path_b2) -> pd.DataFrame:
         """Load and process aperture data from a file.
@@ -525,19 +581,20 @@ class ApertureData:
 
         return df_merged
 
-    def _load_aperture_tolerance(self):
+    def _load_aperture_tolerance(self, path_b1: Optional[str]=None, path_b2: Optional[str]=None):
         """Load MAD-X file with aperture tolerances and adds them to the 
         `aper_b1` and `aper_b2` DataFrames.
         """
 
-        home_path = str(Path.cwd().parent)
+        # By default use the as-built tolerances next to the package
+        if not path_b1: 
+            path_b1 = Path(__file__).resolve().parent.parent / 'test_data' / 'aper_tol_profiles-as-built.b1.madx'
+        if not path_b2: 
+            path_b1 = Path(path_b1)
+            path_b2 = path_b1.with_name(path_b1.name.replace('.b1.', '.b2.'))
 
-        tol_b1 = self._create_df_from_madx(
-            f"{home_path}/test_data/aper_tol_profiles-as-built.b1.madx"
-            )
-        tol_b2 = self._create_df_from_madx(
-            f"{home_path}/test_data/aper_tol_profiles-as-built.b2.madx"
-            )
+        tol_b1 = self._create_df_from_madx(path_b1)
+        tol_b2 = self._create_df_from_madx(path_b2)
 
         # Merge with the existing aperture dataframe attribute
         self.aper_b1 = pd.merge(tol_b1, self.aper_b1, on='NAME', how='right')
@@ -624,6 +681,46 @@ class ApertureData:
 
         return aperx_error, sigmax_after_errors, n1_x, apery_error, sigmay_after_errors, n1_y
         
+    def calculate_n1_ring(
+            self, delta_beta=0, delta=0, beam='beam 1',
+            rtol=None, xtol=None, ytol=None, delta_co=0.002
+            ) -> pd.DataFrame:
+        """Calculate n1 for all aperture elements of the ring at once.
+
+        Parameters:
+            delta_beta: Beta beating given in %
+            delta: Momentum spread
+            beam: 'beam 1' or 'beam 2'
+            rtol, xtol, ytol: Aperture tolerances, if not given, the tolerances from self.aper_b[12] are taken
+            delta_co: Closed orbit error, default 2 mm
+
+        Returns:
+            pd.DataFrame: One row per element with the same quantities as calculate_n1,
+                n1 is NaN where the aperture tolerance is not defined.
+        """
+        if beam == 'beam 1':
+            merged = merge_twiss_and_aper(self.tw_b1, self.aper_b1)
+        elif beam == 'beam 2':
+            merged = merge_twiss_and_aper(self.tw_b2, self.aper_b2)
+
+        # Take the tolerances from the data if not all given
+        if None in (rtol, xtol, ytol):
+            rtol, xtol, ytol = merged.APER_TOL_1, merged.APER_TOL_2, merged.APER_TOL_3
+
+        sigmax_after_errors, sigmay_after_errors = self.calculate_sigma_with_error(
+            merged, delta_beta, delta
+        )
+
+        n1 = merged[['name', 's', 'APER_1', 'APER_2', 'APER_3', 'APER_4']].copy()
+        n1['aperx_error'] = rtol + xtol + delta_co
+        n1['apery_error'] = rtol + ytol + delta_co
+        n1['sigmax_error'] = sigmax_after_errors
+        n1['sigmay_error'] = sigmay_after_errors
+        n1['n1_x'] = (n1.APER_1 - n1.aperx_error) / n1.sigmax_error
+        n1['n1_y'] = (n1.APER_2 - n1.apery_error) / n1.sigmay_error
+
+        return n1
+
     def calculate_aper_error(self, row, rtol, xtol, ytol, delta_co):
         """Calculate aperture errors based on tolerances and closed orbit error.
 
@@ -683,24 +780,23 @@ class ApertureData:
             path : The path to the collimators YAML file. If None, a default path is used.
         """
 
-        # Load the file
-        with open(path, 'r') as file:
-            f = yaml.safe_load(file)
+        # Load the file, it is only parsed again if it changed
+        db = load_collimator_database(path)
 
         # Create the DataFrames
-        self.colx_b1 = self._get_col_df_from_yaml(f, 0, 'b1', 'horizontal')
-        self.colx_b2 = self._get_col_df_from_yaml(f, 0, 'b2', 'horizontal')
+        self.colx_b1 = self._get_col_df_from_yaml(db, 0, 'b1', 'horizontal')
+        self.colx_b2 = self._get_col_df_from_yaml(db, 0, 'b2', 'horizontal')
 
-        self.coly_b1 = self._get_col_df_from_yaml(f, 90, 'b1', 'vertical')
-        self.coly_b2 = self._get_col_df_from_yaml(f, 90, 'b2', 'vertical')
+        self.coly_b1 = self._get_col_df_from_yaml(db, 90, 'b1', 'vertical')
+        self.coly_b2 = self._get_col_df_from_yaml(db, 90, 'b2', 'vertical')
 
     def _get_col_df_from_yaml(
-            self, f: Dict[str, Any], angle: float, 
+            self, db: CollimatorDatabase, angle: float, 
             beam: str, plane: str) -> pd.DataFrame:
         """Create a DataFrame containing collimator data for the specified beam and plane.
 
         Parameters:
-            f : A dictionary containing collimator data.
+            db : The parsed collimator database.
             angle : The angle to filter collimators by.
             beam : The beam identifier ('b1' or 'b2').
             plane : The plane identifier ('h' for horizontal, 'v' for vertical).
@@ -715,11 +811,8 @@ class ApertureData:
         if plane == 'horizontal': sigma_key, x_key='sigma_x', 'x'
         if plane == 'vertical': sigma_key, x_key='sigma_y', 'y'
 
-        # Create a pandas data frame with only gap and angle
-        col = pd.DataFrame(f['collimators'][beam]).loc[['gap', 'angle']].T
-        col = col.reset_index().rename(columns={'index': 'name'})
-        # Drop undefined values
-        col = col[col['angle'] == angle].dropna()
+        # Create a pandas data frame with only gap and angle, without undefined values
+        col = db.get(beam, angle)
         # Merge with twiss data to find collimator positions
         col = pd.merge(col, twiss_data, on='name', how='left')
 
@@ -795,8 +888,12 @@ class ApertureData:
 
     def match_local_bump(
             self, element: str, relevant_mcbs: list, size: float, 
-            beam: str, plane: str, tw0 = None):
-        """Add a 3C or 4C local bump to line using optimisation line.match."""
+            beam: str, plane: str, tw0 = None, orbit_only: Optional[bool] = False):
+        """Add a 3C or 4C local bump to line using optimisation line.match.
+
+        If orbit_only is True, the twiss data is not recomputed after matching, 
+        used when fitting where only the orbit is needed at each step.
+        """
         # If bump size was given as a numpy array, get the first value - for fitting
         if isinstance(size, np.ndarray): size = size[0]
 
@@ -868,7 +965,7 @@ class ApertureData:
                 vary=xt.VaryList(varylist),
                 targets=[target1, target2])
                 
-            self.twiss()
+            if not orbit_only: self.twiss()
             knob_values = self.opt.get_knob_values()
 
             for knob, new_value in knob_values.items():
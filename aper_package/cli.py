@@ -0,0 +1,220 @@
+"""Command line entry point to compute aperture reports without ipywidgets.
+
+Example:
+    python -m aper_package.cli line_b1.json --aperture all_optics_B1.tfs \
+        --collimators collimators.yaml --knobs knobs_a.yaml knobs_b.yaml \
+        --n 4 --output reports --workers 8
+
+Every combination of line and knob file is one configuration,
+configurations are processed in parallel on separate processes.
+"""
+import argparse
+import itertools
+import yaml
+import pandas as pd
+
+from concurrent.futures import ProcessPoolExecutor
+from pathlib import Path
+from typing import Dict, List, Optional
+
+def load_knobs(path: Optional[str]) -> Dict[str, float]:
+    """Load knob settings from a YAML or JSON file mapping knob names to values."""
+    if not path: return {}
+
+    with open(path, 'r') as file:
+        knobs = yaml.safe_load(file) or {}
+
+    return {str(knob): float(value) for knob, value in knobs.items()}
+
+def collimator_margins(data, n: float) -> pd.DataFrame:
+    """Calculate the distance between the collimator jaws and the beam envelope.
+
+    Parameters:
+        data: An ApertureData object with collimators loaded.
+        n: Envelope size in sigma.
+
+    Returns:
+        pd.DataFrame: One row per collimator with the jaw positions and the
+            margins in metres and in sigma, negative if the jaw cuts into the envelope.
+    """
+    margins = []
+    for beam, plane, df in [
+        ('beam 1', 'horizontal', data.colx_b1), ('beam 2', 'horizontal', data.colx_b2),
+        ('beam 1', 'vertical', data.coly_b1), ('beam 2', 'vertical', data.coly_b2)
+        ]:
+        coordinate, sigma = ('x', 'sigma_x') if plane == 'horizontal' else ('y', 'sigma_y')
+
+        margin = df[['name', 's', 'gap', 'top_gap_col', 'bottom_gap_col']].copy()
+        margin['beam'], margin['plane'] = beam, plane
+        margin['margin_top'] = df.top_gap_col - (df[coordinate] + n * df[sigma])
+        margin['margin_bottom'] = (df[coordinate] - n * df[sigma]) - df.bottom_gap_col
+        margin['margin_sigma'] = df.gap - n
+        margins.append(margin)
+
+    return pd.concat(margins, ignore_index=True)
+
+def envelopes(data) -> pd.DataFrame:
+    """Collect the orbit and envelope of both beams in one DataFrame."""
+    columns = ['name', 's', 'x', 'y', 'sigma_x', 'sigma_y', 'x_up', 'x_down', 'y_up', 'y_down']
+    return pd.concat([
+        data.tw_b1[columns].assign(beam='beam 1'),
+        data.tw_b2[columns].assign(beam='beam 2')
+        ], ignore_index=True)
+
+def write_table(df: pd.DataFrame, path: Path, file_format: str) -> None:
+    """Save a table as Parquet or CSV."""
+    if file_format == 'parquet': df.to_parquet(path.with_suffix('.parquet'), index=False)
+    elif file_format == 'csv': df.to_csv(path.with_suffix('.csv'), index=False)
+
+def write_html_report(data, path: Path) -> None:
+    """Save the envelopes, beam positions, aperture and collimators as interactive HTML plots."""
+    import plotly.graph_objects as go
+    from plotly.subplots import make_subplots
+    from aper_package.figure_data import (
+        plot_aperture, plot_collimators_from_yaml, plot_beam_positions, plot_envelopes)
+
+    fig = make_subplots(rows=2, cols=1, shared_xaxes=True, subplot_titles=['Horizontal', 'Vertical'])
+
+    for row, plane in enumerate(['horizontal', 'vertical'], start=1):
+        functions = [plot_beam_positions, plot_envelopes]
+        if hasattr(data, 'aper_b1'): functions.insert(0, plot_aperture)
+        if hasattr(data, 'colx_b1'): functions.insert(1, plot_collimators_from_yaml)
+
+        for function in functions:
+            # Beam 1 only, to keep the report readable
+            visibility, traces = function(data, plane)
+            for trace, visible in zip(traces, visibility):
+                if visible: fig.add_trace(go.Scatter(trace, visible=True), row=row, col=1)
+
+    fig.update_layout(height=1000, showlegend=False, plot_bgcolor='white')
+    fig.update_yaxes(range=[-0.05, 0.05])
+    fig.update_xaxes(title_text='s [m]', row=2, col=1)
+    fig.write_html(path.with_suffix('.html'), include_plotlyjs='cdn')
+
+def run_configuration(config: dict) -> dict:
+    """Compute the aperture report of one configuration and save it.
+
+    Parameters:
+        config: Dictionary with the keys 'name', 'line', 'aperture', 'tolerances',
+            'collimators', 'knobs', 'n', 'emittance', 'delta_beta', 'delta',
+            'delta_co', 'output', 'format' and 'html'.
+
+    Returns:
+        dict: A summary with the smallest n1 of each beam and plane.
+    """
+    from aper_package.aperture_data import ApertureData
+
+    # Progress messages go to a silent label, many workers print at the same time
+    label = type('Label', (), {'value': ''})()
+    data = ApertureData(config['line'], n=config['n'], emitt=config['emittance'], label=label)
+
+    # Apply the knob settings and update the optics
+    knobs = load_knobs(config['knobs'])
+    for knob, value in knobs.items():
+        data.change_knob(knob, value)
+    if knobs: data.twiss()
+
+    output = Path(config['output']) / config['name']
+    output.mkdir(parents=True, exist_ok=True)
+
+    summary = {'name': config['name']}
+    write_table(envelopes(data), output / 'envelopes', config['format'])
+
+    if config['aperture']:
+        # Without tolerances n1 is not defined and left out of the summary
+        data.load_aperture(
+            config['aperture'], tol_path_b1=config['tolerances'], 
+            tolerances=config['tolerances'] is not None)
+
+        n1 = pd.concat([
+            data.calculate_n1_ring(config['delta_beta'], config['delta'], beam, delta_co=config['delta_co'])
+            .assign(beam=beam) for beam in ['beam 1', 'beam 2']
+            ], ignore_index=True)
+        write_table(n1, output / 'n1', config['format'])
+
+        # Smallest n1 and where it is
+        for beam, suffix in [('beam 1', 'b1'), ('beam 2', 'b2')]:
+            for plane in ['x', 'y']:
+                values = n1.loc[n1.beam == beam, ['name', f'n1_{plane}']].dropna()
+                if values.empty: continue
+                minimum = values.loc[values[f'n1_{plane}'].idxmin()]
+                summary[f'n1_{plane}_{suffix}'] = minimum[f'n1_{plane}']
+                summary[f'element_{plane}_{suffix}'] = minimum['name']
+
+    if config['collimators']:
+        data.load_collimators_from_yaml(config['collimators'])
+        write_table(collimator_margins(data, config['n']), output / 'collimators', config['format'])
+
+    if config['html']: write_html_report(data, output / 'report')
+
+    return summary
+
+def build_configurations(args: argparse.Namespace) -> List[dict]:
+    """Create one configuration for each combination of line and knob file."""
+    knob_files = args.knobs or [None]
+    configs = []
+
+    for line, knobs in itertools.product(args.lines, knob_files):
+        name = Path(line).stem
+        if knobs: name = f'{name}_{Path(knobs).stem}'
+
+        configs.append({
+            'name': name,
+            'line': line,
+            'aperture': args.aperture,
+            'tolerances': args.tolerances,
+            'collimators': args.collimators,
+            'knobs': knobs,
+            'n': args.n,
+            'emittance': args.emittance,
+            'delta_beta': args.delta_beta,
+            'delta': args.delta,
+            'delta_co': args.delta_co,
+            'output': args.output,
+            'format': args.format,
+            'html': args.html,
+            })
+
+    return configs
+
+def parse_args(argv: Optional[List[str]] = None) -> argparse.Namespace:
+    parser = argparse.ArgumentParser(
+        prog='python -m aper_package.cli',
+        description='Compute n1, envelopes and collimator margins for one or many configurations.')
+
+    parser.add_argument('lines', nargs='+', help='line JSON files for beam 1, beam 2 is found by replacing b1 with b2')
+    parser.add_argument('--aperture', help='aperture TFS file for beam 1, beam 2 is found by replacing B1 with B4')
+    parser.add_argument('--tolerances', help='MAD-X file with aperture tolerances for beam 1, beam 2 is found by replacing .b1. with .b2. (n1 is only computed if given)')
+    parser.add_argument('--collimators', help='collimator YAML file')
+    parser.add_argument('--knobs', nargs='*', help='YAML or JSON files with knob settings, one configuration per file')
+    parser.add_argument('--n', type=float, default=4, help='envelope size in sigma (default: 4)')
+    parser.add_argument('--emittance', type=float, default=3.5e-6, help='normalised emittance (default: 3.5e-6)')
+    parser.add_argument('--delta-beta', type=float, default=0, help='beta beating in %% for n1')
+    parser.add_argument('--delta', type=float, default=0, help='momentum spread for n1')
+    parser.add_argument('--delta-co', type=float, default=0.002, help='closed orbit error for n1 (default: 2 mm)')
+    parser.add_argument('--output', default='aperture_reports', help='output directory')
+    parser.add_argument('--format', choices=['parquet', 'csv'], default='parquet', help='format of the tables')
+    parser.add_argument('--html', action='store_true', help='also write an HTML report with the plots')
+    parser.add_argument('--workers', type=int, default=None, help='number of processes (default: number of cores)')
+
+    return parser.parse_args(argv)
+
+def main(argv: Optional[List[str]] = None) -> List[dict]:
+    args = parse_args(argv)
+    configs = build_configurations(args)
+
+    # Run in this process if there is nothing to parallelise
+    if len(configs) == 1 or args.workers == 1:
+        summaries = [run_configuration(config) for config in configs]
+    else:
+        with ProcessPoolExecutor(max_workers=args.workers) as executor:
+            summaries = list(executor.map(run_configuration, configs))
+
+    summary = pd.DataFrame(summaries)
+    summary.to_csv(Path(args.output) / 'summary.csv', index=False)
+    print(summary.to_string(index=False))
+
+    return summaries
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,78 @@
+import os
+import numpy as np
+import pandas as pd
+import yaml
+
+from pathlib import Path
+from typing import Dict, Optional, Tuple
+
+# Use the C implementation of the YAML parser if PyYAML was built with libyaml
+_Loader = getattr(yaml, 'CSafeLoader', yaml.SafeLoader)
+
+# Parsed databases memoised by resolved path, together with the file modification time
+_cache: Dict[Path, Tuple[int, 'CollimatorDatabase']] = {}
+
+class CollimatorDatabase:
+
+    def __init__(self, path: str):
+        """Parse a collimator YAML file into one DataFrame per beam.
+
+        Parameters:
+            path: Path to the YAML file containing collimator configurations.
+        """
+        self.path = Path(path)
+
+        with open(self.path, 'r') as file:
+            f = yaml.load(file, Loader=_Loader)
+
+        self.b1 = self._create_df(f['collimators']['b1'])
+        self.b2 = self._create_df(f['collimators']['b2'])
+
+    def _create_df(self, collimators: dict) -> pd.DataFrame:
+        """Create a DataFrame with one row per collimator and typed numeric columns."""
+        df = pd.DataFrame.from_dict(collimators, orient='index')
+        df = df.rename_axis('name').reset_index()
+
+        # Gaps of null disable the collimator, angle is not given for all of them
+        for column in ['gap', 'angle', 'length']:
+            if column in df.columns: df[column] = pd.to_numeric(df[column], errors='coerce')
+            else: df[column] = np.nan
+
+        return df
+
+    def get(self, beam: str, angle: Optional[float] = None) -> pd.DataFrame:
+        """Get the name, gap and angle of the collimators of one beam.
+
+        Parameters:
+            beam: The beam identifier ('b1' or 'b2').
+            angle: If given, only return collimators with this angle and a defined gap.
+
+        Returns:
+            pd.DataFrame: A copy of the collimator data with columns 'name', 'gap' and 'angle'.
+        """
+        if beam == 'b1': df = self.b1
+        elif beam == 'b2': df = self.b2
+
+        df = df[['name', 'gap', 'angle']]
+
+        if angle is not None:
+            df = df[df['angle'] == angle].dropna()
+
+        return df.reset_index(drop=True)
+
+def load_collimator_database(path: str) -> CollimatorDatabase:
+    """Load a collimator database, parsing each file only once
+    unless it was modified since.
+
+    Parameters:
+        path: Path to the YAML file containing collimator configurations.
+    """
+    path = Path(path).resolve()
+    mtime = os.stat(path).st_mtime_ns
+
+    cached = _cache.get(path)
+    if cached is None or cached[0] != mtime:
+        cached = (mtime, CollimatorDatabase(path))
+        _cache[path] = cached
+
+    return cached[1]
@@ -1,9 +1,14 @@
+from __future__ import annotations
+
 import numpy as np
 import pandas as pd
 
-import plotly.graph_objects as go
+from functools import lru_cache
 from typing import List, Tuple
-from aper_package.utils import merge_twiss_and_aper, find_s_value
+from aper_package.utils import merge_twiss_and_aper, find_s_value, lazy_import
+
+# Loaded on first use
+go = lazy_import('plotly.graph_objects')
 
 def plot_BPM_data(
         data: object, plane: str, 
@@ -82,59 +87,48 @@ def plot_machine_components(data: object) -> Tuple[np.ndarray, List[go.Scatter]]
         'hotpink', 'green', 'red'
         ]
 
-    # Dictionary to store combined data for each object type
-    combined_traces = {obj: {'x': [], 'y': [], 'name': []} for obj in objects}
-    centers = {obj: {'x': [], 'y': [], 'name': []} for obj in objects}
-
-    # Iterate over all object types
-    for obj in objects:
+    traces = []
+    for obj, color in zip(objects, colors):
         obj_df = data.elements[data.elements['KEYWORD'] == obj]
 
-        for i in range(obj_df.shape[0]):
-            # Calculate x-coordinates
-            x0 = obj_df.iloc[i]['S'] - obj_df.iloc[i]['L'] / 2
-            x1 = obj_df.iloc[i]['S'] + obj_df.iloc[i]['L'] / 2
-
-            # Calculate y-coordinates
-            if obj == 'QUADRUPOLE':
-                y0, y1 = 0, np.sign(obj_df.iloc[i]['K1L']).astype(int)
-                if y0 == y1:  # Skip if K1L is 0
-                    continue
-            else:
-                y0, y1 = -0.5, 0.5
-
-            # Append coordinates, separated by `None`
-            combined_traces[obj]['x'].extend([x0, x0, x1, x1, None])
-            combined_traces[obj]['y'].extend([y0, y1, y1, y0, None])
-            # Calculate the center of the polygon
-            x_center = np.mean([x0, x1])
-            y_center = np.mean([y0, y1])
-            centers[obj]['x'].append(x_center)
-            centers[obj]['y'].append(y_center)
-            centers[obj]['name'].append(obj_df.iloc[i]['NAME'])
-
-    # Convert combined traces to Plotly Scatter objects
-    traces = []
-    for obj in objects:
-        trace_data = combined_traces[obj]
+        # Calculate x-coordinates for all elements at once
+        s = obj_df['S'].to_numpy(dtype=float)
+        half_length = obj_df['L'].to_numpy(dtype=float) / 2
+        x0, x1 = s - half_length, s + half_length
+        names = obj_df['NAME'].to_numpy()
+
+        # Calculate y-coordinates
+        if obj == 'QUADRUPOLE':
+            y1 = np.sign(obj_df['K1L'].to_numpy(dtype=float))
+            # Skip if K1L is 0
+            keep = y1 != 0
+            x0, x1, y1, names = x0[keep], x1[keep], y1[keep], names[keep]
+            y0 = np.zeros_like(y1)
+        else:
+            y0, y1 = np.full_like(x0, -0.5), np.full_like(x0, 0.5)
+
+        # Rectangles separated by NaN
+        x = _join_polygons(np.column_stack([x0, x0, x1, x1]))
+        y = _join_polygons(np.column_stack([y0, y1, y1, y0]))
+
         trace = go.Scatter(
-            x=trace_data['x'],
-            y=trace_data['y'],
+            x=x,
+            y=y,
             fill='toself',
             mode='lines',
             showlegend=False,
             hoverinfo='skip',
-            fillcolor=colors[objects.index(obj)],
-            line=dict(color=colors[objects.index(obj)])
+            fillcolor=color,
+            line=dict(color=color)
         )
         traces.append(trace)
 
         # Add a trace for the names in the middle of the rectangles
         center_trace = go.Scatter(
-            x=centers[obj]['x'],
-            y=centers[obj]['y'],
+            x=(x0 + x1) / 2,
+            y=(y0 + y1) / 2,
             mode='none',
-            text=centers[obj]['name'],
+            text=names,
             showlegend=False,
             hoverinfo='text'
         )
@@ -196,68 +190,34 @@ def plot_collimators(data: object, plane: str) -> Tuple[np.ndarray, List[go.Scat
     elif plane == 'vertical':
         df_b1, df_b2 = data.coly_b1, data.coly_b2
 
-    # Initialize lists for combined coordinates for Beam 1 and Beam 2
-    combined_traces = {
-        'beam1': {'x': [], 'y': [], 'names': [], 'centers_x': [], 'centers_y': []},
-        'beam2': {'x': [], 'y': [], 'names': [], 'centers_x': [], 'centers_y': []}
-    }
-
-    # Function to append collimator data to the combined traces
-    def add_collimator_traces(df, beam_key):
-        for i in range(df.shape[0]):
-            x0 = df.s.iloc[i] - 0.5
-            x1 = df.s.iloc[i] + 0.5
-            y0t = df.top_gap_col.iloc[i]
-            y0b = df.bottom_gap_col.iloc[i]
-            y1 = 0.1
-
-            # Top and bottom collimator combined in the same trace
-            combined_traces[beam_key]['x'].extend([x0, x0, x1, x1, None, x0, x0, x1, x1, None])
-            combined_traces[beam_key]['y'].extend([y0t, y1, y1, y0t, None, y0b, -y1, -y1, y0b, None])
-
-            # Calculate the center of the collimator's filled area
-            x_center = np.mean([x0, x1])
-            y_center_top = np.mean([y0t, 0.05])
-            y_center_bottom = np.mean([y0b, -0.05])
-            combined_traces[beam_key]['centers_x'].append(x_center)
-            combined_traces[beam_key]['centers_x'].append(x_center)
-            combined_traces[beam_key]['centers_y'].append(y_center_top)
-            combined_traces[beam_key]['centers_y'].append(y_center_bottom)
-            # Use the name from the DataFrame
-            combined_traces[beam_key]['names'].append(df.name.iloc[i])
-            combined_traces[beam_key]['names'].append(df.name.iloc[i])
-
-    # Add data for both beams
-    add_collimator_traces(df_b1, 'beam1')
-    add_collimator_traces(df_b2, 'beam2')
-
     # Create traces for the collimators
     collimators = []
-    for beam_key in combined_traces:
-        trace_data = combined_traces[beam_key]
+    for df, visible in [(df_b1, True), (df_b2, False)]:
+        x, y, centers_x, centers_y, names = _collimator_geometry(df)
+
         # Trace for filled areas
         collimator_trace = go.Scatter(
-            x=trace_data['x'],
-            y=trace_data['y'],
+            x=x,
+            y=y,
             fill="toself",
             mode='lines',
             fillcolor='black',
             hoverinfo='skip',
             showlegend=False,
             line=dict(color='black'),
-            visible=True if beam_key == 'beam1' else False
+            visible=visible
         )
         collimators.append(collimator_trace)
 
         # Trace for names in the middle of the collimators
         center_trace = go.Scatter(
-            x=trace_data['centers_x'],
-            y=trace_data['centers_y'],
+            x=centers_x,
+            y=centers_y,
             mode='none',
-            text=trace_data['names'],
+            text=names,
             showlegend=False,
             hoverinfo='text',
-            visible=True if beam_key == 'beam1' else False
+            visible=visible
         )
         collimators.append(center_trace)
 
@@ -266,6 +226,117 @@ def plot_collimators(data: object, plane: str) -> Tuple[np.ndarray, List[go.Scat
 
     return visibility_arr, collimators
 
+def _collimator_geometry(
+        df: pd.DataFrame, 
+        ) -> Tuple[np.ndarray, np.ndarray, np.ndarray, np.ndarray, np.ndarray]:
+    """Compute the polygons of the top and bottom jaws for all collimators at once.
+
+    Parameters:
+        df: A DataFrame with columns 's', 'top_gap_col', 'bottom_gap_col' and 'name'.
+
+    Returns:
+        Tuple[np.ndarray, np.ndarray, np.ndarray, np.ndarray, np.ndarray]: 
+            NaN-separated x and y coordinates of the jaws, 
+            coordinates of the jaw centers and the corresponding names.
+    """
+    s = df.s.to_numpy(dtype=float)
+    top = df.top_gap_col.to_numpy(dtype=float)
+    bottom = df.bottom_gap_col.to_numpy(dtype=float)
+    x0, x1 = s - 0.5, s + 0.5
+    y1 = np.full_like(s, 0.1)
+
+    # Top and bottom jaw of each collimator follow each other in the same trace
+    x_corners = np.repeat(np.column_stack([x0, x0, x1, x1]), 2, axis=0)
+    y_corners = np.stack([
+        np.column_stack([top, y1, y1, top]),
+        np.column_stack([bottom, -y1, -y1, bottom])
+        ], axis=1).reshape(-1, 4)
+
+    # Calculate the center of the collimator's filled area
+    centers_x = np.repeat((x0 + x1) / 2, 2)
+    centers_y = np.column_stack([(top + 0.05) / 2, (bottom - 0.05) / 2]).ravel()
+    names = np.repeat(df.name.to_numpy(), 2)
+
+    return _join_polygons(x_corners), _join_polygons(y_corners), centers_x, centers_y, names
+
+def _join_polygons(corners: np.ndarray) -> np.ndarray:
+    """Flatten an (n_polygons x n_corners) array of coordinates
+    into a single array with polygons separated by NaN.
+    """
+    separator = np.full((corners.shape[0], 1), np.nan)
+    return np.hstack([corners, separator]).ravel()
+
+def m4_indices(x: np.ndarray, y: np.ndarray, x_range: List[float], n_bins: int) -> np.ndarray:
+    """Select the points needed to draw a line at a given resolution.
+
+    The visible range is divided into n_bins columns and in each column 
+    the first, last, minimum and maximum points are kept (M4 downsampling),
+    so the drawn line looks the same as with all the points.
+
+    Parameters:
+        x: Sorted x coordinates of the trace.
+        y: y coordinates of the trace, NaN points are always kept.
+        x_range: The visible range of x.
+        n_bins: Number of columns, typically the width of the plot in pixels.
+
+    Returns:
+        np.ndarray: Sorted indices of the points to keep.
+    """
+    x, y = np.asarray(x, dtype=float), np.asarray(y, dtype=float)
+    n = len(x)
+
+    # Nothing to gain for short or unsorted traces
+    if n <= 4 * n_bins or np.any(np.diff(x) < 0): return np.arange(n)
+
+    # Keep one point outside of the range on each side so lines reach the edges
+    x_min, x_max = min(x_range), max(x_range)
+    start = max(np.searchsorted(x, x_min, side='left') - 1, 0)
+    end = min(np.searchsorted(x, x_max, side='right') + 1, n)
+    inside = np.arange(start, end)
+
+    if len(inside) <= 4 * n_bins or x_max <= x_min: return inside
+
+    x, y = x[inside], y[inside]
+    bins = ((x - x_min) / (x_max - x_min) * n_bins).astype(int).clip(0, n_bins - 1)
+
+    # Bins are sorted, find where each one starts and ends
+    starts = np.r_[0, np.flatnonzero(np.diff(bins)) + 1]
+    ends = np.r_[starts[1:], len(bins)] - 1
+
+    # Sort by y within each bin, NaN is moved away from the extreme
+    nan = np.isnan(y)
+    order_min = np.lexsort((np.where(nan, np.inf, y), bins))
+    order_max = np.lexsort((np.where(nan, -np.inf, y), bins))
+
+    keep = np.unique(np.concatenate([
+        starts, ends, order_min[starts], order_max[ends], np.flatnonzero(nan)
+        ]))
+
+    return inside[keep]
+
+def downsample_trace(trace: go.Scatter, x_range: List[float], n_bins: int) -> go.Scatter:
+    """Create a copy of a line trace with only the points visible at a given resolution.
+
+    Parameters:
+        trace: The trace to downsample, x, y, text and customdata are reduced.
+        x_range: The visible range of x.
+        n_bins: Number of columns, typically the width of the plot in pixels.
+
+    Returns:
+        go.Scatter: The downsampled trace, or the same trace if no points were removed.
+    """
+    x = np.asarray(trace.x)
+    index = m4_indices(x, trace.y, x_range, n_bins)
+    if len(index) == len(x): return trace
+
+    reduced = {}
+    for key in ['x', 'y', 'text', 'customdata']:
+        value = trace[key]
+        if value is not None and np.ndim(value) > 0 and len(value) == len(x):
+            reduced[key] = np.asarray(value)[index]
+
+    return go.Scatter(trace, **reduced)
+
 def plot_envelopes(data: object, plane: str):
     """Plot the beam envelopes for a given plane.
 
@@ -323,17 +394,20 @@ def create_envelope(twiss_df, plane, beam, up_or_down, fill, visibility):
     elif beam == 'beam 2':
         color = 'rgba(255,0,0,0.1)'
 
-    customdata = list(
-        zip(
-            twiss_df[nom_to_envelope_column],
-            twiss_df[nom_to_envelope_column] * 1e-3 / twiss_df[sigma],
-            twiss_df[position_column] / twiss_df[sigma]
-        )
-    )
+    # Stack into one float array so it is sent as a binary buffer
+    nom_to_envelope = twiss_df[nom_to_envelope_column].to_numpy(dtype=float)
+    position = twiss_df[position_column].to_numpy(dtype=float)
+    sigma = twiss_df[sigma].to_numpy(dtype=float)
+
+    customdata = np.column_stack([
+        nom_to_envelope,
+        nom_to_envelope * 1e-3 / sigma,
+        position / sigma
+    ])
 
     trace = go.Scatter(
-        x=twiss_df.s, 
-        y=twiss_df[position_column], 
+        x=twiss_df.s.to_numpy(dtype=float), 
+        y=position, 
         mode='lines', 
         text=twiss_df.name, 
         name=name, 
@@ -620,7 +694,9 @@ def add_beam_trace(
         rtol=None, xtol=None, ytol=None, 
         delta_beta=0, delta=0, delta_co=0):
     """Add the beam trace including envelope and aperture data
-    to the existing plot."""
+    to the existing plot. If n is a list, the envelopes of all 
+    the sizes are combined into one trace."""
+    n = np.asarray(n, dtype=float)
 
     # Merging and filtering logic for beam 1 and beam 2
     if beam == 'beam 1': 
@@ -717,28 +793,195 @@ def add_beam_trace(
         aperture_trace, aperture_trace_with_error
         ]
 
-def plot_2d_envelope(x0, x1, y0, y1, color, name): 
-    '''Create a trace for envelope in 2d'''
-    # Create more points along each side of the envelope to enhance hover functionality
-    x_side1 = np.linspace(x0, x1, 100)
-    y_side1 = np.full_like(x_side1, y0)
-    
-    y_side2 = np.linspace(y0, y1, 100)
-    x_side2 = np.full_like(y_side2, x1)
-    
-    x_side3 = np.linspace(x1, x0, 100)
-    y_side3 = np.full_like(x_side3, y1)
+def cross_section_sweep(
+        beam, data, n, s_range, rtol=None, xtol=None, ytol=None, 
+        delta_beta=0, delta=0, delta_co=0) -> pd.DataFrame:
+    """Compute the cross-sections of all aperture elements in a range in one pass.
+
+    Parameters:
+        beam: 'beam 1' or 'beam 2'.
+        data: An ApertureData object with the aperture loaded.
+        n: Envelope size in sigma.
+        s_range: Start and end of the range, the range wraps around if start > end.
+        rtol, xtol, ytol: Aperture tolerances, if None taken from the aperture data.
+        delta_beta: Beta beating in percentage (%).
+        delta: Momentum spread.
+        delta_co: Closed orbit error.
+
+    Returns:
+        pd.DataFrame: One row per element with the beam centre, the envelope 
+            limits (x0, x1, y0, y1), the envelope limits including errors 
+            (x0_err, x1_err, y0_err, y1_err), the aperture (APER_1..APER_4) 
+            and the aperture reduced by the tolerances (APER_1_tol..APER_4_tol).
+    """
+    if beam == 'beam 1': merged = merge_twiss_and_aper(data.tw_b1, data.aper_b1)
+    elif beam == 'beam 2': merged = merge_twiss_and_aper(data.tw_b2, data.aper_b2)
+
+    start, end = s_range
+    if start <= end: rows = merged[(merged.s >= start) & (merged.s <= end)]
+    # Keep the order along the beam if the range goes through s = 0
+    else: rows = pd.concat([merged[merged.s >= start], merged[merged.s <= end]])
+    df = rows[['name', 's', 'x', 'y', 'APER_1', 'APER_2', 'APER_3', 'APER_4']].copy()
+
+    # Envelope
+    for coordinate, sigma in [('x', rows.sigma_x), ('y', rows.sigma_y)]:
+        df[f'{coordinate}0'] = rows[coordinate] - n * sigma
+        df[f'{coordinate}1'] = rows[coordinate] + n * sigma
+
+    # Envelope including beta-beating and momentum spread
+    sigmax, sigmay = data.calculate_sigma_with_error(rows, delta_beta, delta)
+    for coordinate, sigma in [('x', sigmax), ('y', sigmay)]:
+        df[f'{coordinate}0_err'] = rows[coordinate] - n * sigma
+        df[f'{coordinate}1_err'] = rows[coordinate] + n * sigma
+
+    # Aperture reduced by the tolerances, NaN where they are not defined
+    if None in (rtol, xtol, ytol): rtol, xtol, ytol = rows.APER_TOL_1, rows.APER_TOL_2, rows.APER_TOL_3
+    aperx_error = rtol + xtol + delta_co
+    apery_error = rtol + ytol + delta_co
+    for i, error in zip(range(1, 5), [aperx_error, apery_error, aperx_error, apery_error]):
+        df[f'APER_{i}_tol'] = rows[f'APER_{i}'] - error
+
+    return df.reset_index(drop=True)
+
+def sweep_traces(row, beam, show_errors=False):
+    """Create the cross-section traces of one row of cross_section_sweep.
+
+    The same number of traces is always returned, so that they can be 
+    used as animation frames or to update an existing figure.
+    """
+    if beam == 'beam 1': color, color_fill, color_fill_with_error = (
+        'rgba(0,0,255,1)', 'rgba(0,0,255,0.5)', 'rgba(0,0,255,0.2)')
+    elif beam == 'beam 2': color, color_fill, color_fill_with_error = (
+        'rgba(255,0,0,1)', 'rgba(255,0,0,0.5)', 'rgba(255,0,0,0.2)')
+
+    def rectangle(x0, x1, y0, y1, fill, name):
+        return plot_2d_envelope(x0, x1, y0, y1, fill, name)[0]
+
+    traces = [
+        go.Scatter(x=[row.x], y=[row.y], mode='markers', name='Beam center', line=dict(color=color)),
+        rectangle(row.x0, row.x1, row.y0, row.y1, color_fill, 'Envelope'),
+        plot_2d_aperture(row.APER_1, row.APER_2, row.APER_3, row.APER_4, 'Aperture'),
+        ]
+
+    if show_errors: 
+        traces.extend([
+            rectangle(row.x0_err, row.x1_err, row.y0_err, row.y1_err, 
+                      color_fill_with_error, 'Envelope including uncertainties'),
+            plot_2d_aperture(row.APER_1_tol, row.APER_2_tol, row.APER_3_tol, row.APER_4_tol, 
+                             'Aperture including tolerances')
+            ])
+
+    return traces
+
+def generate_2d_sweep(
+        s_range, beam, data, n, rtol=None, xtol=None, ytol=None, 
+        delta_beta=0, delta=0, delta_co=0, show_errors=False, width=600, height=600):
+    """Create an animated cross-section moving along s through all aperture elements in a range.
+
+    Parameters:
+        s_range: Start and end of the range, e.g. from data.get_ir_boundries('IR5').
+        beam: 'beam 1', 'beam 2' or 'both'. For both beams the beam 2 
+            element closest to each beam 1 element is shown.
+        See cross_section_sweep for the other parameters.
+
+    Returns:
+        go.Figure: A figure with one frame per element and a slider.
+    """
+    beams = ['beam 1', 'beam 2'] if beam == 'both' else [beam]
+    sweeps = [cross_section_sweep(b, data, n, s_range, rtol, xtol, ytol, delta_beta, delta, delta_co) 
+              for b in beams]
     
-    y_side4 = np.linspace(y1, y0, 100)
-    x_side4 = np.full_like(y_side4, x0)
+    # Match the other beam to the positions of the first one
+    if len(sweeps) == 2: sweeps[1] = nearest_rows(sweeps[1], sweeps[0].s.to_numpy())
+
+    frames = []
+    for i, name in enumerate(sweeps[0].name):
+        traces = [trace for b, df in zip(beams, sweeps) 
+                  for trace in sweep_traces(df.iloc[i], b, show_errors)]
+        frames.append(go.Frame(data=traces, name=name))
 
-    # Combine all sides to form the envelope
-    x_envelope = np.concatenate([x_side1, x_side2, x_side3, x_side4])
-    y_envelope = np.concatenate([y_side1, y_side2, y_side3, y_side4])
+    fig = go.Figure(data=frames[0].data if frames else [], frames=frames)
+
+    steps = [dict(
+        method='animate', label=frame.name,
+        args=[[frame.name], dict(mode='immediate', frame=dict(duration=0, redraw=False), 
+                                 transition=dict(duration=0))]
+        ) for frame in frames]
+
+    fig.update_layout(
+        title=f'{beam} 2D view',
+        plot_bgcolor='white',
+        xaxis_title='x [m]',
+        yaxis_title='y [m]',
+        showlegend=False,
+        width=width,
+        height=height,
+        sliders=[dict(steps=steps, currentvalue=dict(prefix='element: '))],
+        updatemenus=[dict(
+            type='buttons', showactive=False, x=0, y=0, xanchor='right', yanchor='top',
+            buttons=[dict(label='Play', method='animate', 
+                          args=[None, dict(frame=dict(duration=100, redraw=False), fromcurrent=True)])]
+            )]
+        )
+    fig.update_xaxes(range=[-0.05, 0.05], showgrid=True, gridwidth=1, gridcolor='lightgrey', 
+                     zeroline=True, zerolinewidth=1, zerolinecolor='lightgrey')
+    fig.update_yaxes(range=[-0.05, 0.05], showgrid=True, gridwidth=1, gridcolor='lightgrey', 
+                     zeroline=True, zerolinewidth=1, zerolinecolor='lightgrey')
+
+    return fig
+
+def nearest_rows(df, s):
+    """Select the rows of a DataFrame with the 's' values closest to the given positions."""
+    order = np.argsort(df.s.to_numpy(), kind='stable')
+    positions = df.s.to_numpy()[order]
+
+    if len(positions) < 2: index = np.zeros(len(s), dtype=int)
+    else:
+        index = np.searchsorted(positions, s).clip(1, len(positions) - 1)
+        # Choose between the neighbours on both sides
+        left = (s - positions[index - 1]) <= (positions[index] - s)
+        index = np.where(left, index - 1, index)
+
+    return df.iloc[order[index]].reset_index(drop=True)
+
+# Outline of a unit square with 100 points per side, counter-clockwise from (0, 0)
+_SIDE = np.linspace(0, 1, 100)
+_UNIT_SQUARE_OUTLINE = (
+    np.concatenate([_SIDE, np.ones(100), _SIDE[::-1], np.zeros(100)]),
+    np.concatenate([np.zeros(100), _SIDE, np.ones(100), _SIDE[::-1]])
+    )
+# Corners of a unit square, closed
+_UNIT_SQUARE_CORNERS = (np.array([0., 1., 1., 0., 0.]), np.array([0., 0., 1., 1., 0.]))
+
+def rectangle_outline(x0, x1, y0, y1, template=_UNIT_SQUARE_CORNERS) -> Tuple[np.ndarray, np.ndarray]:
+    """Scale and translate a unit square template to one or many rectangles.
+
+    Parameters:
+        x0, x1, y0, y1: Limits of the rectangles, scalars or arrays of the same length.
+        template: x and y coordinates of the unit square outline.
+
+    Returns:
+        Tuple[np.ndarray, np.ndarray]: Coordinates of the outline, for many 
+            rectangles they are separated by NaN.
+    """
+    x0, x1, y0, y1 = [np.asarray(i, dtype=float) for i in (x0, x1, y0, y1)]
+    x = x0[..., None] + (x1 - x0)[..., None] * template[0]
+    y = y0[..., None] + (y1 - y0)[..., None] * template[1]
+
+    if x.ndim == 1: return x, y
+    return _join_polygons(x), _join_polygons(y)
+
+def plot_2d_envelope(x0, x1, y0, y1, color, name): 
+    '''Create a trace for envelope in 2d. 
+    
+    If the limits are arrays, all the envelopes are combined into one trace.'''
+    x_corners, y_corners = rectangle_outline(x0, x1, y0, y1)
+    # Create more points along each side of the envelope to enhance hover functionality
+    x_envelope, y_envelope = rectangle_outline(x0, x1, y0, y1, _UNIT_SQUARE_OUTLINE)
 
     envelope_trace = go.Scatter(
-        x=[x0, x1, x1, x0, x0],  # Close the rectangle by repeating x0 at the end
-        y=[y0, y0, y1, y1, y0],  # Close the rectangle by repeating y0 at the end
+        x=x_corners,
+        y=y_corners,
         mode='lines',
         name = name,
         line=dict(color=color, width=2),
@@ -765,56 +1008,70 @@ def plot_2d_envelope(x0, x1, y0, y1, color, name):
 
 def plot_2d_aperture(aper_1, aper_2, aper_3, aper_4, name):
     '''Create a trace for aperture in 2d'''
-    t = np.linspace(0, 2*np.pi, 10000)
-    
-    x_rect = [-aper_1, aper_1, aper_1, -aper_1, -aper_1]
-    y_rect = [-aper_2, -aper_2, aper_2, aper_2, -aper_2]
-    x_elipse = aper_3*np.cos(t)
-    y_elipse = aper_4*np.sin(t)
+    x, y = aperture_polygon(aper_1, aper_2, aper_3, aper_4)
 
     hover_template = (
             "x: %{x:.4f} [m]<br>"
             "y: %{y:.4f} [m]<br>"  
         )
 
-    try:
-        indices = np.where(abs(y_elipse)>aper_2)
-        x_new = np.delete(x_elipse, indices)
-        y_new = np.delete(y_elipse, indices)
+    aperture_trace = go.Scatter(
+        x=x, 
+        y=y, 
+        mode='lines',
+        name=name,
+        hovertemplate=hover_template,
+        line=dict(color='grey', width=2)
+        )
 
-        indices = np.where(abs(x_elipse)>aper_1)
-        x_new = np.delete(x_new, indices)
-        y_new = np.delete(y_new, indices)
+    return aperture_trace
 
-        # To close the loop
-        x_new = np.append(x_new, x_new[0])
-        y_new = np.append(y_new, y_new[0])
+def aperture_polygon(aper_1, aper_2, aper_3, aper_4) -> Tuple[np.ndarray, np.ndarray]:
+    """Compute the closed outline of a rectellipse aperture,
+    the intersection of a rectangle and an ellipse.
 
-        aperture_trace = go.Scatter(
-            x=x_new, 
-            y=y_new, 
-            mode='lines',
-            name=name,
-            hovertemplate=hover_template,
-            line=dict(color='grey', width=2)
-            )
+    Parameters:
+        aper_1, aper_2: Half width and half height of the rectangle.
+        aper_3, aper_4: Horizontal and vertical semi-axes of the ellipse,
+            if not positive the aperture is a rectangle.
 
-    except: 
-        print('oops')
+    Returns:
+        Tuple[np.ndarray, np.ndarray]: Read-only x and y coordinates of the outline.
+    """
+    return _aperture_polygon(float(aper_1), float(aper_2), float(aper_3), float(aper_4))
 
-        aper_x = aper_1
-        aper_y = aper_2
-            
-        # Define the rectangle corners as a scatter trace
-        aperture_trace = go.Scatter(
-                x=[-aper_x, aper_x, aper_x, -aper_x, -aper_x],  # Close the rectangle
-                y=[-aper_y, -aper_y, aper_y, aper_y, -aper_y],
-                mode='lines',
-                name = name,
-                line=dict(color='grey', width=2),
-                fill='toself',  # To close the shape
-                fillcolor='rgba(0, 0, 0, 0)'  # No fill
-                )
+@lru_cache(maxsize=4096)
+def _aperture_polygon(a1: float, a2: float, a3: float, a4: float) -> Tuple[np.ndarray, np.ndarray]:
+    """Memoised implementation of aperture_polygon."""
+    # Missing or non-positive dimensions do not limit the aperture
+    a1, a2, a3, a4 = [a if a > 0 else np.inf for a in (a1, a2, a3, a4)]
+    
+    if np.isinf(a3) or np.isinf(a4):
+        # Rectangle only, or no aperture at all
+        if np.isinf(a1) or np.isinf(a2): x, y = np.array([]), np.array([])
+        else: x, y = np.array([a1, a1, 0.]), np.array([0., a2, a2])
 
-    return aperture_trace
-   
\ No newline at end of file
+    else:
+        # Ellipse angles where it crosses the sides of the rectangle
+        t1 = np.arccos(min(1., a1 / a3))
+        t2 = np.arcsin(min(1., a2 / a4))
+
+        # The corner of the rectangle is inside the ellipse
+        if t1 > t2: 
+            x, y = np.array([a1, a1, 0.]), np.array([0., a2, a2])
+        
+        else:
+            # The number of points follows the length of the arc
+            t = np.linspace(t1, t2, max(2, int(np.ceil(64 * (t2 - t1) / (np.pi / 2))) + 1))
+            x, y = a3 * np.cos(t), a4 * np.sin(t)
+
+            # Vertical and horizontal sides where the rectangle cuts the ellipse
+            if t1 > 0: x, y = np.r_[a1, x], np.r_[0., y]
+            if t2 < np.pi / 2: x, y = np.r_[x, 0.], np.r_[y, a2]
+
+    # Mirror the first quadrant to the others and close the loop
+    x = np.concatenate([x, -x[::-1], -x, x[::-1], x[:1]])
+    y = np.concatenate([y, y[::-1], -y, -y[::-1], y[:1]])
+    x.flags.writeable, y.flags.writeable = False, False
+
+    return x, y
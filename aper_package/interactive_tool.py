@@ -5,7 +5,7 @@ import pandas as pd
 import warnings
 
 from datetime import datetime, date
-from typing import Optional, Any
+from typing import Optional, Any, List
 
 import plotly.graph_objects as go
 from plotly.subplots import make_subplots
@@ -16,6 +16,7 @@ from ipyfilechooser import FileChooser
 from aper_package.figure_data import *
 from aper_package.timber_data import *
 from aper_package.aperture_data import ApertureData
+from aper_package.serialisation import compact_trace
 
 warnings.simplefilter(action='ignore', category=DeprecationWarning)
 
@@ -25,7 +26,9 @@ class InteractiveTool:
         self,
         spark: Optional[Any] = None,
         initial_path: Optional[str] = "/eos/project-c/collimation-team/machine_configurations/",
-        angle_range=(-800, 800)
+        angle_range=(-800, 800),
+        max_points: Optional[int] = 2000,
+        compact_arrays: Optional[bool] = False
     ):
         """Create and display an interactive plot with widgets for controlling and visualizing data.
 
@@ -33,6 +36,9 @@ class InteractiveTool:
             initial_path: initial path for FileChoosers
             spark: SWAN spark session
             angle_range: range for BPM angle fitting
+            max_points: number of columns used to downsample the orbit and envelope traces
+                to the visible range, None to always show all the points
+            compact_arrays: if True, send large trace arrays as float32 where precision allows
         """
         # Initially, set all the paths to None
         self.path_line = None
@@ -48,6 +54,8 @@ class InteractiveTool:
         self.initial_path = initial_path
         self.spark = spark
         self.angle_range = angle_range
+        self.max_points = max_points
+        self.compact_arrays = compact_arrays
 
         # Create empty plots for the 2D view
         self.cross_section_b1 = self.create_empty_cross_section()
@@ -1374,6 +1382,37 @@ class InteractiveTool:
                 )
             )
         
+        # Sweep through all the aperture elements in an IR
+        self.sweep_ir_dropdown = Dropdown(
+            options=['IR1', 'IR2', 'IR3', 'IR4', 'IR5', 'IR6', 'IR7', 'IR8'],
+            description='IR:',
+            layout=widgets.Layout(width='200px')
+            )
+        self.sweep_button = Button(
+            description="Sweep", 
+            style=widgets.ButtonStyle(button_color='pink'), 
+            tooltip='Precompute the 2D view of all the aperture elements in the IR'
+            )
+        self.sweep_button.on_click(self.sweep_button_clicked)
+
+        # Slider to move along s, only enabled after a sweep
+        self.sweep_slider = widgets.SelectionSlider(
+            options=[''],
+            description='Element:',
+            continuous_update=True,
+            disabled=True,
+            layout=widgets.Layout(width='400px')
+            )
+        self.sweep_slider.observe(self.on_sweep_slider_change, names='value')
+
+        sweep_controls = [self.sweep_ir_dropdown, self.sweep_button]
+        self.widgets.extend(sweep_controls)
+
+        sweep_row = HBox(
+            sweep_controls + [self.sweep_slider], 
+            layout=widgets.Layout(padding='5px', justify_content='space-around')
+            )
+        
         # Group main controls into a Vbox
         cross_section_vbox = VBox(
             [
@@ -1382,7 +1421,9 @@ class InteractiveTool:
             error_inputs, 
             self.tol_inputs, 
             n1_button_and_output, 
-            add_and_generate_2d_plot_buttons
+            add_and_generate_2d_plot_buttons,
+            widgets.HTML("<h4>Sweep along s through an IR</h4>"), 
+            sweep_row
             ],
             layout=Layout(
                 justify_content='space-around',
@@ -1479,12 +1520,8 @@ class InteractiveTool:
             self.cross_section_both
             ]
     
-    def generate_2d_plot_button_clicked(self, b):
-        """Create a new cross-section based on the current state of the line."""
-        
-        n = self.aperture_data.n
-        element = self.element_input.value
-
+    def _get_2d_errors(self):
+        """Get the tolerances and errors used for the cross-sections."""
         # Set aperture tolerances
         if self.aper_tolerances_dropdown.value == "Customise aperture tolerances":
             rtol = self.rtol_input.value
@@ -1501,6 +1538,15 @@ class InteractiveTool:
         else:
             delta_beta, delta, delta_co, rtol, xtol, ytol = 0, 0, 0, 0, 0, 0
 
+        return rtol, xtol, ytol, delta_beta, delta, delta_co
+
+    def generate_2d_plot_button_clicked(self, b):
+        """Create a new cross-section based on the current state of the line."""
+        
+        n = self.aperture_data.n
+        element = self.element_input.value
+        rtol, xtol, ytol, delta_beta, delta, delta_co = self._get_2d_errors()
+
         self.progress_label.value = "Generating the cross-section..."
 
         # Generate and store cross-sections
@@ -1523,6 +1569,68 @@ class InteractiveTool:
             self.cross_section_both
         ]
     
+    def sweep_button_clicked(self, b):
+        """Precompute the cross-sections of all aperture elements in the selected IR."""
+        if not hasattr(self.aperture_data, 'aper_b1'):
+            self.progress_label.value = "Load the aperture data"
+            return
+        
+        self.progress_label.value = "Computing the cross-sections..."
+        
+        s_range = self.aperture_data.get_ir_boundries(self.sweep_ir_dropdown.value)
+        errors = self._get_2d_errors()
+
+        sweep_b1 = cross_section_sweep('beam 1', self.aperture_data, self.aperture_data.n, s_range, *errors)
+        sweep_b2 = cross_section_sweep('beam 2', self.aperture_data, self.aperture_data.n, s_range, *errors)
+
+        if sweep_b1.empty: 
+            self.progress_label.value = "No aperture elements in the selected IR"
+            return
+
+        # Show beam 2 at the positions of beam 1 elements
+        self.sweeps = {'beam 1': sweep_b1, 'beam 2': nearest_rows(sweep_b2, sweep_b1.s.to_numpy())}
+        self.show_errors_in_sweep = self.toggle_switch.value
+
+        self.cross_section_b1 = self.create_empty_cross_section()
+        self.cross_section_b2 = self.create_empty_cross_section()
+        self.cross_section_both = self.create_empty_cross_section()
+
+        for beam, figures in [('beam 1', [self.cross_section_b1, self.cross_section_both]), 
+                              ('beam 2', [self.cross_section_b2, self.cross_section_both])]:
+            for fig in figures:
+                fig.add_traces(sweep_traces(self.sweeps[beam].iloc[0], beam, self.show_errors_in_sweep))
+
+        self.cross_section_container.children = [
+            self.cross_section_b1,
+            self.cross_section_b2,
+            self.cross_section_both
+            ]
+
+        # Changing the options triggers the slider observer
+        self.sweep_slider.unobserve(self.on_sweep_slider_change, names='value')
+        self.sweep_slider.options = [f'{i}: {name}' for i, name in enumerate(sweep_b1.name)]
+        self.sweep_slider.observe(self.on_sweep_slider_change, names='value')
+        self.sweep_slider.disabled = False
+
+        self.progress_label.value = "Done!"
+
+    def on_sweep_slider_change(self, change):
+        """Show the precomputed cross-sections at the element selected with the slider."""
+        if not hasattr(self, 'sweeps') or not change['new']: return
+        index = int(change['new'].split(':')[0])
+
+        traces = {beam: sweep_traces(df.iloc[index], beam, self.show_errors_in_sweep) 
+                  for beam, df in self.sweeps.items()}
+        
+        for fig, new_traces in [
+            (self.cross_section_b1, traces['beam 1']), 
+            (self.cross_section_b2, traces['beam 2']), 
+            (self.cross_section_both, traces['beam 1'] + traces['beam 2'])
+            ]:
+            with fig.batch_update():
+                for displayed, trace in zip(fig.data, new_traces):
+                    self._update_trace(displayed, trace)
+
     def define_2d_view_tab(self):
         """Group all the widgets for the 2d view into one hbox"""
         cross_section_vbox = self.create_2d_plot_controls()
@@ -1618,7 +1726,53 @@ class InteractiveTool:
                     border='solid 2px #ccc'
                     )
                 )
-        return timber_row_layout
+        
+        # Controls to follow the collimator gaps over an interval
+        self.end_time_input = Text(
+                description='End Time (HH:MM:SS):',
+                value=datetime.now().strftime('%H:%M:%S'),
+                placeholder='11:53:15',
+                style={'description_width': 'initial'},
+                layout=Layout(width='300px')
+                )
+        self.load_cols_series_button = Button(
+                description="Load collimator series",
+                style=widgets.ButtonStyle(button_color='pink'),
+                tooltip='Load collimator gaps from timber between the start and end time.'
+                )
+        self.load_cols_series_button.on_click(self.on_load_cols_series_button_clicked)
+
+        # Slider to scrub through the loaded gaps
+        self.collimator_time_slider = widgets.IntSlider(
+                value=0,
+                min=0,
+                max=0,
+                description='Time index:',
+                continuous_update=False,
+                disabled=True,
+                layout=Layout(width='400px')
+                )
+        self.collimator_time_slider.observe(self.on_collimator_time_slider_change, names='value')
+        self.collimator_time_label = Label(value='')
+
+        series_row_controls = [
+            self.end_time_input,
+            self.load_cols_series_button
+            ]
+        self.widgets.extend(series_row_controls)
+
+        series_row_layout = HBox(
+                series_row_controls + [self.collimator_time_slider, self.collimator_time_label],
+                layout=Layout(
+                    justify_content='space-around',
+                    align_items='center',
+                    width='100%',
+                    padding='10px',
+                    border='solid 2px #ccc'
+                    )
+                )
+        
+        return timber_row_layout, series_row_layout
 
     def create_ls_controls(self):
         """Initialise controls for least squares fitting line into BPM data."""
@@ -1666,6 +1820,13 @@ class InteractiveTool:
         self.fit_button.on_click(self.on_fit_button_clicked
                                  )
 
+        # Fit the knobs of all IRs at once on a pool of processes
+        self.fit_all_button = Button(
+                description="Fit all IRs", 
+                style=widgets.ButtonStyle(button_color='pink'), 
+                tooltip='Fit the crossing and separation knobs of all IRs in both planes.')
+        self.fit_all_button.on_click(self.on_fit_all_button_clicked)
+
         # Output with best fit angle and its uncertainty
         self.result_output = widgets.Output()
 
@@ -1676,6 +1837,7 @@ class InteractiveTool:
             self.ir_dropdown, 
             self.s_range_slider, 
             self.fit_button, 
+            self.fit_all_button, 
             self.result_output]
         self.widgets.extend(ls_row_controls)
 
@@ -1730,12 +1892,56 @@ class InteractiveTool:
 
             self.update_graph()
 
+    def on_fit_all_button_clicked(self, b):
+        """Handle event when button Fit all IRs is clicked"""
+        if getattr(self.BPM_data, 'data', None) is None:
+            self.progress_label.value = 'Load BPM data first.'
+            return
+
+        self.all_irs_fit = self.BPM_data.fit_all_irs(self.aperture_data, angle_range=self.angle_range)
+
+        with self.result_output:
+            self.result_output.clear_output()
+            print(self.all_irs_fit.round(2).to_string(index=False))
+
+    def start_orbit_monitor(self, knobs: List[str], period: Optional[float] = 1.0, **kwargs) -> None:
+        """Follow the BPM data in the background and refit the knobs at every acquisition.
+
+        Parameters:
+            knobs: Names of the knobs to fit, e.g. ['on_x1', 'on_sep1'].
+            period: Time between updates in seconds.
+            kwargs: Other arguments of OrbitMonitor, e.g. start_time to replay logged data.
+        """
+        from aper_package.monitoring import OrbitMonitor
+
+        self.stop_orbit_monitor()
+
+        def show(result):
+            values = ', '.join(
+                f'{knob}: {value:.2f} ± {result["uncertainties"][knob]:.2f}' 
+                for knob, value in result['values'].items())
+            # Warn if the fit can't keep up with the acquisitions
+            late = ' (slower than the period)' if result['duration'] > period else ''
+            self.progress_label.value = f'{result["time"]:%H:%M:%S} {values}, update took {result["duration"]:.2f} s{late}'
+            self.update_graph()
+
+        self.orbit_monitor = OrbitMonitor(
+            self.BPM_data, self.aperture_data, knobs, period=period, 
+            callback=show, label=self.progress_label, **kwargs)
+        self.orbit_monitor.start()
+
+    def stop_orbit_monitor(self) -> None:
+        """Stop following the BPM data."""
+        if getattr(self, 'orbit_monitor', None) is not None:
+            self.orbit_monitor.stop()
+            self.orbit_monitor = None
+
     def define_ls_tab(self):
         """Group all the widgets for the least squares fitting
         and timber data into one vbox.
         """
         # Create layout for the timber row of controls
-        timber_row_layout = self.initialise_timber_data()
+        timber_row_layout, series_row_layout = self.initialise_timber_data()
 
         # Create layout for the timber row of controls
         ls_row_layout = self.create_ls_controls()
@@ -1745,6 +1951,8 @@ class InteractiveTool:
             [
             widgets.HTML("<h4>Load collimator and BPM data</h4>"),
             timber_row_layout, 
+            widgets.HTML("<h4>Follow collimator gaps over time</h4>"),
+            series_row_layout,
             widgets.HTML("<h4>Perform least-squares fitting</h4>"),
             ls_row_layout
             ],
@@ -1851,22 +2059,10 @@ class InteractiveTool:
             return
 
         try:
-            # Parse the time string to extract hours, minutes, and seconds
-            selected_time = datetime.strptime(selected_time_str, '%H:%M:%S').time()
-            
-            combined_datetime = datetime(
-                selected_date.year, selected_date.month, selected_date.day,
-                selected_time.hour, selected_time.minute, selected_time.second
-            )
-
-            # Convert to pandas datetime and localize to Zurich time
-            zurich_time = pd.Timestamp(combined_datetime, tz="Europe/Zurich")
-
-            # Convert to UTC
-            utc_time = zurich_time.tz_convert("UTC")
+            utc_time = self._to_utc(selected_date, selected_time_str)
 
             # Load data using the provided loader
-            data_loader(utc_time.to_pydatetime())
+            data_loader(utc_time)
 
             # Check if the data meets the update condition and update the graph
             if update_condition():
@@ -1877,6 +2073,70 @@ class InteractiveTool:
         except ValueError:
             self.progress_label.value = "Invalid time format. Please use HH:MM:SS."
 
+    def _to_utc(self, selected_date, selected_time_str):
+        """Combine the date and a HH:MM:SS string given in Zurich time into a UTC datetime."""
+        # Parse the time string to extract hours, minutes, and seconds
+        selected_time = datetime.strptime(selected_time_str, '%H:%M:%S').time()
+        
+        combined_datetime = datetime(
+            selected_date.year, selected_date.month, selected_date.day,
+            selected_time.hour, selected_time.minute, selected_time.second
+        )
+
+        # Convert to pandas datetime and localize to Zurich time
+        zurich_time = pd.Timestamp(combined_datetime, tz="Europe/Zurich")
+
+        # Convert to UTC
+        return zurich_time.tz_convert("UTC").to_pydatetime()
+
+    def on_load_cols_series_button_clicked(self, b):
+        """Handle the event when the Load collimator series button is clicked.
+
+        Load the collimator gaps between the start and end time 
+        and enable the slider to scrub through them.
+        """
+        selected_date = self.date_picker.value
+
+        if (not selected_date or 
+            not self.time_input.value or 
+            not self.end_time_input.value):
+            self.progress_label.value = "Select a date, a start time and an end time to load collimator data."
+            return
+
+        try:
+            start = self._to_utc(selected_date, self.time_input.value)
+            end = self._to_utc(selected_date, self.end_time_input.value)
+        except ValueError:
+            self.progress_label.value = "Invalid time format. Please use HH:MM:SS."
+            return
+        
+        if end <= start:
+            self.progress_label.value = "The end time must be after the start time."
+            return
+
+        self.collimator_data.load_time_series(start, end)
+
+        # Reset the slider without triggering a redraw for each change
+        self.collimator_time_slider.unobserve(self.on_collimator_time_slider_change, names='value')
+        self.collimator_time_slider.max = len(self.collimator_data.times) - 1
+        self.collimator_time_slider.value = 0
+        self.collimator_time_slider.disabled = False
+        self.collimator_time_slider.observe(self.on_collimator_time_slider_change, names='value')
+
+        self.on_collimator_time_slider_change({'new': 0})
+
+    def on_collimator_time_slider_change(self, change):
+        """Show the collimator gaps at the time selected with the slider."""
+        index = change['new']
+        self.collimator_data.select_time(index)
+
+        # Display the selected time in Zurich time
+        time = pd.Timestamp(self.collimator_data.times[index], unit='s', tz='UTC')
+        self.collimator_time_label.value = time.tz_convert('Europe/Zurich').strftime('%H:%M:%S')
+
+        if hasattr(self, 'aperture_data'):
+            self.update_graph()
+
     def on_load_BPMs_button_clicked(self, b):
         """Handle the event when the Load BPMs button is clicked. 
         
@@ -2156,20 +2416,46 @@ class InteractiveTool:
         
         # If line loaded add all the available traces
         if hasattr(self, 'aperture_data'): 
-            self.create_figure()
+            # Keep the full resolution traces for zooming
+            self.full_layers = self.create_layers()
+            layers = self._downsample_layers(self.full_layers, self.plot_range)
+            if self.compact_arrays: self._compact_layers(layers)
+
+            # If the same traces are already displayed, only patch the changed layers
+            if self._can_patch(layers):
+                self._patch_figure(layers)
+                return
+            
+            self.create_figure(layers)
             
         # Else return an empty figure
         else: 
+            layers = []
             self.fig = make_subplots(rows=1, cols=1)
             self.row, self.col = 1, 1
             # Disable all butons if the line not loaded
             self.disable_buttons()
 
         self.update_layout()   
-        # Change to a widget
-        self.fig_widget = go.FigureWidget(self.fig)
-        # Put the figure in the graph container
-        self.graph_container.children = [self.fig_widget]
+
+        # Keep the displayed widget and replace its content
+        if hasattr(self, 'fig_widget'):
+            with self.fig_widget.batch_update():
+                self.fig_widget.data = []
+                self.fig_widget.layout = self.fig.layout
+                self.fig_widget.add_traces(self.fig.data)
+        else:
+            # Change to a widget
+            self.fig_widget = go.FigureWidget(self.fig)
+            # Put the figure in the graph container
+            self.graph_container.children = [self.fig_widget]
+
+        # Resample the traces when the user zooms
+        xaxis = 'xaxis' if self.row == 1 else f'xaxis{self.row}'
+        self.fig_widget.layout.on_change(self._on_x_range_change, f'{xaxis}.range')
+
+        # Keep track of the displayed layers
+        self.drawn_layers = layers
 
     def show(self,
              width: Optional[int] = 2000, 
@@ -2213,23 +2499,84 @@ class InteractiveTool:
 
         return go.FigureWidget(fig)
     
-    def _add_traces(self, trace_function, *args):
-        """Add traces and update visibility lists."""
+    def _cached_layer(self, name, sources, trace_function, *args):
+        """Return the traces of a static layer, only regenerating them 
+        if any of the source DataFrames were replaced or the plane changed.
+
+        Parameters:
+            name: Name of the layer.
+            sources: Objects the layer is built from, compared by identity.
+            trace_function: Function returning the visibility and the traces.
+            args: Arguments passed to the trace_function.
+        """
+        key = (name, self.plane)
+        cached = self.layer_cache.get(key)
+
+        if (cached is not None and 
+            len(cached[0]) == len(sources) and 
+            all(old is new for old, new in zip(cached[0], sources))):
+            return cached[1], cached[2]
+
         visibility, traces = trace_function(*args)
-        for trace in traces:
-            self.fig.add_trace(trace, row=self.row, col=self.col)
-        self.visibility_b1 = np.append(self.visibility_b1, visibility)
-        self.visibility_b2 = np.append(self.visibility_b2, ~np.array(visibility))
+        self.layer_cache[key] = (sources, visibility, traces)
+
+        return visibility, traces
+
+    def create_layers(self):
+        """Create a list of figure layers based on the available attributes.
+
+        Static layers (machine components, aperture and nominal orbit) 
+        are reused from the cache, all the others are regenerated.
+
+        Returns:
+            List of tuples (name, visibility, traces) in the order of plotting.
+        """
+        if not hasattr(self, 'layer_cache'): self.layer_cache = {}
+        layers = []
+
+        # If thick machine elements are loaded
+        if hasattr(self.aperture_data, 'elements'):
+            layers.append(('elements', *self._cached_layer(
+                'elements', (self.aperture_data.elements,), 
+                plot_machine_components, self.aperture_data)))
+
+        # If there is aperture data
+        if hasattr(self.aperture_data, 'aper_b1'):
+            layers.append(('aperture', *self._cached_layer(
+                'aperture', (self.aperture_data.aper_b1, self.aperture_data.aper_b2),
+                plot_aperture, self.aperture_data, self.plane)))
+
+        # If there are collimators loaded from yaml file
+        if hasattr(self.aperture_data, 'colx_b1'):
+            layers.append(('collimators_yaml', 
+                           *plot_collimators_from_yaml(self.aperture_data, self.plane)))
 
-    def create_figure(self):
+        # If collimators were loaded from timber
+        if (self.collimator_data and 
+            hasattr(self.collimator_data, 'colx_b1')):
+            layers.append(('collimators_timber', 
+                           *plot_collimators_from_timber(self.collimator_data, self.aperture_data, self.plane)))
+
+        # If BPM data was loaded from timber
+        if (self.BPM_data and 
+            hasattr(self.BPM_data, 'data')):
+            layers.append(('bpm', *plot_BPM_data(self.BPM_data, self.plane, self.aperture_data)))
+            
+        layers.append(('beam_positions', *plot_beam_positions(self.aperture_data, self.plane)))
+        layers.append(('nominal', *self._cached_layer(
+            'nominal', (self.aperture_data.nom_b1, self.aperture_data.nom_b2),
+            plot_nominal_beam_positions, self.aperture_data, self.plane)))
+        layers.append(('envelopes', *plot_envelopes(self.aperture_data, self.plane)))
+
+        return layers
+
+    def create_figure(self, layers=None):
         """Create a Plotly figure with multiple traces 
         based on the available attributes."""
-        # These correspond to swapping between visibilities of aperture/collimators for beam 1 and 2
-        self.visibility_b1 = np.array([], dtype=bool)
-        self.visibility_b2 = np.array([], dtype=bool)
+        if layers is None: layers = self.create_layers()
 
         # If thick machine elements are loaded
-        if hasattr(self.aperture_data, 'elements'):
+        if layers[0][0] == 'elements':
 
             # Create 2 subplots: for elements and the plot
             self.fig = make_subplots(rows=2, cols=1, row_heights=[0.2, 0.8], shared_xaxes=True)
@@ -2237,19 +2584,10 @@ class InteractiveTool:
             # Update layout of the upper plot (machine components plot)
             self.fig.update_yaxes(range=[-1, 1], showticklabels=False, showline=False, row=1, col=1)
             self.fig.update_xaxes(showticklabels=False, showline=False, row=1, col=1)
-            
-            elements_visibility, elements = plot_machine_components(self.aperture_data)
-
-            for i in elements:
-                self.fig.add_trace(i, row=1, col=1)
 
             # Row and col for other traces
             self.row, self.col = 2, 1
 
-            # Always show machine components
-            self.visibility_b1 = np.append(self.visibility_b1, elements_visibility)
-            self.visibility_b2 = np.append(self.visibility_b2, elements_visibility)
-
         # If thick machine elements are not loaded
         else:
             # Create only one plot
@@ -2257,33 +2595,99 @@ class InteractiveTool:
             # Row and col for other traces
             self.row, self.col = 1, 1
 
-        # If there is aperture data
-        if hasattr(self.aperture_data, 'aper_b1'):
-            self._add_traces(plot_aperture, self.aperture_data, self.plane)
+        for name, visibility, traces in layers:
+            # Machine components are shown in the upper plot
+            row = 1 if name == 'elements' else self.row
+            for trace in traces:
+                self.fig.add_trace(trace, row=row, col=self.col)
 
-        # If there are collimators loaded from yaml file
-        if hasattr(self.aperture_data, 'colx_b1'):
-            self._add_traces(plot_collimators_from_yaml, self.aperture_data, self.plane)
+        self._define_visibility(layers)
 
-        # If collimators were loaded from timber
-        if (self.collimator_data and 
-            hasattr(self.collimator_data, 'colx_b1')):
-            self._add_traces(plot_collimators_from_timber, self.collimator_data, self.aperture_data, self.plane)
+    def _define_visibility(self, layers):
+        """Define the visibility arrays used to swap between beam 1 and beam 2."""
+        # These correspond to swapping between visibilities of aperture/collimators for beam 1 and 2
+        self.visibility_b1 = np.concatenate(
+            [np.array(visibility, dtype=bool) for _, visibility, _ in layers])
+        # Always show machine components
+        self.visibility_b2 = np.concatenate([
+            np.array(visibility, dtype=bool) if name == 'elements' else ~np.array(visibility, dtype=bool)
+            for name, visibility, _ in layers
+            ])
+        self.visibility_both = np.full(len(self.visibility_b1), True)
 
-        # If BPM data was loaded from timber
-        if (self.BPM_data and 
-            hasattr(self.BPM_data, 'data')):
-            self._add_traces(plot_BPM_data, self.BPM_data, self.plane, self.aperture_data)
-            
-        self._add_traces(plot_beam_positions, self.aperture_data, self.plane)
-        self._add_traces(plot_nominal_beam_positions, self.aperture_data, self.plane)
-        self._add_traces(plot_envelopes, self.aperture_data, self.plane)
+    def _can_patch(self, layers):
+        """Check if the displayed figure has the same layers and numbers of traces."""
+        if not getattr(self, 'drawn_layers', None): return False
+
+        return (
+            [(name, len(traces)) for name, _, traces in layers] == 
+            [(name, len(traces)) for name, _, traces in self.drawn_layers]
+            )
+
+    def _patch_figure(self, layers):
+        """Update the traces of the changed layers in the existing FigureWidget."""
+        with self.fig_widget.batch_update():
+            self._patch_traces(layers)
+            self._define_visibility(layers)
+            self.drawn_layers = layers
+            self.fig = self.fig_widget
+            self.update_layout()
+
+    def _downsample_layers(self, layers, x_range):
+        """Downsample the orbit and envelope layers to the given x range."""
+        if not self.max_points: return layers
+
+        return [
+            (name, visibility, [downsample_trace(trace, x_range, self.max_points) for trace in traces])
+            if name in ['beam_positions', 'nominal', 'envelopes'] else (name, visibility, traces)
+            for name, visibility, traces in layers
+            ]
+
+    def _compact_layers(self, layers):
+        """Convert the large arrays of all traces to float32 where precision allows."""
+        for _, _, traces in layers:
+            for trace in traces:
+                compact_trace(trace)
+
+    def _on_x_range_change(self, layout, x_range):
+        """Show the orbit and envelopes with the resolution needed for the new x range."""
+        if not self.max_points or not getattr(self, 'drawn_layers', None) or x_range is None: return
+
+        layers = self._downsample_layers(self.full_layers, x_range)
+        if self.compact_arrays: self._compact_layers(layers)
+
+        with self.fig_widget.batch_update():
+            self._patch_traces(layers)
+            self.drawn_layers = layers
+
+    def _patch_traces(self, layers):
+        """Update the displayed traces of the layers that were regenerated."""
+        index = 0
+        for (_, _, traces), (_, _, drawn_traces) in zip(layers, self.drawn_layers):
+            # Static layers taken from the cache are already displayed
+            if traces is not drawn_traces:
+                for i, trace in enumerate(traces):
+                    self._update_trace(self.fig_widget.data[index + i], trace)
+            index += len(traces)
+
+    def _update_trace(self, displayed, trace):
+        """Push only the properties of a trace that differ from the displayed ones.
+
+        Parameters:
+            displayed: Trace of the FigureWidget.
+            trace: New trace with the same type.
+        """
+        properties = trace.to_plotly_json()
+        # Keep the beam selected by the user
+        properties.pop('visible', None)
+        properties.pop('type', None)
+
+        current = displayed.to_plotly_json()
+        changed = {key: value for key, value in properties.items() 
+                   if not _equal_properties(current.get(key), value)}
+        
+        if changed: displayed.update(changed)
 
-        # Convert lists to NumPy arrays and finalize visibility settings
-        self.visibility_b1 = np.array(self.visibility_b1, dtype=bool)
-        self.visibility_b2 = np.array(self.visibility_b2, dtype=bool)
-        self.visibility_both = np.full(len(self.visibility_b1), True)
-       
     def update_layout(self):
         """Update the layout of the given figure 
         with appropriate settings and visibility toggles.
@@ -2331,3 +2735,18 @@ class InteractiveTool:
                 )
             
 
+def _equal_properties(a, b) -> bool:
+    """Compare two trace properties, arrays are compared element-wise."""
+    if isinstance(a, dict) and isinstance(b, dict):
+        return (a.keys() == b.keys() and 
+                all(_equal_properties(a[key], b[key]) for key in a))
+    
+    if isinstance(a, (list, tuple, np.ndarray)) or isinstance(b, (list, tuple, np.ndarray)):
+        if a is None or b is None: return False
+        a, b = np.asarray(a), np.asarray(b)
+        if a.shape != b.shape: return False
+        try: return np.array_equal(a, b, equal_nan=True)
+        # Strings and mixed arrays can not contain NaN
+        except TypeError: return np.array_equal(a, b)
+    
+    return a == b
@@ -0,0 +1,159 @@
+import numpy as np
+
+from abc import ABC, abstractmethod
+from pathlib import Path
+from datetime import datetime
+from typing import Dict, List, Optional, Tuple, Union
+
+class LoggingBackend(ABC):
+    """Interface for sources of logged variables.
+
+    A backend returns data in the same format as `pytimber.LoggingDB.get`:
+    a dictionary mapping each variable name found in the source to a tuple
+    (timestamps, values), where timestamps are unix times in seconds.
+    Variables that are not available are left out of the dictionary.
+    """
+
+    @abstractmethod
+    def get(self, variables: Union[str, List[str]],
+            t1, t2=None) -> Dict[str, Tuple[np.ndarray, np.ndarray]]:
+        """Fetch the logged values of the variables between t1 and t2,
+        or the last value before t1 if t2 is not given."""
+
+class PytimberBackend(LoggingBackend):
+
+    def __init__(self, spark):
+        """Initialise the connection to the logging database.
+
+        Parameters:
+            spark: Spark session for accessing the LoggingDB,
+                or a string to use the default NXCALS source.
+        """
+        # Import here so that pytimber is only needed when the database is used
+        import pytimber
+
+        if isinstance(spark, str): self.ldb = pytimber.LoggingDB(source="nxcals")
+        else: self.ldb = pytimber.LoggingDB(spark_session=spark)
+
+    def get(self, variables, t1, t2=None):
+        return self.ldb.get(variables, t1, t2)
+
+class ReplayBackend(LoggingBackend):
+
+    def __init__(self, directory: str):
+        """Serve recorded variables from local files.
+
+        Each variable is stored in the directory as a .npz file
+        holding the arrays `timestamps` and `values`.
+
+        Parameters:
+            directory: Path to the directory with the recorded variables.
+        """
+        self.directory = Path(directory)
+        # Variables are read from disk only once
+        self._cache = {}
+
+    @staticmethod
+    def _file_name(variable: str) -> str:
+        """Create a file name for a variable, colons are not allowed on all systems."""
+        return variable.replace(':', '__') + '.npz'
+
+    def _load(self, variable: str) -> Optional[Tuple[np.ndarray, np.ndarray]]:
+        """Load a recorded variable, returns None if it was not recorded."""
+        if variable not in self._cache:
+            path = self.directory / self._file_name(variable)
+            if path.exists():
+                with np.load(path) as f:
+                    self._cache[variable] = (f['timestamps'], f['values'])
+            else: self._cache[variable] = None
+
+        return self._cache[variable]
+
+    def get(self, variables, t1, t2=None):
+        """Fetch the recorded values of the variables between t1 and t2.
+
+        Parameters:
+            variables: A variable name or a list of variable names.
+            t1: Start of the interval.
+            t2: End of the interval, if not given the last value before t1 is returned.
+        """
+        if isinstance(variables, str): variables = [variables]
+
+        t1 = to_timestamp(t1)
+        if t2 is not None: t2 = to_timestamp(t2)
+
+        result = {}
+        for variable in variables:
+            recorded = self._load(variable)
+            if recorded is None: continue
+            timestamps, values = recorded
+
+            # Timestamps are sorted when recording so a binary search is enough
+            if t2 is None:
+                end = np.searchsorted(timestamps, t1, side='right')
+                start = max(end - 1, 0)
+            else:
+                start = np.searchsorted(timestamps, t1, side='left')
+                end = np.searchsorted(timestamps, t2, side='right')
+
+            result[variable] = (timestamps[start:end], values[start:end])
+
+        return result
+
+    def write(self, variable: str, timestamps, values) -> None:
+        """Save a variable to the replay directory.
+
+        Parameters:
+            variable: Name of the logged variable.
+            timestamps: Timestamps of the samples as unix times in seconds.
+            values: Logged values, one entry (or row) per timestamp.
+        """
+        self.directory.mkdir(parents=True, exist_ok=True)
+
+        timestamps = np.asarray(timestamps, dtype=float)
+        values = np.asarray(values)
+
+        # Keep the samples sorted in time for fast lookups
+        order = np.argsort(timestamps, kind='stable')
+        timestamps, values = timestamps[order], values[order]
+
+        np.savez(self.directory / self._file_name(variable),
+                 timestamps=timestamps, values=values)
+        self._cache[variable] = (timestamps, values)
+
+    def record(self, source: LoggingBackend,
+               variables: Union[str, List[str]], t1, t2=None) -> List[str]:
+        """Fetch variables from another backend and save them for replay.
+
+        Parameters:
+            source: The backend to record from, e.g. a PytimberBackend.
+            variables: A variable name or a list of variable names.
+            t1, t2: The interval to record.
+
+        Returns:
+            List[str]: Names of the variables that were not found in the source.
+        """
+        if isinstance(variables, str): variables = [variables]
+
+        data = source.get(variables, t1, t2)
+        for variable, (timestamps, values) in data.items():
+            self.write(variable, timestamps, values)
+
+        return [variable for variable in variables if variable not in data]
+
+def to_timestamp(t) -> float:
+    """Convert a datetime, pandas timestamp or a number to unix time in seconds."""
+    if isinstance(t, datetime): return t.timestamp()
+    return float(t)
+
+def get_backend(spark) -> LoggingBackend:
+    """Create a logging backend from the argument given to BPMData or CollimatorsData.
+
+    Parameters:
+        spark: An existing LoggingBackend, a path to a replay directory
+            given as a pathlib.Path, a Spark session or a string
+            to use the default NXCALS source.
+    """
+    if isinstance(spark, LoggingBackend): return spark
+    if isinstance(spark, Path): return ReplayBackend(spark)
+    return PytimberBackend(spark)
@@ -0,0 +1,208 @@
+"""Follow the orbit during a fill: poll the BPM data at a fixed cadence and
+update the fitted knobs incrementally.
+
+Example:
+    monitor = OrbitMonitor(bpm_data, aper_data, ['on_x1', 'on_sep1'], period=1.0)
+    monitor.start()     # In a background thread
+    ...
+    monitor.stop()
+"""
+import threading
+import time
+import numpy as np
+
+from datetime import datetime, timedelta
+from typing import Callable, Dict, List, Optional, Tuple
+
+class OrbitMonitor:
+
+    def __init__(self,
+                 bpm_data: object,
+                 aper_data: object,
+                 knobs: List[str],
+                 period: Optional[float] = 1.0,
+                 s_range: Optional[Tuple[float, float]] = None,
+                 start_time: Optional[datetime] = None,
+                 delay: Optional[float] = 0,
+                 step: Optional[float] = 1.0,
+                 refresh_response: Optional[int] = None,
+                 acquisitions: Optional[int] = 1,
+                 callback: Optional[Callable[[Dict], None]] = None,
+                 clock: Optional[Callable[[], float]] = time.monotonic,
+                 sleep: Optional[Callable[[float], None]] = None,
+                 label=None):
+        """Initialise the monitor, nothing is loaded before the first update.
+
+        Every update loads the BPM data in place, with `BPMData.load_data`, and takes one
+        Gauss-Newton step from the previous knob values with the previous response matrix,
+        so only one orbit twiss is needed. The response matrix is computed at the first update.
+
+        Parameters:
+            bpm_data: A BPMData object, its logging backend can be live or a ReplayBackend.
+            aper_data: An ApertureData object, the knobs are left at the fitted values.
+            knobs: Names of the knobs to fit.
+            period: Time between updates in seconds.
+            s_range: If given, only the BPMs in this range are used.
+            start_time: If given, the logged data is replayed from this time at the real speed,
+                otherwise the last data logged before the current time is loaded.
+            delay: Seconds subtracted from the loaded time, e.g. to wait for all BPMs to be logged.
+            step: Knob change used to compute the response matrix.
+            refresh_response: If given, the response matrix is computed again every this many updates.
+            acquisitions: Number of acquisitions averaged at every update.
+            callback: Called with the result of every update, e.g. to update a figure.
+            clock: Monotonic clock in seconds, used for the cadence.
+            sleep: Function to wait for a number of seconds, by default waiting is interrupted by `stop`.
+            label: Label to report failed updates to, they are printed if not given.
+        """
+        self.bpm_data = bpm_data
+        self.aper_data = aper_data
+        self.knobs = knobs
+        self.period = period
+        self.s_range = s_range
+        self.start_time = start_time
+        self.delay = delay
+        self.step = step
+        self.refresh_response = refresh_response
+        self.acquisitions = acquisitions
+        self.callback = callback
+        self.clock = clock
+        self.sleep = sleep
+        self.label = label
+
+        # Warm start of the fit, the knob values and the response matrix of the previous update
+        current = aper_data.knobs.set_index('knob')['current value']
+        self.values = np.array([current[knob] for knob in knobs], dtype=float)
+        self.response = None
+        self.response_names = None
+
+        self.history = []
+        # Time and exception of every failed update
+        self.errors = []
+        self.updates = 0
+        self._stop = threading.Event()
+        self._thread = None
+        self._clock0 = None
+
+    def print_to_label(self, string):
+        if self.label is not None:
+            self.label.value = string
+        else: print(string)
+
+    def _time(self) -> datetime:
+        """Time of the data to load for the current update."""
+        if self._clock0 is None: self._clock0 = self.clock()
+
+        if self.start_time is not None:
+            t = self.start_time + timedelta(seconds=self.clock() - self._clock0)
+        else: t = datetime.now()
+
+        return t - timedelta(seconds=self.delay)
+
+    def _residuals(self, orbit_b1, orbit_b2) -> Tuple[np.ndarray, np.ndarray]:
+        """The names of the BPMs used and the residuals, horizontal then vertical."""
+        merged = self.bpm_data._merge_orbits(orbit_b1, orbit_b2, self.s_range)
+        return merged['name'].to_numpy(), self.bpm_data._orbit_residuals(merged)
+
+    def compute_response(self) -> None:
+        """Compute the response of the residuals to each knob at the current values."""
+        points = [self.values] + [self.values + self.step * unit for unit in np.eye(len(self.values))]
+        orbits = self.bpm_data._knob_orbits(self.aper_data, self.knobs, points, None)
+        names_residuals = [self._residuals(orbit_b1, orbit_b2) for orbit_b1, orbit_b2 in orbits]
+        residuals = [r for _, r in names_residuals]
+
+        # The BPMs of the rows, the response only applies to the same BPMs
+        self.response_names = names_residuals[0][0]
+
+        # Response of the simulated orbit, the residuals are measured minus simulated
+        self.response = np.column_stack([(residuals[0] - r) / self.step for r in residuals[1:]])
+
+        # Leave the knobs at the current values
+        for knob, value in zip(self.knobs, self.values): self.aper_data.change_knob(knob, value)
+
+    def update(self) -> Optional[Dict]:
+        """Load the latest BPM data and update the fitted knobs.
+
+        Returns:
+            Optional[Dict]: The time, knob values, uncertainties, rms of the residuals
+                and duration of the update, None if there was no data.
+        """
+        start = self.clock()
+        t = self._time()
+
+        # Live data is only available up to now, replayed data from the start time on
+        self.bpm_data.load_data(t, self.acquisitions, latest=self.start_time is None)
+        if getattr(self.bpm_data, 'data', None) is None: return None
+
+        refresh = self.refresh_response and self.updates % self.refresh_response == 0
+        if self.response is None or refresh: self.compute_response()
+
+        names, residuals = self._residuals(*self.aper_data.twiss_orbit())
+        if not np.array_equal(names, self.response_names):
+            # The BPMs changed, the response matrix no longer matches
+            self.compute_response()
+            names, residuals = self._residuals(*self.aper_data.twiss_orbit())
+
+        # Ignore BPMs without a reading
+        valid = np.isfinite(residuals)
+        response, residuals = self.response[valid], residuals[valid]
+
+        delta = np.linalg.lstsq(response, residuals, rcond=None)[0]
+        self.values = self.values + delta
+        for knob, value in zip(self.knobs, self.values): self.aper_data.change_knob(knob, value)
+
+        # The orbit responds linearly so the residuals after the step can be predicted
+        predicted = residuals - response @ delta
+        sigma_squared = np.sum(predicted**2) / (len(predicted) - len(delta))
+        covariance = np.linalg.inv(response.T @ response) * sigma_squared
+
+        self.updates += 1
+        result = {
+            'time': t,
+            'values': dict(zip(self.knobs, self.values)),
+            'uncertainties': dict(zip(self.knobs, np.sqrt(np.diag(covariance)))),
+            'rms': np.sqrt(np.mean(predicted**2)),
+            'duration': self.clock() - start
+            }
+        self.history.append(result)
+
+        if self.callback is not None: self.callback(result)
+
+        return result
+
+    def run(self, count: Optional[int] = None) -> None:
+        """Update at a fixed cadence until stopped, or for a number of updates.
+
+        If an update takes longer than the period, the missed updates are skipped.
+        A failed update is reported and the monitor carries on with the next one.
+        """
+        self._stop.clear()
+        next_time = self.clock()
+        done = 0
+
+        while not self._stop.is_set() and (count is None or done < count):
+            try: self.update()
+            except Exception as e:
+                self.errors.append((datetime.now(), e))
+                self.print_to_label(f"Orbit monitor update failed: {type(e).__name__}: {e}")
+            done += 1
+
+            # Keep the cadence, skipping the updates that were missed
+            next_time += self.period
+            now = self.clock()
+            if now > next_time:
+                next_time += np.ceil((now - next_time) / self.period) * self.period
+            if count is None or done < count: (self.sleep or self._stop.wait)(next_time - now)
+
+    def start(self) -> None:
+        """Run the monitor in a background thread."""
+        if self._thread is not None and self._thread.is_alive(): return
+
+        self._thread = threading.Thread(target=self.run, daemon=True)
+        self._thread.start()
+
+    def stop(self) -> None:
+        """Stop the monitor after the current update."""
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
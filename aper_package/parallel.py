@@ -0,0 +1,172 @@
+"""Evaluate the closed orbit for many knob settings, or run independent fits, on a pool of processes.
+
+Every worker loads its own copy of the lines once, when the pool is created,
+and is brought to the same state as the ApertureData object the pool was
+created from: knob values, orbit corrector values and cycling.
+Starting the pool costs one line loading and twiss per worker, so it pays off
+when many orbits are evaluated, e.g. the Jacobian columns of a fit with several parameters.
+"""
+import pandas as pd
+
+from concurrent.futures import Future, ProcessPoolExecutor
+from itertools import repeat
+from typing import Dict, List, Optional, Tuple
+
+# The ApertureData object of a worker process, defined by the pool initializer
+_aperture_data = None
+
+def snapshot(aper_data: object) -> Dict:
+    """Collect the changed knob values and the cycling of an ApertureData object.
+
+    Parameters:
+        aper_data: An ApertureData object.
+
+    Returns:
+        Dict: A picklable description of the state, used by `apply_settings`.
+    """
+    settings = []
+
+    # Knobs are set for both beams, orbit correctors for one beam only
+    for df, beam in [
+        (aper_data.knobs, None),
+        (aper_data.acbh_knobs_b1, 'beam 1'), (aper_data.acbv_knobs_b1, 'beam 1'),
+        (aper_data.acbh_knobs_b2, 'beam 2'), (aper_data.acbv_knobs_b2, 'beam 2')]:
+        changed = df[df['current value'] != df['initial value']]
+        settings += [(knob, value, beam) for knob, value in zip(changed['knob'], changed['current value'])]
+
+    return {
+        'settings': settings,
+        'first_element': getattr(aper_data, 'first_element', None)
+        }
+
+def apply_settings(aper_data: object, settings: List[Tuple[str, float, Optional[str]]]) -> None:
+    """Set knob values in the lines and in the knob DataFrames.
+
+    Parameters:
+        aper_data: An ApertureData object.
+        settings: A list of (knob, value, beam), beam is 'beam 1', 'beam 2' or None for both.
+    """
+    for knob, value, beam in settings:
+        if beam is None: aper_data.change_knob(knob, value)
+        else: aper_data.change_acb_knob(knob, value, beam)
+
+def _init_worker(path_b1: str, path_b2: Optional[str], state: Dict) -> None:
+    """Load the lines in a worker process and apply the state of the parent."""
+    global _aperture_data
+    from aper_package.aperture_data import ApertureData
+
+    # Progress messages go to a silent label, many workers print at the same time
+    label = type('Label', (), {'value': ''})()
+    _aperture_data = ApertureData(path_b1, path_b2, label=label)
+
+    apply_settings(_aperture_data, state['settings'])
+    if state['first_element'] is not None:
+        _aperture_data.first_element = state['first_element']
+
+def _orbit(
+        settings: List[Tuple[str, float, Optional[str]]],
+        names: Optional[List[str]]) -> Tuple[pd.DataFrame, pd.DataFrame]:
+    """Apply the settings in a worker process and compute the orbit of both beams."""
+    apply_settings(_aperture_data, settings)
+    orbit_b1, orbit_b2 = _aperture_data.twiss_orbit()
+
+    # Only send back the elements that are needed
+    if names is not None:
+        orbit_b1 = orbit_b1[orbit_b1['name'].isin(names)]
+        orbit_b2 = orbit_b2[orbit_b2['name'].isin(names)]
+
+    return orbit_b1, orbit_b2
+
+def _fit_knob(
+        bpm_data: object, knob: str, plane: str, 
+        s_range: Tuple[float, float], angle_range: Tuple[float, float],
+        rounded: bool) -> Tuple[float, float]:
+    """Fit one knob in a worker process, starting from and restoring its value in the state of the pool."""
+    init_angle = _aperture_data.line_b1.vv.get(knob)
+
+    try:
+        if rounded:
+            return bpm_data.least_squares_fit(_aperture_data, init_angle, knob, plane, angle_range, s_range)
+
+        params, uncertainty, _, _ = bpm_data._knob_fit(_aperture_data, init_angle, knob, plane, angle_range, s_range)
+        return params[0], uncertainty[0]
+    finally:
+        # The next fit in this worker starts from the state of the pool again
+        _aperture_data.change_knob(knob, init_angle)
+
+class OrbitPool:
+
+    def __init__(self, aper_data: object, workers: Optional[int] = None):
+        """Start a pool of processes with copies of the lines of an ApertureData object.
+
+        Parameters:
+            aper_data: An ApertureData object, its current state is copied to the workers.
+            workers: Number of processes, by default the number of cores.
+        """
+        self.executor = ProcessPoolExecutor(
+            max_workers=workers, initializer=_init_worker,
+            initargs=(aper_data.path_b1, aper_data.path_b2, snapshot(aper_data)))
+
+    def orbits(
+            self, settings: List[List[Tuple[str, float, Optional[str]]]],
+            names: Optional[List[str]] = None) -> List[Tuple[pd.DataFrame, pd.DataFrame]]:
+        """Compute the orbit for each of the knob settings concurrently.
+
+        The settings of every evaluation should set all the knobs that are varied,
+        as the workers keep the values of the previous evaluation.
+
+        Parameters:
+            settings: One list of (knob, value, beam) per evaluation.
+            names: If given, only the orbit at these elements is returned.
+
+        Returns:
+            List[Tuple[pd.DataFrame, pd.DataFrame]]:
+                The orbit of beam 1 and beam 2 for each evaluation, as in ApertureData.twiss_orbit.
+        """
+        if names is not None: names = list(names)
+        return list(self.executor.map(_orbit, settings, repeat(names)))
+
+    def submit_fit(
+            self, bpm_data: object, knob: str, plane: str,
+            s_range: Tuple[float, float], angle_range: Tuple[float, float],
+            rounded: Optional[bool] = True) -> Future:
+        """Start a single knob fit with BPMData.least_squares_fit in a worker.
+
+        The fit starts from the value of the knob in the ApertureData object the pool
+        was created from, and the worker is brought back to that value afterwards.
+
+        Parameters:
+            rounded: If False, the result is not rounded to two decimals, e.g. for resampled fits.
+
+        Returns:
+            Future: The future of the best fit value and its uncertainty.
+        """
+        return self.executor.submit(_fit_knob, bpm_data, knob, plane, s_range, angle_range, rounded)
+
+    def fit_knobs(
+            self, bpm_data: object, 
+            fits: List[Tuple[str, str, Tuple[float, float], Tuple[float, float]]]
+            ) -> List[Tuple[float, float]]:
+        """Run independent single knob fits concurrently with BPMData.least_squares_fit.
+
+        Every fit starts from the value of its knob in the ApertureData object 
+        the pool was created from, as in `submit_fit`.
+
+        Parameters:
+            bpm_data: A BPMData object with data loaded.
+            fits: One (knob, plane, s_range, angle_range) per fit.
+
+        Returns:
+            List[Tuple[float, float]]: The best fit value and its uncertainty for each fit.
+        """
+        futures = [self.submit_fit(bpm_data, *fit) for fit in fits]
+        return [future.result() for future in futures]
+
+    def close(self) -> None:
+        self.executor.shutdown()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
@@ -0,0 +1,205 @@
+from __future__ import annotations
+
+import base64
+import json
+import numpy as np
+
+from typing import Any, Optional, Union
+from aper_package.utils import lazy_import
+
+# Loaded on first use
+go = lazy_import('plotly.graph_objects')
+
+# Arrays shorter than this are left as they are
+MIN_SIZE = 1000
+
+# Largest error allowed when converting float64 to float32, in the units of the data.
+# The plots are in metres, 0.1 mm is not visible even when zooming on one element,
+# while s around the ring (up to 27 km) is kept as float64
+ATOL = 1e-4
+
+# Type codes understood by plotly.js (>= 2.28) for typed arrays
+_DTYPES = {
+    np.dtype('float64'): 'f8',
+    np.dtype('float32'): 'f4',
+    np.dtype('int32'): 'i4',
+    np.dtype('int16'): 'i2',
+    np.dtype('int8'): 'i1',
+    np.dtype('uint32'): 'u4',
+    np.dtype('uint16'): 'u2',
+    np.dtype('uint8'): 'u1',
+    }
+
+# Plotly.js version that can read typed arrays in JSON
+PLOTLYJS_CDN = 'https://cdn.plot.ly/plotly-2.35.2.min.js'
+
+def to_numeric_array(value: Any,
+                     atol: float = ATOL,
+                     min_size: int = MIN_SIZE) -> Optional[np.ndarray]:
+    """Convert a large numeric sequence to the smallest NumPy array that keeps its precision.
+
+    Parameters:
+        value: Property of a trace, e.g. x, y or customdata.
+        atol: Absolute error allowed when converting float64 to float32, see ATOL.
+        min_size: Sequences with fewer elements are not converted.
+
+    Returns:
+        Optional[np.ndarray]: The converted array, None if the value is not a large numeric array.
+    """
+    if not isinstance(value, (list, tuple, np.ndarray)) or len(value) < min_size: return None
+
+    try: array = np.asarray(value)
+    # Ragged sequences
+    except ValueError: return None
+
+    if array.dtype.kind == 'f':
+        single = array.astype(np.float32)
+        # Use float32 only if the values survive the round trip
+        if np.allclose(single, array, rtol=0, atol=atol, equal_nan=True): return single
+        return array.astype(np.float64)
+
+    if array.dtype.kind in 'iub':
+        # plotly.js has no 64-bit integers
+        for dtype in [np.int8, np.uint8, np.int16, np.uint16, np.int32, np.uint32]:
+            info = np.iinfo(dtype)
+            if array.size == 0 or (array.min() >= info.min and array.max() <= info.max):
+                return array.astype(dtype)
+
+    return None
+
+def compact_figure(fig: go.Figure,
+                   atol: float = ATOL,
+                   min_size: int = MIN_SIZE) -> go.Figure:
+    """Convert the large numeric arrays of all traces to NumPy arrays,
+    with float32 where precision allows.
+
+    FigureWidget sends NumPy arrays to the browser as binary buffers,
+    so the converted figure is both smaller and faster to transfer.
+
+    Parameters:
+        fig: The figure to convert, it is modified in place.
+        atol: Absolute error allowed when converting float64 to float32, see ATOL.
+        min_size: Arrays with fewer elements are not converted.
+
+    Returns:
+        go.Figure: The same figure.
+    """
+    for trace in fig.data:
+        compact_trace(trace, atol, min_size)
+
+    return fig
+
+def compact_trace(trace: go.Scatter,
+                  atol: float = ATOL,
+                  min_size: int = MIN_SIZE) -> go.Scatter:
+    """Convert the large numeric arrays of a trace in place, see compact_figure."""
+    update = {}
+    for key in ['x', 'y', 'customdata']:
+        array = to_numeric_array(trace[key], atol, min_size)
+        if array is not None: update[key] = array
+
+    if update: trace.update(update)
+
+    return trace
+
+def encode_typed_arrays(obj: Any,
+                        atol: float = ATOL,
+                        min_size: int = MIN_SIZE) -> Any:
+    """Replace the large numeric arrays in a plotly JSON structure
+    with base64 encoded typed arrays ({'dtype': ..., 'bdata': ...}).
+
+    Parameters:
+        obj: Output of `fig.to_plotly_json()` or any part of it.
+        atol: Absolute error allowed when converting float64 to float32, see ATOL.
+        min_size: Arrays with fewer elements are left as lists.
+    """
+    if isinstance(obj, dict):
+        return {key: encode_typed_arrays(value, atol, min_size) for key, value in obj.items()}
+
+    array = to_numeric_array(obj, atol, min_size)
+    if array is not None and array.ndim <= 2 and array.dtype in _DTYPES:
+        encoded = {
+            'dtype': _DTYPES[array.dtype],
+            'bdata': base64.b64encode(np.ascontiguousarray(array).tobytes()).decode('ascii')
+            }
+        if array.ndim == 2: encoded['shape'] = f'{array.shape[0]}, {array.shape[1]}'
+        return encoded
+
+    if isinstance(obj, (list, tuple)):
+        return [encode_typed_arrays(value, atol, min_size) for value in obj]
+
+    return obj
+
+def decode_typed_array(encoded: dict) -> np.ndarray:
+    """Decode a typed array created by encode_typed_arrays."""
+    dtypes = {code: dtype for dtype, code in _DTYPES.items()}
+    array = np.frombuffer(base64.b64decode(encoded['bdata']), dtype=dtypes[encoded['dtype']])
+
+    if 'shape' in encoded:
+        array = array.reshape([int(i) for i in encoded['shape'].split(',')])
+
+    return array
+
+def figure_to_json(fig: Union[go.Figure, dict],
+                   typed_arrays: bool = True,
+                   atol: float = ATOL,
+                   min_size: int = MIN_SIZE) -> str:
+    """Serialise a figure to JSON, encoding large arrays as typed arrays.
+
+    Parameters:
+        fig: The figure or its plotly JSON dictionary.
+        typed_arrays: If False, use the standard plotly serialisation.
+        atol: Absolute error allowed when converting float64 to float32, see ATOL.
+        min_size: Arrays with fewer elements are left as lists.
+    """
+    if not typed_arrays:
+        if isinstance(fig, dict): fig = go.Figure(fig)
+        return fig.to_json()
+
+    if not isinstance(fig, dict): fig = fig.to_plotly_json()
+
+    return json.dumps(encode_typed_arrays(fig, atol, min_size), cls=_Encoder)
+
+def write_html(fig: go.Figure,
+               path: str,
+               typed_arrays: bool = True,
+               atol: float = ATOL) -> None:
+    """Save a figure as a standalone HTML file.
+
+    Typed arrays need plotly.js 2.28 or newer, which is loaded from the CDN.
+
+    Parameters:
+        fig: The figure to save.
+        path: Path of the HTML file.
+        typed_arrays: If False, use the standard plotly serialisation.
+        atol: Absolute error allowed when converting float64 to float32, see ATOL.
+    """
+    if not typed_arrays:
+        fig.write_html(path)
+        return
+
+    html = (
+        '<html>\n<head><meta charset="utf-8" /></head>\n<body>\n'
+        f'<script src="{PLOTLYJS_CDN}"></script>\n'
+        '<div id="figure"></div>\n'
+        '<script>\n'
+        f'var figure = {figure_to_json(fig, True, atol)};\n'
+        'Plotly.newPlot("figure", figure.data, figure.layout);\n'
+        '</script>\n</body>\n</html>\n'
+        )
+
+    with open(path, 'w') as f:
+        f.write(html)
+
+class _Encoder(json.JSONEncoder):
+    """Serialise the remaining NumPy and pandas objects."""
+
+    def default(self, obj):
+        if isinstance(obj, np.ndarray):
+            if obj.dtype.kind == 'f': obj = np.where(np.isnan(obj), None, obj)
+            return obj.tolist()
+        if isinstance(obj, np.generic):
+            obj = obj.item()
+            return None if isinstance(obj, float) and np.isnan(obj) else obj
+        if hasattr(obj, 'tolist'): return obj.tolist()
+        return super().default(obj)
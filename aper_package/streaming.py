@@ -0,0 +1,237 @@
+"""Receive orbit acquisitions pushed at several Hz into a preallocated ring buffer.
+
+A publisher sends the BPM names once to every subscriber and then each
+acquisition as raw float64 arrays, a subscriber stores them in an OrbitRingBuffer.
+Only the standard library is used, the socket stands in for the pub/sub
+service of the machine.
+
+Example:
+    buffer = OrbitRingBuffer.from_bpm_data(bpm_data, capacity=600)
+    subscriber = OrbitSubscriber('localhost', 5555, buffer)
+    subscriber.start()
+    ...
+    times, x, y = buffer.window(50)     # Views of the last 50 acquisitions
+"""
+import json
+import socket
+import struct
+import threading
+import numpy as np
+import pandas as pd
+
+from typing import List, Optional, Tuple
+
+# Every message starts with its type and the length of the payload
+_HEADER = struct.Struct('!cI')
+_NAMES, _ORBIT = b'N', b'O'
+
+class OrbitRingBuffer:
+
+    def __init__(self, names: List[str], capacity: Optional[int] = 1000):
+        """Preallocate a (time x BPM) buffer for the last acquisitions.
+
+        Every row is written twice, capacity rows apart, so that the
+        last n acquisitions are always contiguous and can be read without copying.
+
+        Parameters:
+            names: BPM names defining the columns, e.g. from BPMData.load_data.
+            capacity: Number of acquisitions kept.
+        """
+        self.names = np.char.lower(np.asarray(names, dtype=str))
+        self.columns = {name: i for i, name in enumerate(self.names)}
+        self.capacity = capacity
+
+        self._times = np.full(2*capacity, np.nan)
+        self._x = np.full((2*capacity, len(self.names)), np.nan)
+        self._y = np.full((2*capacity, len(self.names)), np.nan)
+
+        # Total number of acquisitions pushed
+        self.count = 0
+        self._lock = threading.Lock()
+
+    @classmethod
+    def from_bpm_data(cls, bpm_data: object, capacity: Optional[int] = 1000) -> 'OrbitRingBuffer':
+        """Create a buffer with the BPMs of the data loaded in a BPMData object."""
+        return cls(bpm_data.data['name'], capacity)
+
+    def column_indices(self, names: List[str]) -> Tuple[np.ndarray, np.ndarray]:
+        """Find the buffer columns of BPM names in another order.
+
+        Returns:
+            Tuple[np.ndarray, np.ndarray]: Positions in names of the known BPMs and their buffer columns.
+        """
+        names = np.char.lower(np.asarray(names, dtype=str))
+        found = np.array([name in self.columns for name in names], dtype=bool)
+        columns = np.array([self.columns[name] for name in names[found]], dtype=int)
+
+        return np.flatnonzero(found), columns
+
+    def push(self, t: float, x: np.ndarray, y: np.ndarray,
+             columns: Optional[Tuple[np.ndarray, np.ndarray]] = None) -> None:
+        """Store one acquisition, overwriting the oldest one if the buffer is full.
+
+        Parameters:
+            t: Time of the acquisition as unix time in seconds.
+            x, y: Positions in metres, in the order of the buffer columns.
+            columns: If the positions are in another order, the result of `column_indices`.
+        """
+        with self._lock:
+            row = self.count % self.capacity
+            for i in (row, row + self.capacity):
+                self._times[i] = t
+                if columns is None:
+                    self._x[i], self._y[i] = x, y
+                else:
+                    # BPMs missing from the acquisition stay NaN
+                    self._x[i], self._y[i] = np.nan, np.nan
+                    self._x[i, columns[1]] = np.asarray(x)[columns[0]]
+                    self._y[i, columns[1]] = np.asarray(y)[columns[0]]
+            self.count += 1
+
+    def window(self, n: Optional[int] = None) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+        """Read-only views of the last n acquisitions, oldest first.
+
+        The views are overwritten once capacity - n more acquisitions are pushed,
+        copy them to keep them longer.
+
+        Parameters:
+            n: Number of acquisitions, by default all that are stored.
+
+        Returns:
+            Tuple[np.ndarray, np.ndarray, np.ndarray]: The times, and the (time x BPM) x and y positions.
+        """
+        with self._lock:
+            stored = min(self.count, self.capacity)
+            n = stored if n is None else min(n, stored)
+            end = (self.count - 1) % self.capacity + self.capacity + 1
+            window = slice(end - n, end)
+
+            views = self._times[window], self._x[window], self._y[window]
+        for view in views: view.flags.writeable = False
+
+        return views
+
+    def latest(self) -> Optional[pd.DataFrame]:
+        """The last acquisition in the format of BPMData.data, None if nothing was received."""
+        if self.count == 0: return None
+        times, x, y = self.window(1)
+        return pd.DataFrame({'name': self.names, 'x': x[-1], 'y': y[-1]})
+
+def _send(connection: socket.socket, kind: bytes, payload: bytes) -> None:
+    connection.sendall(_HEADER.pack(kind, len(payload)) + payload)
+
+def _receive_exactly(connection: socket.socket, size: int) -> Optional[bytes]:
+    """Read size bytes, None if the connection was closed."""
+    data = bytearray()
+    while len(data) < size:
+        chunk = connection.recv(size - len(data))
+        if not chunk: return None
+        data += chunk
+    return bytes(data)
+
+class OrbitPublisher:
+
+    def __init__(self, names: List[str], host: Optional[str] = 'localhost', port: Optional[int] = 0):
+        """Start a server publishing orbit acquisitions to all connected subscribers.
+
+        Parameters:
+            names: BPM names, sent to every subscriber when it connects.
+            host: Address to listen on.
+            port: Port to listen on, 0 to pick a free one, see `self.port`.
+        """
+        self.names = [str(name) for name in names]
+        self.subscribers = []
+        self._lock = threading.Lock()
+
+        self.server = socket.create_server((host, port))
+        self.port = self.server.getsockname()[1]
+
+        # Check regularly if the publisher was closed while waiting for subscribers
+        self.server.settimeout(0.2)
+        self._closed = threading.Event()
+
+        self._thread = threading.Thread(target=self._accept, daemon=True)
+        self._thread.start()
+
+    def _accept(self) -> None:
+        while not self._closed.is_set():
+            try: connection, _ = self.server.accept()
+            except socket.timeout: continue
+            except OSError: return
+            connection.settimeout(None)
+            _send(connection, _NAMES, json.dumps(self.names).encode())
+            with self._lock: self.subscribers.append(connection)
+
+    def publish(self, t: float, x: np.ndarray, y: np.ndarray) -> None:
+        """Send one acquisition, positions in metres in the order of the names."""
+        payload = (
+            struct.pack('!d', t)
+            + np.ascontiguousarray(x, dtype='>f8').tobytes()
+            + np.ascontiguousarray(y, dtype='>f8').tobytes()
+            )
+        with self._lock:
+            for connection in list(self.subscribers):
+                try: _send(connection, _ORBIT, payload)
+                except OSError: self.subscribers.remove(connection)
+
+    def close(self) -> None:
+        self._closed.set()
+        self._thread.join()
+        self.server.close()
+        with self._lock:
+            for connection in self.subscribers: connection.close()
+            self.subscribers = []
+
+class OrbitSubscriber:
+
+    def __init__(self, host: str, port: int, buffer: OrbitRingBuffer, callback=None):
+        """Connect to an OrbitPublisher and store the received acquisitions in a buffer.
+
+        Parameters:
+            host, port: Address of the publisher.
+            buffer: The ring buffer to fill, publisher BPMs that it doesn't have are ignored.
+            callback: Called with the buffer after every acquisition, e.g. to update a plot.
+        """
+        self.buffer = buffer
+        self.callback = callback
+        self.connection = socket.create_connection((host, port))
+        self.columns = None
+        self._thread = None
+
+    def receive(self) -> bool:
+        """Receive one message, returns False once the publisher closed the connection."""
+        header = _receive_exactly(self.connection, _HEADER.size)
+        if header is None: return False
+        kind, size = _HEADER.unpack(header)
+        payload = _receive_exactly(self.connection, size)
+        if payload is None: return False
+
+        if kind == _NAMES:
+            # Map the order of the publisher onto the buffer columns
+            self.columns = self.buffer.column_indices(json.loads(payload))
+        elif kind == _ORBIT:
+            t, = struct.unpack_from('!d', payload)
+            positions = np.frombuffer(payload, dtype='>f8', offset=8)
+            x, y = np.split(positions, 2)
+            self.buffer.push(t, x, y, self.columns)
+            if self.callback is not None: self.callback(self.buffer)
+
+        return True
+
+    def run(self) -> None:
+        """Receive until the connection is closed."""
+        try:
+            while self.receive(): pass
+        except OSError: pass
+
+    def start(self) -> None:
+        """Receive in a background thread."""
+        self._thread = threading.Thread(target=self.run, daemon=True)
+        self._thread.start()
+
+    def close(self) -> None:
+        # Shutting down wakes up the thread waiting for data
+        try: self.connection.shutdown(socket.SHUT_RDWR)
+        except OSError: pass
+        self.connection.close()
+        if self._thread is not None: self._thread.join()
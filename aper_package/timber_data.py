@@ -1,15 +1,22 @@
 import pandas as pd
 import numpy as np
-import yaml
-import tfs
+import re
+import copy
 
 from typing import Any, Dict, Optional, Union, List, Tuple
 
-import pytimber
+from concurrent.futures import as_completed
 from datetime import datetime, timedelta
-from scipy.optimize import least_squares
+from itertools import compress
+from pathlib import Path
+from statistics import NormalDist
 
-from aper_package.utils import shift_by
+from aper_package.utils import shift_by, lazy_import
+from aper_package.logging_backend import get_backend, to_timestamp
+from aper_package.collimator_database import load_collimator_database
+
+# Loaded on first use
+optimize = lazy_import('scipy.optimize')
 
 class BPMData:
 
@@ -18,63 +25,328 @@ class BPMData:
         Initializes the BPMData class.
 
         Parameters:
-            spark: Spark session for accessing the LoggingDB.
+            spark: Spark session for accessing the LoggingDB, 
+                or a LoggingBackend, e.g. a ReplayBackend for offline use.
         """
 
         # initialise the logging
-        if isinstance(spark, str): self.ldb = pytimber.LoggingDB(source="nxcals")
-        else: self.ldb = pytimber.LoggingDB(spark_session=spark)
+        self.ldb = get_backend(spark)
         self.label = label
+
+        # Twiss the data was last processed with, see `is_processed`
+        self.processed_with = None
+
+        # Multiplicity of each BPM in a resampled fit, see `least_squares_fit`
+        self.resample_weights = None
     
     def print_to_label(self, string):
         if self.label is not None:
             self.label.value = string
         else: print(string)
 
-    def load_data(self, t: datetime) -> None:
+    def __getstate__(self):
+        # The logging backend and the label can't be sent to other processes,
+        # a copy in another process can only be used for fitting the loaded data
+        state = self.__dict__.copy()
+        state.pop('ldb', None)
+        state['label'] = None
+
+        # Nor is the ApertureData the data was processed with, it holds the lines
+        for key in ['b1', 'b2']: state.pop(key, None)
+        state['processed_with'] = None
+
+        # A fit only needs the averaged data, and its quality if it was assessed
+        state.pop('readings', None)
+        if state.get('_quality_data') is not state.get('data'):
+            for key in ['quality', '_quality_data']: state.pop(key, None)
+        return state
+
+    def assess_quality(
+            self, max_z: Optional[float] = 10, 
+            noise_floor: Optional[float] = 1e-6,
+            exclude: Optional[str] = 'bpmwf') -> pd.DataFrame:
+        """Flag dead and outlier BPMs and weight the others by their noise.
+
+        The result is stored in self.quality and used by all the fits,
+        the loaded data itself is not modified.
+
+        Parameters:
+            max_z: Robust z-score, using the median absolute deviation, 
+                above which the noise of a BPM is an outlier.
+            noise_floor: Resolution in metres added to the noise of each BPM, 
+                the weights are uniform if only one acquisition was loaded.
+            exclude: Regular expression of BPM names never used, by default the BPMs around IP1 and IP5.
+
+        Returns:
+            pd.DataFrame: One row per BPM with the columns name, excluded, dead, 
+                outlier, mask, weight_x and weight_y.
+        """
+        self.quality = bpm_quality(self.data, max_z, noise_floor, exclude)
+        # Keep track of the data the quality was assessed for
+        self._quality_data = self.data
+
+        return self.quality
+
+    def _fit_data(self) -> pd.DataFrame:
+        """The BPM data used in the fits, masked and with the weights."""
+        if getattr(self, '_quality_data', None) is not self.data: self.assess_quality()
+
+        mask = self.quality['mask'].to_numpy()
+        data = self.data[mask]
+
+        # BPMs drawn several times in a resample count as many times
+        weights = getattr(self, 'resample_weights', None)
+        count = 1 if weights is None else data['name'].map(weights).fillna(1).to_numpy()
+
+        return data.assign(
+            weight_x=self.quality['weight_x'].to_numpy()[mask] * count, 
+            weight_y=self.quality['weight_y'].to_numpy()[mask] * count)
+
+    def _get_bpm_names(self, t: datetime) -> Dict[str, Tuple[np.ndarray, np.ndarray]]:
+        """Fetch the BPM name mapping at the given time."""
+        # The mapping is only logged on change, use the last value before t if there is one
+        variable = 'BFC.LHC:Mappings:fBPMNames_h'
+        bpm_names_data = self.ldb.get(variable, t)
+        if len(bpm_names_data.get(variable, ((), ()))[1]) == 0:
+            bpm_names_data = self.ldb.get(variable, t, t + timedelta(weeks=1))
+
+        return bpm_names_data
+
+    def _get_positions(self, variable: str, t: datetime, acquisitions: int, latest: bool):
+        """Fetch the BPM positions following t, or preceding t if latest."""
+        window = timedelta(seconds=max(1, acquisitions))
+        if not latest: return self.ldb.get(variable, t, t + window)
+
+        positions = self.ldb.get(variable, t - window, t)
+        # Nothing logged in the window, use the last acquisition before t
+        if len(positions.get(variable, ((), ()))[1]) == 0: positions = self.ldb.get(variable, t)
+
+        return positions
+
+    def load_data(
+            self, t: datetime, acquisitions: Optional[int] = 1, 
+            latest: Optional[bool] = False) -> None:
         """
         Load BPM data from Timber.
 
+        Several acquisitions can be averaged, the spread of the readings is then
+        kept as the noise of each BPM in the columns x_rms and y_rms.
+        If the data can't be loaded, self.data is None.
+
         Parameters:
             t: A datetime object or a list containing a datetime object representing the time to fetch data.
+            acquisitions: Number of acquisitions to average, 
+                they are fetched from the following seconds assuming at least one per second.
+            latest: If True, the last acquisitions at or before t are used instead,
+                e.g. for live data that is not logged yet after t.
         """
         
         self.print_to_label("Loading BPM data...")
 
-        # Define the end time for data fetching
-        end_time = t + timedelta(seconds=1)
+        # New data has to be merged with twiss again
+        self.processed_with = None
         
         # Fetch BPM data
         try:
-            bpm_positions_h = self.ldb.get('BFC.LHC:OrbitAcq:positionsH', t, end_time)
-            bpm_positions_v = self.ldb.get('BFC.LHC:OrbitAcq:positionsV', t, end_time)
-            bpm_names_data = self.ldb.get('BFC.LHC:Mappings:fBPMNames_h', t, t + timedelta(weeks=1))
+            bpm_positions_h = self._get_positions('BFC.LHC:OrbitAcq:positionsH', t, acquisitions, latest)
+            bpm_positions_v = self._get_positions('BFC.LHC:OrbitAcq:positionsV', t, acquisitions, latest)
+            bpm_names_data = self._get_bpm_names(t)
         except Exception as e:
+            # Don't keep using the previous data as if it was loaded at t
+            self.data = None
             self.print_to_label(f"Error loading BPM data: {e}")
             return
 
+        # The acquisitions closest to t
+        selection = slice(-acquisitions, None) if latest else slice(None, acquisitions)
+
         try:
-            # Extract BPM readings
-            bpm_readings_h = bpm_positions_h['BFC.LHC:OrbitAcq:positionsH'][1][0]  
-            bpm_readings_v = bpm_positions_v['BFC.LHC:OrbitAcq:positionsV'][1][0] 
+            # Extract BPM readings, one row per acquisition
+            bpm_readings_h = np.asarray(bpm_positions_h['BFC.LHC:OrbitAcq:positionsH'][1][selection], dtype=float)
+            bpm_readings_v = np.asarray(bpm_positions_v['BFC.LHC:OrbitAcq:positionsV'][1][selection], dtype=float)
+            count = min(len(bpm_readings_h), len(bpm_readings_v))
+            if count == 0: raise IndexError
+            if latest: 
+                # Keep the same number of the last acquisitions in both planes
+                bpm_readings_h, bpm_readings_v = bpm_readings_h[-count:], bpm_readings_v[-count:]
 
-            # Ensure BPM names are in strings and in lowercase for merging with Twiss data later
-            bpm_names = bpm_names_data['BFC.LHC:Mappings:fBPMNames_h'][1][0]
-            if not np.issubdtype(bpm_names.dtype, np.str_):
-                bpm_names = bpm_names.astype(str)
-            bpm_names = np.char.lower(bpm_names)
+            bpm_names = bpm_names_lowercase(bpm_names_data['BFC.LHC:Mappings:fBPMNames_h'][1][0])
+
+            # Change units to metres to stay consistent
+            x, x_rms = average_acquisitions(bpm_readings_h[:count]/1e6)
+            y, y_rms = average_acquisitions(bpm_readings_v[:count]/1e6)
 
             # Create a DataFrame with the extracted data
             self.data = pd.DataFrame({
                 'name': bpm_names,
-                'x': bpm_readings_h/1e6, # Change units to metres to stay consistent
-                'y': bpm_readings_v/1e6
+                'x': x,
+                'y': y,
+                'x_rms': x_rms,
+                'y_rms': y_rms
             })
+            self.acquisitions = count
+            # The single readings are kept to resample the acquisitions
+            self.readings = (bpm_readings_h[:count]/1e6, bpm_readings_v[:count]/1e6)
+
+            # Flag the BPMs not to use in the fits
+            self.assess_quality()
 
-        except KeyError: self.data = None
+        except (KeyError, IndexError): self.data = None
 
         self.print_to_label("Done loading BPM data.")
 
+    def load_from_buffer(self, buffer: object) -> None:
+        """Use the last acquisition received in an OrbitRingBuffer as the BPM data.
+
+        Parameters:
+            buffer: An OrbitRingBuffer filled e.g. by an OrbitSubscriber.
+        """
+        self.data = buffer.latest()
+        self.readings = None
+
+        # New data has to be merged with twiss again
+        self.processed_with = None
+
+    def load_series(
+            self, times: List[datetime], 
+            chunk: Optional[float] = 600) -> Dict[float, pd.DataFrame]:
+        """Load BPM data for many timestamps with few requests to Timber.
+
+        Timestamps closer than chunk seconds to each other are fetched in one request,
+        and for each of them the first acquisition within a second is taken, as in `load_data`.
+
+        Parameters:
+            times: A list of datetime objects.
+            chunk: Longest interval in seconds fetched in one request.
+
+        Returns:
+            Dict[float, pd.DataFrame]: 
+                The BPM data for each timestamp with an acquisition, keyed by unix time.
+        """
+        times = sorted(times)
+        self.print_to_label(f"Loading BPM data for {len(times)} timestamps...")
+
+        bpm_names_data = self._get_bpm_names(times[0])
+        bpm_names = bpm_names_lowercase(bpm_names_data['BFC.LHC:Mappings:fBPMNames_h'][1][0])
+
+        series, start = {}, 0
+        while start < len(times):
+            # Group the following timestamps into one request
+            end = start + 1
+            while end < len(times) and to_timestamp(times[end]) - to_timestamp(times[start]) <= chunk: 
+                end += 1
+
+            t1, t2 = times[start], times[end-1] + timedelta(seconds=1)
+            positions = {
+                plane: self.ldb.get(f'BFC.LHC:OrbitAcq:positions{plane}', t1, t2).get(
+                    f'BFC.LHC:OrbitAcq:positions{plane}', (np.array([]), np.array([])))
+                for plane in ['H', 'V']
+                }
+
+            for t in times[start:end]:
+                t = to_timestamp(t)
+                # First acquisition within a second of the timestamp
+                indices = [np.searchsorted(positions[plane][0], t, side='left') for plane in ['H', 'V']]
+                if any(
+                    i == len(positions[plane][0]) or positions[plane][0][i] > t + 1 
+                    for i, plane in zip(indices, ['H', 'V'])): 
+                    continue
+
+                series[t] = pd.DataFrame({
+                    'name': bpm_names,
+                    'x': np.asarray(positions['H'][1][indices[0]])/1e6, # Change units to metres to stay consistent
+                    'y': np.asarray(positions['V'][1][indices[1]])/1e6
+                    })
+
+            start = end
+
+        self.print_to_label(f"Done loading BPM data for {len(series)} timestamps.")
+
+        return series
+
+    def batch_fit(
+            self, aper_data: object, times: List[datetime],
+            knob: str, plane: str, output: str,
+            angle_range: Optional[Tuple[float, float]] = (-500, 500), 
+            s_range: Optional[Tuple[float, float]] = None,
+            file_format: Optional[str] = 'parquet',
+            workers: Optional[int] = None) -> pd.DataFrame:
+        """Fit a knob to the BPM data of many timestamps, e.g. the crossing angle over a fill.
+
+        The data is loaded with `load_series` and the fits run on a pool of processes,
+        each with its own copy of the lines, starting from the current knob value.
+        Every result is saved as soon as it is available, as one file per timestamp
+        in the output directory, and timestamps already in the directory are skipped.
+        A failed fit is reported and not saved, so it is tried again in the next run.
+
+        Parameters:
+            aper_data: An ApertureData object.
+            times: A list of datetime objects, see `time_grid` for an interval with a stride.
+            knob: The knob to fit.
+            plane: The plane to fit in, 'horizontal' or 'vertical'.
+            output: Directory to save the results to.
+            angle_range: Bounds of the knob value.
+            s_range: If given, only the BPMs in this range are used.
+            file_format: 'parquet' or 'csv'.
+            workers: Number of processes, by default the number of cores.
+
+        Returns:
+            pd.DataFrame: The results of all timestamps in the output directory, 
+                with the columns time, knob, plane, value and uncertainty.
+        """
+        from aper_package.parallel import OrbitPool
+
+        if file_format not in ('parquet', 'csv'): raise ValueError(f"Unknown file format: {file_format}")
+
+        output = Path(output)
+        output.mkdir(parents=True, exist_ok=True)
+
+        def part(t):
+            return output / f'{knob}_{plane}_{int(round(t*1e3))}.{file_format}'
+
+        # Skip the timestamps already done in a previous run
+        times = [t for t in times if not part(to_timestamp(t)).exists()]
+
+        if times:
+            series = self.load_series(times)
+            self.print_to_label(f"Fitting {len(series)} timestamps...")
+
+            with OrbitPool(aper_data, workers) as pool:
+                futures = {}
+                for t, data in series.items():
+                    # Only the data of this timestamp is sent to the worker
+                    bpm_data = copy.copy(self)
+                    bpm_data.data = data
+                    futures[pool.submit_fit(bpm_data, knob, plane, s_range, angle_range)] = t
+
+                failed = []
+                for done, future in enumerate(as_completed(futures), start=1):
+                    t = futures[future]
+                    try: value, uncertainty = future.result()
+                    except Exception as e:
+                        # Keep the other results, the timestamp is fitted again in the next run
+                        failed.append(datetime.fromtimestamp(t))
+                        self.print_to_label(f"Fit at {failed[-1]} failed: {e}")
+                        continue
+                    result = pd.DataFrame({
+                        'time': [t], 'knob': [knob], 'plane': [plane], 
+                        'value': [value], 'uncertainty': [uncertainty]
+                        })
+                    if file_format == 'parquet': result.to_parquet(part(t), index=False)
+                    elif file_format == 'csv': result.to_csv(part(t), index=False)
+                    self.print_to_label(f"Fitted {done}/{len(futures)} timestamps...")
+
+            if failed: 
+                self.print_to_label(
+                    f"Done fitting, {len(failed)} timestamps failed: {', '.join(str(t) for t in sorted(failed))}")
+            else: self.print_to_label("Done fitting all timestamps.")
+
+        parts = sorted(output.glob(f'{knob}_{plane}_*.{file_format}'))
+        if not parts: return pd.DataFrame(columns=['time', 'knob', 'plane', 'value', 'uncertainty'])
+
+        read = pd.read_parquet if file_format == 'parquet' else pd.read_csv
+        return pd.concat([read(path) for path in parts], ignore_index=True).sort_values(by='time', ignore_index=True)
+
     def process(self, twiss: object) -> None:
         """Process the loaded BPM data by merging it 
         with the Twiss data to find BPM positions.
@@ -85,20 +357,25 @@ class BPMData:
         if self.data is None:
             self.print_to_label("No BPM data to process. Load data first.")
             return
+
+        # Nothing changed since the last time
+        if is_processed(self, twiss): return
         
         # Merge BPM data with Twiss data to find positions
         self.b1 = pd.merge(self.data, twiss.tw_b1[['name', 's']], on='name')
         self.b2 = pd.merge(self.data, twiss.tw_b2[['name', 's']], on='name')
 
+        self.processed_with = (twiss, getattr(twiss, 'twiss_version', None))
+
     def _simulate(self, angle, aper_data, knob, s_range):
         
-        # Vary the crossing angle
+        # Vary the crossing angle, only the orbit is needed to compare with the measurement
         aper_data.change_knob(knob, angle)
-        aper_data.twiss()
+        orbit_b1, orbit_b2 = aper_data.twiss_orbit()
         
         # Merge new simulated data with the measured data
-        merged_b1 = self._merge_twiss_and_bpm(aper_data.tw_b1, s_range)
-        merged_b2 = self._merge_twiss_and_bpm(aper_data.tw_b2, s_range)
+        merged_b1 = self._merge_twiss_and_bpm(orbit_b1, s_range)
+        merged_b2 = self._merge_twiss_and_bpm(orbit_b2, s_range)
         
         # Perform the fitting on both beams simultanously
         return pd.concat([merged_b1, merged_b2], ignore_index=True)
@@ -107,25 +384,16 @@ class BPMData:
         
         df = self._simulate(angle, aper_data, knob, s_range)
 
-        # Calculate the residuals for the plane of interest
-        if plane == 'horizontal': residuals = df['x'] - df['x_simulated']
-        elif plane == 'vertical': residuals =  df['y'] - df['y_simulated']
+        # Calculate the weighted residuals for the plane of interest
+        if plane == 'horizontal': residuals = (df['x'] - df['x_simulated']) * np.sqrt(df['weight_x'])
+        elif plane == 'vertical': residuals = (df['y'] - df['y_simulated']) * np.sqrt(df['weight_y'])
             
         return residuals
 
-    def least_squares_fit(
-            self, aper_data: object, init_angle: float,
-            knob: str, plane: str,
-            angle_range: Optional[Tuple[float, float]] = (-500, 500), 
-            s_range: Optional[Tuple[float, float]] = None):
-        """
-        Data needs to be loaded using self.load befor performing the fit.
-        """
-
-        # Remove the outliers aroundd ip1 and ip5
-        self.data = self.data[~self.data['name'].str.contains('bpmwf')]
+    def _knob_fit(self, aper_data, init_angle, knob, plane, angle_range, s_range):
+        """Fit one knob, returns the parameters, their uncertainties, the Jacobian and the residuals."""
 
-        result = least_squares(
+        result = optimize.least_squares(
             self._objective, x0=[init_angle], bounds=angle_range, 
             args=(aper_data, knob, s_range, plane))
 
@@ -133,6 +401,9 @@ class BPMData:
         params = result.x
         jacobian = result.jac
         residuals = self._objective(params, aper_data, knob, s_range, plane)
+
+        # The knob is left at the best fit, update the full twiss data once
+        aper_data.twiss()
         
         # Compute statistics
         n = len(residuals)
@@ -141,18 +412,281 @@ class BPMData:
         covariance = np.linalg.inv(jacobian.T @ jacobian) * sigma_squared
         param_uncertainty = np.sqrt(np.diag(covariance))
 
-        return round(params[0], 2), round(param_uncertainty[0], 2)
+        return params, param_uncertainty, jacobian, np.asarray(residuals)
+
+    def least_squares_fit(
+            self, aper_data: object, init_angle: float,
+            knob: str, plane: str,
+            angle_range: Optional[Tuple[float, float]] = (-500, 500), 
+            s_range: Optional[Tuple[float, float]] = None,
+            resampling: Optional[str] = None,
+            resample_over: Optional[str] = 'bpms',
+            n_resamples: Optional[int] = 200,
+            workers: Optional[int] = None,
+            seed: Optional[int] = None):
+        """
+        Data needs to be loaded using self.load befor performing the fit.
+
+        Parameters:
+            resampling: If given, 'bootstrap' or 'jackknife', the uncertainty is also 
+                estimated from fits to resampled data, see `resampling_summary`.
+            resample_over: Resample the 'bpms' or the 'acquisitions' averaged in `load_data`.
+            n_resamples: Number of bootstrap resamples, a jackknife leaves out each BPM or acquisition once.
+            workers: If given, every resample is fitted again on this many processes, 
+                otherwise with one step on the linearised response at the best fit.
+            seed: Seed of the bootstrap resampling.
+
+        Returns:
+            The best fit value and its uncertainty, 
+            and the summary of the resampled fits if resampling was given.
+        """
+        params, param_uncertainty, jacobian, residuals = self._knob_fit(
+            aper_data, init_angle, knob, plane, angle_range, s_range)
+
+        if resampling is None: return round(params[0], 2), round(param_uncertainty[0], 2)
+
+        rows = self._merge_orbits(*aper_data.twiss_orbit(), s_range)
+        resamples = self._resamples(rows['name'].unique(), resampling, resample_over, n_resamples, seed)
+
+        if workers is None:
+            planes = ['x'] if plane == 'horizontal' else ['y']
+            estimates = self._linearised_resamples(params, jacobian, residuals, rows, planes, resamples)
+        else:
+            from aper_package.parallel import OrbitPool
+
+            # The workers start from the best fit
+            with OrbitPool(aper_data, workers) as pool:
+                futures = [
+                    pool.submit_fit(self._resampled(weights, data), knob, plane, s_range, angle_range, rounded=False) 
+                    for weights, data in resamples
+                    ]
+                estimates = np.array([[future.result()[0]] for future in futures])
+
+        self.resampled_estimates = pd.DataFrame(estimates, columns=[knob])
+        summary = resampling_summary(estimates, params, resampling, [knob])
+
+        return round(params[0], 2), round(param_uncertainty[0], 2), summary
+
+    def _resamples(self, names, method, over, n_resamples, seed):
+        """Resampled BPM weights or BPM data, one (weights, data) per resample, the other is None."""
+        rng = np.random.default_rng(seed)
+        names = np.asarray(names)
+
+        if over == 'bpms':
+            # Each BPM is counted as many times as it was drawn
+            if method == 'bootstrap': 
+                counts = rng.multinomial(len(names), np.full(len(names), 1/len(names)), size=n_resamples)
+            elif method == 'jackknife': counts = 1 - np.eye(len(names), dtype=int)
+            else: raise ValueError(f"Unknown resampling method: {method}")
+
+            return [(pd.Series(count, index=names, dtype=float), None) for count in counts]
+
+        elif over == 'acquisitions':
+            readings = getattr(self, 'readings', None)
+            if readings is None or len(readings[0]) < 2:
+                raise ValueError("Resampling acquisitions needs several acquisitions, see load_data.")
+
+            count = len(readings[0])
+            if method == 'bootstrap': selections = rng.integers(0, count, size=(n_resamples, count))
+            elif method == 'jackknife': selections = [np.delete(np.arange(count), i) for i in range(count)]
+            else: raise ValueError(f"Unknown resampling method: {method}")
+
+            resamples = []
+            for selection in selections:
+                x, _ = average_acquisitions(readings[0][selection])
+                y, _ = average_acquisitions(readings[1][selection])
+                resamples.append((None, self.data.assign(x=x, y=y)))
+
+            return resamples
+
+        raise ValueError(f"Unknown resampling unit: {over}")
+
+    def _resampled(self, weights, data):
+        """A copy with the weights or the data of one resample, to send to a worker."""
+        resampled = copy.copy(self)
+        resampled.readings = None
+        if weights is not None: resampled.resample_weights = weights
+        if data is not None:
+            resampled.data = data
+            # Keep the BPMs flagged in the measured data
+            resampled._quality_data = data
+
+        return resampled
+
+    def _linearised_resamples(self, params, jacobian, residuals, rows, planes, resamples):
+        """Refit every resample with one Gauss-Newton step from the best fit.
+
+        Parameters:
+            params, jacobian, residuals: The best fit and the Jacobian of the residuals there.
+            rows: The merged BPM data of the residuals, as in `_merge_orbits`.
+            planes: The planes of the residuals in order, 'x' and/or 'y'.
+            resamples: As in `_resamples`.
+
+        Returns:
+            np.ndarray: A (resample x parameter) array of the fitted values.
+        """
+        names = np.tile(rows['name'].to_numpy(), len(planes))
+
+        estimates = []
+        for weights, data in resamples:
+            r = residuals
+            if data is not None:
+                # Residuals change by the difference of the resampled and measured positions
+                measured = data.set_index('name')
+                r = residuals + np.concatenate([
+                    (rows['name'].map(measured[plane]) - rows[plane]) * np.sqrt(rows[f'weight_{plane}'])
+                    for plane in planes])
+
+            scale = np.ones(len(r)) if weights is None else np.sqrt(pd.Series(names).map(weights).fillna(1).to_numpy())
+            delta = np.linalg.lstsq(jacobian * scale[:, None], -r * scale, rcond=None)[0]
+            estimates.append(params + delta)
+
+        return np.array(estimates)
+    
+    def _knob_orbits(self, aper_data, knobs, points, pool):
+
+        # Evaluate all points concurrently if a pool was given
+        if pool is not None:
+            settings = [[(knob, value, None) for knob, value in zip(knobs, point)] for point in points]
+            return pool.orbits(settings, names=self.data['name'])
+
+        orbits = []
+        for point in points:
+            for knob, value in zip(knobs, point): aper_data.change_knob(knob, value)
+            orbits.append(aper_data.twiss_orbit())
+
+        return orbits
+
+    def joint_least_squares_fit(
+            self, aper_data: object, knobs: List[str],
+            init_values: Optional[List[float]] = None,
+            s_range: Optional[Tuple[float, float]] = None,
+            step: Optional[float] = 1.0,
+            max_iterations: Optional[int] = 10,
+            tolerance: Optional[float] = 1e-3,
+            workers: Optional[int] = None) -> Tuple[pd.Series, pd.Series, pd.DataFrame]:
+        """Fit several knobs at once to the measured orbit in both planes.
+
+        The orbit is assumed to respond linearly to the knobs: the response matrix
+        is computed once, in one batch, and every Gauss-Newton iteration then only
+        needs one twiss to evaluate the residuals.
+
+        Parameters:
+            aper_data: An ApertureData object.
+            knobs: Names of the knobs to fit, e.g. ['on_x1', 'on_sep1', 'on_o1', 'on_a1'].
+            init_values: Initial knob values, by default the current values.
+            s_range: If given, only the BPMs in this range are used.
+            step: Knob change used to compute the response matrix.
+            max_iterations: Maximum number of Gauss-Newton iterations.
+            tolerance: The fit stops once no knob changes by more than this.
+            workers: If given, the response matrix is computed on this many processes.
+
+        Returns:
+            Tuple[pd.Series, pd.Series, pd.DataFrame]: 
+                The best fit knob values, their uncertainties and the covariance matrix, indexed by knob.
+        """
+        if init_values is None:
+            current = aper_data.knobs.set_index('knob')['current value']
+            init_values = [current[knob] for knob in knobs]
+        x = np.asarray(init_values, dtype=float)
+
+        # Orbit at the initial values and with each knob changed by one step
+        points = [x] + [x + step * unit for unit in np.eye(len(x))]
+
+        if workers is None: 
+            orbits = self._knob_orbits(aper_data, knobs, points, None)
+        else:
+            from aper_package.parallel import OrbitPool
+
+            with OrbitPool(aper_data, workers) as pool:
+                orbits = self._knob_orbits(aper_data, knobs, points, pool)
+
+        residuals = [
+            self._orbit_residuals(self._merge_orbits(orbit_b1, orbit_b2, s_range)) 
+            for orbit_b1, orbit_b2 in orbits
+            ]
+        # Response of the simulated orbit, the residuals are measured minus simulated
+        response = np.column_stack([(residuals[0] - r) / step for r in residuals[1:]])
+
+        residuals = residuals[0]
+        for _ in range(max_iterations):
+            delta = np.linalg.lstsq(response, residuals, rcond=None)[0]
+            x = x + delta
+
+            for knob, value in zip(knobs, x): aper_data.change_knob(knob, value)
+            orbit_b1, orbit_b2 = aper_data.twiss_orbit()
+            residuals = self._orbit_residuals(self._merge_orbits(orbit_b1, orbit_b2, s_range))
+
+            if np.all(np.abs(delta) < tolerance): break
+
+        # The knobs are left at the best fit, update the full twiss data once
+        aper_data.twiss()
+
+        # Compute statistics
+        n = len(residuals)
+        p = len(x)
+        sigma_squared = np.sum(residuals**2) / (n - p)
+        covariance = np.linalg.inv(response.T @ response) * sigma_squared
+        param_uncertainty = np.sqrt(np.diag(covariance))
+
+        return (
+            pd.Series(x, index=knobs), 
+            pd.Series(param_uncertainty, index=knobs), 
+            pd.DataFrame(covariance, index=knobs, columns=knobs)
+            )
+    
+    def fit_all_irs(
+            self, aper_data: object,
+            planes: Optional[Tuple[str, ...]] = ('horizontal', 'vertical'),
+            angle_range: Optional[Tuple[float, float]] = (-500, 500),
+            workers: Optional[int] = None) -> pd.DataFrame:
+        """Fit the crossing and separation knobs of all eight IRs concurrently.
+
+        For every IR, the knobs named like on_x1, on_sep1, on_x2h or on_sep8v are
+        fitted one at a time in each plane, using only the BPMs of that IR, 
+        as with least_squares_fit. Knobs ending in h or v are only fitted in 
+        their own plane, see `ir_knob_planes`. The fits run on a pool of processes.
+
+        Parameters:
+            aper_data: An ApertureData object.
+            planes: Planes to fit in.
+            angle_range: Bounds of the knob values.
+            workers: Number of processes, by default the number of cores.
+
+        Returns:
+            pd.DataFrame: One row per IR, knob and plane with the best fit value and its uncertainty.
+        """
+        from aper_package.parallel import OrbitPool
+
+        fits, rows = [], []
+        for ir, knob, plane in ir_knob_planes(aper_data.knobs['knob'], planes):
+            fits.append((knob, plane, aper_data.get_ir_boundries(ir), angle_range))
+            rows.append({'ir': ir, 'knob': knob, 'plane': plane})
+
+        self.print_to_label(f"Fitting {len(fits)} knobs...")
+
+        with OrbitPool(aper_data, workers) as pool:
+            results = pool.fit_knobs(self, fits)
+
+        self.print_to_label("Done fitting all IRs.")
+
+        df = pd.DataFrame(rows)
+        df['value'] = [value for value, _ in results]
+        df['uncertainty'] = [uncertainty for _, uncertainty in results]
+
+        return df
     
     def _local_bump_simulate(
             self, size, element, aper_data, 
             relevant_mcbs, s_range, beam, plane, tw0):
         
-        # Vary the crossing angle
-        aper_data.match_local_bump(element, relevant_mcbs, size, beam, plane, tw0)
+        # Vary the bump size, only the orbit is needed to compare with the measurement
+        aper_data.match_local_bump(element, relevant_mcbs, size, beam, plane, tw0, orbit_only=True)
+        orbit_b1, orbit_b2 = aper_data.twiss_orbit()
         
         # Merge new simulated data with the measured data
-        merged_b1 = self._merge_twiss_and_bpm(aper_data.tw_b1, s_range)
-        merged_b2 = self._merge_twiss_and_bpm(aper_data.tw_b2, s_range)
+        merged_b1 = self._merge_twiss_and_bpm(orbit_b1, s_range)
+        merged_b2 = self._merge_twiss_and_bpm(orbit_b2, s_range)
         
         # Perform the fitting on both beams simultanously
         return pd.concat([merged_b1, merged_b2], ignore_index=True)
@@ -165,9 +699,9 @@ class BPMData:
             size, element, aper_data, relevant_mcbs, 
             s_range, beam, plane, tw0)
 
-        # Calculate the residuals for the plane of interest
-        if plane == 'horizontal': residuals = df['x'] - df['x_simulated']
-        elif plane == 'vertical': residuals =  df['y'] - df['y_simulated']
+        # Calculate the weighted residuals for the plane of interest
+        if plane == 'horizontal': residuals = (df['x'] - df['x_simulated']) * np.sqrt(df['weight_x'])
+        elif plane == 'vertical': residuals = (df['y'] - df['y_simulated']) * np.sqrt(df['weight_y'])
 
         return residuals
     
@@ -176,13 +710,23 @@ class BPMData:
             init_size: float, relevant_mcbs: list,
             beam: str, plane: str,
             size_range: Optional[Tuple[float, float]] = (-15, 15), 
-            s_range: Optional[Tuple[float, float]] = None):
+            s_range: Optional[Tuple[float, float]] = None,
+            resampling: Optional[str] = None,
+            resample_over: Optional[str] = 'bpms',
+            n_resamples: Optional[int] = 200,
+            seed: Optional[int] = None):
+        """Fit the size of a local bump at element to the BPM data.
+
+        Parameters:
+            resampling, resample_over, n_resamples, seed: As in `least_squares_fit`,
+                the resamples are fitted on the linearised response at the best fit.
+        """
 
         if beam == 'beam 1': line = aper_data.line_b1
         elif beam == 'beam 2': line = aper_data.line_b2
 
         tw0 = line.twiss()
-        result = least_squares(
+        result = optimize.least_squares(
             self._local_bump_objective, x0=[init_size], bounds=size_range, 
             args=(element, aper_data, relevant_mcbs, s_range, beam, plane, tw0), diff_step=1e-3)
 
@@ -192,6 +736,9 @@ class BPMData:
         residuals = self._local_bump_objective(
             params, element, aper_data, relevant_mcbs, 
             s_range, beam, plane, tw0)
+
+        # The bump is left at the best fit, update the full twiss data once
+        aper_data.twiss()
         
         # Compute statistics
         n = len(residuals)
@@ -200,33 +747,63 @@ class BPMData:
         covariance = np.linalg.inv(jacobian.T @ jacobian) * sigma_squared
         param_uncertainty = np.sqrt(np.diag(covariance))
 
-        return round(params[0], 2), round(param_uncertainty[0], 2)
+        if resampling is None: return round(params[0], 2), round(param_uncertainty[0], 2)
+
+        # Matching the bump again for every resample is too slow, use the linearised response
+        rows = self._merge_orbits(*aper_data.twiss_orbit(), s_range)
+        resamples = self._resamples(rows['name'].unique(), resampling, resample_over, n_resamples, seed)
+        planes = ['x'] if plane == 'horizontal' else ['y']
+        estimates = self._linearised_resamples(params, jacobian, np.asarray(residuals), rows, planes, resamples)
+
+        self.resampled_estimates = pd.DataFrame(estimates, columns=[element])
+        summary = resampling_summary(estimates, params, resampling, [element])
+
+        return round(params[0], 2), round(param_uncertainty[0], 2), summary
     
-    def _yasp_bump_simulate(
-            self, scale_factors, aper_data, s_range, 
-            final_bump_container, bump_dict):
+    def _yasp_bump_settings(self, scale_factors, final_bump_container, bump_dict):
         
-        # Vary the scaling
+        # Iterate over all knobs in the bump definitions and scale them accordingly
+        settings = []
         for n,bump_hbox in enumerate(final_bump_container.children):
             bump_name = bump_hbox.children[0].value
 
             float_inputs = bump_dict[bump_name]['float_inputs']
             selected_beam = bump_dict[bump_name]['vbox'].children[1].children[1].value
 
-            # Iterate over all knobs in the bump definition and scale them accordingly    
-            for i in float_inputs:
-                aper_data.change_acb_knob(i.description, i.value*scale_factors[n]*1e-6, selected_beam)
+            settings += [(i.description, i.value*scale_factors[n]*1e-6, selected_beam) for i in float_inputs]
+
+        return settings
+
+    def _yasp_bump_simulate(
+            self, scale_factors, aper_data, s_range, 
+            final_bump_container, bump_dict):
         
-        # Twiss and update the graph
-        aper_data.twiss()
+        # Vary the scaling
+        for knob, value, beam in self._yasp_bump_settings(scale_factors, final_bump_container, bump_dict):
+            aper_data.change_acb_knob(knob, value, beam)
+        
+        # Only the orbit is needed to compare with the measurement
+        orbit_b1, orbit_b2 = aper_data.twiss_orbit()
         
+        return self._merge_orbits(orbit_b1, orbit_b2, s_range)
+
+    def _merge_orbits(self, orbit_b1, orbit_b2, s_range):
+
         # Merge new simulated data with the measured data
-        merged_b1 = self._merge_twiss_and_bpm(aper_data.tw_b1, s_range)
-        merged_b2 = self._merge_twiss_and_bpm(aper_data.tw_b2, s_range)
+        merged_b1 = self._merge_twiss_and_bpm(orbit_b1, s_range)
+        merged_b2 = self._merge_twiss_and_bpm(orbit_b2, s_range)
         
         # Perform the fitting on both beams simultanously
         return pd.concat([merged_b1, merged_b2], ignore_index=True)
 
+    def _orbit_residuals(self, df):
+
+        # Calculate the weighted residuals in both planes
+        residuals_x = (df['x'] - df['x_simulated']) * np.sqrt(df['weight_x'])
+        residuals_y = (df['y'] - df['y_simulated']) * np.sqrt(df['weight_y'])
+
+        return np.concatenate((residuals_x, residuals_y))
+
     def _yasp_bump_objective(
             self, scale_factors, aper_data, s_range, 
             final_bump_container, bump_dict):
@@ -235,17 +812,44 @@ class BPMData:
             scale_factors, aper_data, s_range, 
             final_bump_container, bump_dict)
 
-        # Calculate the residuals for the plane of interest
-        residuals_x = df['x'] - df['x_simulated']
-        residuals_y =  df['y'] - df['y_simulated']
+        return self._orbit_residuals(df)
 
-        residuals = np.concatenate((residuals_x, residuals_y))
-        
-        return residuals
+    def _yasp_bump_jacobian(
+            self, scale_factors, pool, s_range, 
+            final_bump_container, bump_dict):
+
+        # Forward differences with the same relative step as the serial fit
+        x = np.asarray(scale_factors, dtype=float)
+        steps = 1e-3 * np.maximum(1, np.abs(x))
+        points = [x] + [x + step * unit for step, unit in zip(steps, np.eye(len(x)))]
+
+        # The unperturbed point and all the columns are evaluated concurrently
+        orbits = pool.orbits(
+            [self._yasp_bump_settings(point, final_bump_container, bump_dict) for point in points], 
+            names=self.data['name'])
+        residuals = [
+            self._orbit_residuals(self._merge_orbits(orbit_b1, orbit_b2, s_range)) 
+            for orbit_b1, orbit_b2 in orbits
+            ]
+
+        return np.column_stack([(r - residuals[0]) / step for r, step in zip(residuals[1:], steps)])
     
     def yasp_bump_least_squares_fit(
             self, aper_data, s_range, 
-            final_bump_container, bump_dict):
+            final_bump_container, bump_dict, 
+            workers: Optional[int] = None,
+            resampling: Optional[str] = None,
+            resample_over: Optional[str] = 'bpms',
+            n_resamples: Optional[int] = 200,
+            seed: Optional[int] = None):
+        """Fit the scale factor of each bump in final_bump_container to the BPM data.
+
+        Parameters:
+            workers: If given, the Jacobian columns are evaluated concurrently
+                on this many processes, each with its own copy of the lines.
+            resampling, resample_over, n_resamples, seed: As in `least_squares_fit`,
+                the resamples are fitted on the linearised response at the best fit.
+        """
 
         initial_guess = []
         for bump_hbox in final_bump_container.children:
@@ -254,15 +858,27 @@ class BPMData:
 
             initial_guess.append(bump_float_value)
 
-        result = least_squares(
-            self._yasp_bump_objective, x0=initial_guess, 
-            args=(aper_data, s_range, final_bump_container, bump_dict), diff_step=1e-3)
+        args = (aper_data, s_range, final_bump_container, bump_dict)
+
+        if workers is None:
+            result = optimize.least_squares(
+                self._yasp_bump_objective, x0=initial_guess, args=args, diff_step=1e-3)
+        else:
+            from aper_package.parallel import OrbitPool
+
+            with OrbitPool(aper_data, workers) as pool:
+                jacobian = lambda x, *args: self._yasp_bump_jacobian(
+                    x, pool, s_range, final_bump_container, bump_dict)
+                result = optimize.least_squares(
+                    self._yasp_bump_objective, x0=initial_guess, args=args, jac=jacobian)
 
         # Extract the optimized parameter, Jacobian, and residuals
         params = result.x
         jacobian = result.jac
-        residuals = self._yasp_bump_objective(
-            params, aper_data, s_range, final_bump_container, bump_dict)
+        residuals = self._yasp_bump_objective(params, *args)
+
+        # The knobs are left at the best fit, update the full twiss data once
+        aper_data.twiss()
 
         # Compute statistics
         n = len(residuals)
@@ -272,18 +888,31 @@ class BPMData:
         param_uncertainty = np.sqrt(np.diag(covariance))
 
         # Return all parameters and uncertainties
-        return params, param_uncertainty
+        if resampling is None: return params, param_uncertainty
+
+        rows = self._merge_orbits(*aper_data.twiss_orbit(), s_range)
+        resamples = self._resamples(rows['name'].unique(), resampling, resample_over, n_resamples, seed)
+        estimates = self._linearised_resamples(params, jacobian, residuals, rows, ['x', 'y'], resamples)
+
+        bump_names = [bump_hbox.children[0].value for bump_hbox in final_bump_container.children]
+        self.resampled_estimates = pd.DataFrame(estimates, columns=bump_names)
+        summary = resampling_summary(estimates, params, resampling, bump_names)
+
+        return params, param_uncertainty, summary
     
     def _merge_twiss_and_bpm(self, twiss_data, s_range):
     
         # Rename the columns to differentiate between simulated and measured data
         simulated_data = twiss_data[['name', 's', 'x', 'y']].rename(columns={'x': 'x_simulated', 'y': 'y_simulated'})
         
-        # Merge the measured and simulated data into one dataframe
-        merged = pd.merge(self.data, simulated_data, on='name').sort_values(by='s').reset_index(drop=True)
+        # Merge the measured and simulated data into one dataframe, without the flagged BPMs
+        merged = pd.merge(self._fit_data(), simulated_data, on='name').sort_values(by='s').reset_index(drop=True)
         
         # If range was specified, use it
-        if s_range: 
+        if s_range and s_range[0] > s_range[1]:
+            # The range wraps around the start of the ring
+            merged = merged[(merged['s'] >= s_range[0]) | (merged['s'] <= s_range[1])]
+        elif s_range: 
             merged = merged[(merged['s'] >= s_range[0]) & (merged['s'] <= s_range[1])]
         
         return merged
@@ -297,79 +926,195 @@ class CollimatorsData:
         """Initialize the CollimatorsData class.
 
         Parameters:
-            spark: Spark session for accessing the LoggingDB.
+            spark: Spark session for accessing the LoggingDB, 
+                or a LoggingBackend, e.g. a ReplayBackend for offline use.
             yaml_path: Path to the YAML file containing collimator configurations.
         """
         # initialise the logging
-        if isinstance(spark, str): self.ldb = pytimber.LoggingDB(source="nxcals")
-        else: self.ldb = pytimber.LoggingDB(spark_session=spark)
+        self.ldb = get_backend(spark)
         self.yaml_path = yaml_path
         self.label = label
 
-    def load_data(self, t: datetime) -> None:
+        # Gaps for an interval of time, only defined in the time-series mode
+        self.times, self.gaps = None, None
+
+        # Twiss the data was last processed with, see `is_processed`
+        self.processed_with = None
+
+    def _load_collimator_angles(self) -> Tuple[pd.DataFrame, pd.DataFrame]:
+        """Read collimator names and angles for both beams from the YAML file."""
+        # Load the file, it is only parsed again if it changed
+        db = load_collimator_database(self.yaml_path)
+
+        return db.get('b1')[['name', 'angle']], db.get('b2')[['name', 'angle']]
+
+    def load_data(self, t: datetime, combined: Optional[bool] = True) -> None:
         """Load collimator data from the specified YAML file and Timber.
 
         Parameters:
             t: Datetime object representing the time to fetch data.
+            combined: If True, fetch the gaps of both beams in a single request.
         """
-        # Load the file  
-        with open(self.yaml_path, 'r') as file:
-            f = yaml.safe_load(file)
-
-        # Create a data frame for beam 1
-        col_b1 = pd.DataFrame(f['collimators']['b1']).loc[['angle']].T
-        col_b1 = col_b1.reset_index().rename(columns={'index': 'name'})
-
-        # Create a data frame for beam 2
-        col_b2 = pd.DataFrame(f['collimators']['b2']).loc[['angle']].T
-        col_b2 = col_b2.reset_index().rename(columns={'index': 'name'})
+        col_b1, col_b2 = self._load_collimator_angles()
 
-        # Get a list of collimator names to load from timber
-        names_b1 = col_b1['name'].str.upper().to_list()
-        names_b2 = col_b2['name'].str.upper().to_list()
+        # A single timestamp replaces any previously loaded time series
+        self.times, self.gaps = None, None
+        self.processed_with = None
 
-        for i, name in enumerate(names_b1): names_b1[i]=name+':MEAS_LVDT_GD'
-        for i, name in enumerate(names_b2): names_b2[i]=name+':MEAS_LVDT_GD'
+        # Get a list of collimator variables to load from timber
+        variables_b1 = (col_b1['name'].str.upper() + ':MEAS_LVDT_GD').to_list()
+        variables_b2 = (col_b2['name'].str.upper() + ':MEAS_LVDT_GD').to_list()
 
         self.print_to_label("Loading collimators data...")
 
-        col_b1_from_timber = self.ldb.get(names_b1, t, t+timedelta(seconds=1)) 
-        col_b2_from_timber = self.ldb.get(names_b2, t, t+timedelta(seconds=1))
-
-        # Iterate over all rows and add the gap column's values
-        for index, row in col_b1.iterrows():
-            try:
-                name_to_search = row['name'].upper()+':MEAS_LVDT_GD'
-                # Make sure the gaps are in units of metres to match everythong else
-                col_b1.at[index, 'gap'] = col_b1_from_timber[name_to_search][1][0]/1e3
-            except: col_b1.at[index, 'gap'] = np.nan
-
-        # Iterate over all rows and add the gap column's values
-        for index, row in col_b2.iterrows():
-            try:
-                name_to_search = row['name'].upper()+':MEAS_LVDT_GD'
-                # Make sure the gaps are in units of metres to match everythong else
-                col_b2.at[index, 'gap'] = col_b2_from_timber[name_to_search][1][0]/1e3
-            except: col_b2.at[index, 'gap'] = np.nan
+        end_time = t + timedelta(seconds=1)
+        if combined:
+            col_b1_from_timber = self.ldb.get(variables_b1 + variables_b2, t, end_time)
+            col_b2_from_timber = col_b1_from_timber
+        else:
+            col_b1_from_timber = self.ldb.get(variables_b1, t, end_time) 
+            col_b2_from_timber = self.ldb.get(variables_b2, t, end_time)
+
+        # Make sure the gaps are in units of metres to match everything else
+        gaps_b1, missing_b1 = first_values(col_b1_from_timber, variables_b1)
+        gaps_b2, missing_b2 = first_values(col_b2_from_timber, variables_b2)
+        col_b1['gap'] = gaps_b1 / 1e3
+        col_b2['gap'] = gaps_b2 / 1e3
+
+        # Keep track of the collimators without data
+        self.missing_variables = (
+            [('b1', variable) for variable in missing_b1] + 
+            [('b2', variable) for variable in missing_b2]
+            )
 
         self.colx_b1 = col_b1[col_b1['angle']==0].dropna()
         self.colx_b2 = col_b2[col_b2['angle']==0].dropna()
         self.coly_b1 = col_b1[col_b1['angle']==90].dropna()
         self.coly_b2 = col_b2[col_b2['angle']==90].dropna()
 
-        self.print_to_label("Done loading collimators data.")
+        if self.missing_variables:
+            self.print_to_label(
+                f"Done loading collimators data, {len(self.missing_variables)} variables not found.")
+        else: self.print_to_label("Done loading collimators data.")
         
+    def load_time_series(
+            self, t1: datetime, t2: datetime, 
+            step: Optional[float] = 1.0) -> None:
+        """Load collimator gaps for an interval of time in bulk.
+
+        The gaps are sampled on a regular time grid, holding the last logged
+        value of each collimator, and stored as a (time x collimator) array.
+        The gaps at any time can then be selected with `select_time`
+        without fetching the data again.
+
+        Parameters:
+            t1: Datetime object representing the start of the interval.
+            t2: Datetime object representing the end of the interval.
+            step: Spacing of the time grid in seconds.
+        """
+        col_b1, col_b2 = self._load_collimator_angles()
+        col_b1['beam'], col_b2['beam'] = 'b1', 'b2'
+        collimators = pd.concat([col_b1, col_b2], ignore_index=True)
+
+        variables = (collimators['name'].str.upper() + ':MEAS_LVDT_GD').to_list()
+
+        self.print_to_label("Loading collimators data...")
+
+        # The gaps are only logged on change so also fetch the last value before the interval
+        initial = self.ldb.get(variables, t1)
+        data = self.ldb.get(variables, t1, t2)
+
+        t1, t2 = to_timestamp(t1), to_timestamp(t2)
+        self.times = np.arange(t1, t2 + step/2, step)
+        self.gaps = np.full((len(self.times), len(variables)), np.nan)
+
+        self.missing_variables = []
+        for j, variable in enumerate(variables):
+            samples = [source[variable] for source in (initial, data) if variable in source]
+            timestamps = np.concatenate([np.asarray(i[0], dtype=float) for i in samples] + [[]])
+
+            if len(timestamps) == 0:
+                self.missing_variables.append((collimators.at[j, 'beam'], variable))
+                continue
+
+            values = np.concatenate([np.asarray(i[1], dtype=float) for i in samples])
+
+            # Index of the last sample before each time on the grid
+            index = np.searchsorted(timestamps, self.times, side='right') - 1
+            valid = index >= 0
+            # Make sure the gaps are in units of metres to match everything else
+            self.gaps[valid, j] = values[index[valid]] / 1e3
+
+        # Collimator properties, positions are added when processing with twiss
+        collimators['name'] = collimators['name'].str.lower()
+        self.collimators = collimators[['name', 'beam', 'angle']]
+        self.processed_with = None
+
+        self.select_time(0)
+
+        self.print_to_label("Done loading collimators data.")
+
+    def select_time(self, index: int) -> None:
+        """Select the collimator gaps at the given index of the loaded time series.
+
+        If the data was already processed with twiss, the gaps
+        relative to the orbit are recomputed without merging again.
+
+        Parameters:
+            index: Index on the time grid created by `load_time_series`.
+        """
+        self.time_index = index
+        gap = self.gaps[index]
+
+        collimators = self.collimators.assign(gap=gap)
+
+        if {'s', 'x', 'y'}.issubset(collimators.columns):
+            # Position of the orbit in the plane of each collimator
+            position = np.where(
+                collimators['angle'].to_numpy() == 90, 
+                collimators['y'].to_numpy(), collimators['x'].to_numpy()
+                )
+            collimators['top_gap_col'] = gap + position
+            collimators['bottom_gap_col'] = -gap + position
+
+        columns = [
+            column 
+            for column in ['name', 'gap', 'angle', 's', 'x', 'y', 'top_gap_col', 'bottom_gap_col'] 
+            if column in collimators.columns
+            ]
+        valid = ~np.isnan(gap)
+
+        for attr, beam, angle in [
+            ('colx_b1', 'b1', 0), ('colx_b2', 'b2', 0), 
+            ('coly_b1', 'b1', 90), ('coly_b2', 'b2', 90)]:
+            selection = valid & (collimators['beam'] == beam) & (collimators['angle'] == angle)
+            setattr(self, attr, collimators.loc[selection, columns].reset_index(drop=True))
+
     def process(self, twiss: object) -> None:
         """Process the loaded collimator data with the provided Twiss data.
 
         Parameters:
             twiss: An ApertureData object containing Twiss data for beam 1 and beam 2.
         """
-        
-        self.colx_b1 = self._add_collimator_positions(twiss.tw_b1, self.colx_b1, 'x')
-        self.colx_b2 = self._add_collimator_positions(twiss.tw_b2, self.colx_b2, 'x')
-        self.coly_b1 = self._add_collimator_positions(twiss.tw_b1, self.coly_b1, 'y')
-        self.coly_b2 = self._add_collimator_positions(twiss.tw_b2, self.coly_b2, 'y')
+        # Nothing changed since the last time
+        if is_processed(self, twiss): return
+
+        # In the time-series mode, find the positions once for all collimators
+        if self.gaps is not None:
+            positions = []
+            for beam, tw in [('b1', twiss.tw_b1), ('b2', twiss.tw_b2)]:
+                col = self.collimators[self.collimators['beam'] == beam][['name', 'beam', 'angle']]
+                tw = tw[['name', 's', 'x', 'y']].drop_duplicates(subset='name')
+                positions.append(pd.merge(col, tw, on='name', how='left'))
+            self.collimators = pd.concat(positions, ignore_index=True)
+            self.select_time(self.time_index)
+        else:
+            self.colx_b1 = self._add_collimator_positions(twiss.tw_b1, self.colx_b1, 'x')
+            self.colx_b2 = self._add_collimator_positions(twiss.tw_b2, self.colx_b2, 'x')
+            self.coly_b1 = self._add_collimator_positions(twiss.tw_b1, self.coly_b1, 'y')
+            self.coly_b2 = self._add_collimator_positions(twiss.tw_b2, self.coly_b2, 'y')
+
+        self.processed_with = (twiss, getattr(twiss, 'twiss_version', None))
                
     def _add_collimator_positions(
             self, twiss: pd.DataFrame, 
@@ -403,4 +1148,216 @@ class CollimatorsData:
     def print_to_label(self, string):
         if self.label is not None:
             self.label.value = string
-        else: print(string)
\ No newline at end of file
+        else: print(string)
+
+def average_acquisitions(readings: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+    """Average BPM readings over acquisitions, ignoring missing values.
+
+    Parameters:
+        readings: A (acquisition x BPM) array.
+
+    Returns:
+        Tuple[np.ndarray, np.ndarray]: 
+            The mean and the standard deviation of each BPM, the deviation is NaN
+            for BPMs with fewer than two readings.
+    """
+    valid = np.isfinite(readings)
+    count = valid.sum(axis=0)
+    filled = np.where(valid, readings, 0)
+
+    with np.errstate(invalid='ignore', divide='ignore'):
+        mean = np.where(count > 0, filled.sum(axis=0) / count, np.nan)
+        squares = np.where(valid, (readings - mean)**2, 0).sum(axis=0)
+        rms = np.where(count > 1, np.sqrt(squares / (count - 1)), np.nan)
+
+    return mean, rms
+
+def resampling_summary(
+        estimates: np.ndarray, point: np.ndarray, 
+        method: str, names: List[str], level: Optional[float] = 0.95) -> pd.DataFrame:
+    """Summarise the distribution of parameters fitted to resampled data.
+
+    Parameters:
+        estimates: A (resample x parameter) array of the fitted values.
+        point: The best fit to all the data.
+        method: 'bootstrap' or 'jackknife'.
+        names: Names of the parameters.
+        level: Confidence level of the interval, from the percentiles of a bootstrap,
+            and from the normal distribution around the best fit for a jackknife.
+
+    Returns:
+        pd.DataFrame: One row per parameter with the columns estimate, mean, std, 
+            ci_low, ci_high and samples.
+    """
+    estimates = np.asarray(estimates, dtype=float)
+    point = np.asarray(point, dtype=float)
+    n = len(estimates)
+    mean = estimates.mean(axis=0)
+
+    if method == 'bootstrap':
+        std = estimates.std(axis=0, ddof=1)
+        ci_low, ci_high = np.percentile(estimates, [50*(1-level), 50*(1+level)], axis=0)
+    elif method == 'jackknife':
+        # The leave-one-out fits are close to each other, scale their spread up
+        std = np.sqrt((n-1) / n * np.sum((estimates - mean)**2, axis=0))
+        z = NormalDist().inv_cdf(0.5 + level/2)
+        ci_low, ci_high = point - z*std, point + z*std
+    else: raise ValueError(f"Unknown resampling method: {method}")
+
+    return pd.DataFrame({
+        'estimate': point, 'mean': mean, 'std': std, 
+        'ci_low': ci_low, 'ci_high': ci_high, 'samples': n
+        }, index=pd.Index(names, name='parameter'))
+
+def robust_z_score(values: np.ndarray) -> np.ndarray:
+    """Distance to the median in units of the scaled median absolute deviation, NaN stays NaN."""
+    if not np.isfinite(values).any(): return np.full(len(values), np.nan)
+
+    median = np.nanmedian(values)
+    mad = 1.4826 * np.nanmedian(np.abs(values - median))
+
+    # Without a spread nothing stands out
+    if not mad > 0: return np.where(np.isnan(values), np.nan, 0.)
+    return np.abs(values - median) / mad
+
+def bpm_quality(
+        data: pd.DataFrame, max_z: Optional[float] = 10, 
+        noise_floor: Optional[float] = 1e-6,
+        exclude: Optional[str] = 'bpmwf') -> pd.DataFrame:
+    """Flag dead and outlier BPMs and weight the others by their noise.
+
+    A BPM is dead if it has no reading, reads exactly zero in both planes, or
+    has no noise at all in both planes over several acquisitions. It is an outlier
+    if its noise is far from the other BPMs, see `BPMData.assess_quality`.
+    The positions are not compared, the bumps around the IPs are what the fits measure.
+
+    Parameters:
+        data: BPM data with the columns name, x and y, and optionally x_rms and y_rms.
+
+    Returns:
+        pd.DataFrame: One row per BPM with the columns name, excluded, dead, 
+            outlier, mask, weight_x and weight_y.
+    """
+    x, y = data['x'].to_numpy(dtype=float), data['y'].to_numpy(dtype=float)
+    nan = np.full(len(data), np.nan)
+    x_rms = data['x_rms'].to_numpy(dtype=float) if 'x_rms' in data else nan
+    y_rms = data['y_rms'].to_numpy(dtype=float) if 'y_rms' in data else nan
+
+    excluded = data['name'].str.contains(exclude).to_numpy() if exclude else np.zeros(len(data), dtype=bool)
+    dead = (
+        ~np.isfinite(x) | ~np.isfinite(y) 
+        | ((x == 0) & (y == 0)) 
+        | ((x_rms == 0) & (y_rms == 0))
+        )
+
+    # Outliers are found among the BPMs that work
+    candidates = ~excluded & ~dead
+    outlier = np.zeros(len(data), dtype=bool)
+    for values in [x_rms, y_rms]:
+        z = robust_z_score(np.where(candidates, values, np.nan))
+        outlier |= candidates & (z > max_z)
+
+    mask = candidates & ~outlier
+
+    # Weights from the noise, normalised to one on average over the used BPMs
+    weights = []
+    for rms in [x_rms, y_rms]:
+        weight = 1 / (np.where(np.isfinite(rms), rms**2, 0) + noise_floor**2)
+        if mask.any(): weight = weight / weight[mask].mean()
+        weights.append(weight)
+
+    return pd.DataFrame({
+        'name': data['name'].to_numpy(),
+        'excluded': excluded,
+        'dead': dead,
+        'outlier': outlier,
+        'mask': mask,
+        'weight_x': weights[0],
+        'weight_y': weights[1]
+        })
+
+def bpm_names_lowercase(bpm_names: np.ndarray) -> np.ndarray:
+    """Ensure BPM names are in strings and in lowercase for merging with Twiss data later."""
+    if not np.issubdtype(bpm_names.dtype, np.str_):
+        bpm_names = bpm_names.astype(str)
+    return np.char.lower(bpm_names)
+
+def time_grid(t1: datetime, t2: datetime, step: float) -> List[datetime]:
+    """Create timestamps from t1 to t2, included, every step seconds."""
+    count = int(np.floor((t2 - t1).total_seconds() / step + 1e-9)) + 1
+    return [t1 + timedelta(seconds=i*step) for i in range(count)]
+
+def ir_knobs(knobs: List[str]) -> List[Tuple[str, str]]:
+    """Find the crossing and separation knobs of each IR, e.g. on_x1, on_sep2h or on_x8v.
+
+    Parameters:
+        knobs: Names of all knobs.
+
+    Returns:
+        List[Tuple[str, str]]: Pairs of IR, e.g. 'IR1', and knob, sorted by IR and knob.
+    """
+    pairs = []
+    for knob in knobs:
+        match = re.fullmatch(r'on_(x|sep)([1-8])[hv]?', knob)
+        if match: pairs.append((f'IR{match.group(2)}', knob))
+
+    return sorted(pairs)
+
+def ir_knob_planes(knobs: List[str], planes: Tuple[str, ...]) -> List[Tuple[str, str, str]]:
+    """Pair the knobs of each IR with the planes they are fitted in.
+
+    Knobs ending in h or v, e.g. on_x2h or on_sep8v, only act in the horizontal
+    or vertical plane, the others are fitted in all the given planes.
+
+    Returns:
+        List[Tuple[str, str, str]]: The IR, knob and plane of each fit, as in `ir_knobs`.
+    """
+    return [
+        (ir, knob, plane) for ir, knob in ir_knobs(knobs) for plane in planes
+        if knob[-1] not in 'hv' or plane[0] == knob[-1]
+        ]
+
+def is_processed(data: object, twiss: object) -> bool:
+    """Check if the data was already processed with the current twiss.
+
+    The twiss version is incremented by ApertureData on every retwiss and cycle,
+    objects without a version are always processed again.
+
+    Parameters:
+        data: A BPMData or CollimatorsData object.
+        twiss: An ApertureData object containing Twiss data for beam 1 and beam 2.
+
+    Returns:
+        bool: True if the processed results are still valid.
+    """
+    if data.processed_with is None: return False
+
+    processed_twiss, version = data.processed_with
+    return (
+        processed_twiss is twiss and version is not None 
+        and version == getattr(twiss, 'twiss_version', None)
+        )
+
+def first_values(data: Dict[str, Tuple[np.ndarray, np.ndarray]], 
+                 variables: List[str]) -> Tuple[np.ndarray, List[str]]:
+    """Extract the first logged value of each variable from a LoggingDB result.
+
+    Parameters:
+        data: The dictionary returned by the logging backend.
+        variables: Names of the variables to extract, in the order of the output.
+
+    Returns:
+        Tuple[np.ndarray, List[str]]: 
+            An array with the first value of each variable (NaN if missing) 
+            and a list of variables that were not found.
+    """
+    # Variables not found or without samples in the requested window count as missing
+    empty = (np.array([]), np.array([]))
+    samples = [data.get(variable, empty)[1] for variable in variables]
+    found = np.array([len(sample) > 0 for sample in samples], dtype=bool)
+
+    values = np.full(len(variables), np.nan)
+    values[found] = [sample[0] for sample in compress(samples, found)]
+    missing = list(compress(variables, ~found))
+
+    return values, missing
@@ -1,6 +1,28 @@
+import sys
+import importlib.util
 import pandas as pd
 import numpy as np
 
+def lazy_import(name):
+    """Import a module only when one of its attributes is first used.
+
+    Heavy dependencies (xtrack, plotly, scipy) take seconds to import,
+    with this they are only loaded by the code paths that need them.
+    """
+    # Already imported, lazily or not
+    if name in sys.modules: return sys.modules[name]
+
+    spec = importlib.util.find_spec(name)
+    if spec is None: raise ModuleNotFoundError(f"No module named '{name}'", name=name)
+
+    loader = importlib.util.LazyLoader(spec.loader)
+    spec.loader = loader
+    module = importlib.util.module_from_spec(spec)
+    sys.modules[name] = module
+    loader.exec_module(module)
+
+    return module
+
 def find_s_value(name, data):
     """Find a position of an element."""
     # Normalize the input name to lowercase
@@ -0,0 +1,68 @@
+"""Measure the import time of the aper_package modules in fresh interpreters
+and report which heavy dependencies each of them loads.
+
+Usage:
+    python bench_import.py [--repeat N]
+"""
+import argparse
+import json
+import statistics
+import subprocess
+import sys
+
+from pathlib import Path
+
+MODULES = [
+    'aper_package.utils',
+    'aper_package.logging_backend',
+    'aper_package.collimator_database',
+    'aper_package.timber_data',
+    'aper_package.aperture_data',
+    'aper_package.figure_data',
+    'aper_package.serialisation',
+    'aper_package.parallel',
+    'aper_package.monitoring',
+    'aper_package.streaming',
+    'aper_package.cli',
+    'aper_package.interactive_tool',
+    ]
+
+HEAVY = ['xtrack', 'tfs', 'scipy.optimize', 'plotly.graph_objs', 'ipywidgets', 'pytimber']
+
+# Runs in a fresh interpreter, so nothing is cached between measurements
+SCRIPT = '''
+import json, sys, time
+start = time.perf_counter()
+import {module}
+elapsed = time.perf_counter() - start
+# Lazily imported modules are in sys.modules but not executed yet
+loaded = [name for name in {heavy} if name in sys.modules
+          and type(sys.modules[name]).__name__ != '_LazyModule']
+print(json.dumps([elapsed, loaded]))
+'''
+
+def measure(module: str, repeat: int):
+    """Import time in seconds (median of the runs) and the loaded heavy dependencies."""
+    root = str(Path(__file__).resolve().parent.parent)
+    times = []
+    for _ in range(repeat):
+        output = subprocess.run(
+            [sys.executable, '-c', SCRIPT.format(module=module, heavy=HEAVY)],
+            cwd=root, capture_output=True, text=True, check=True
+            ).stdout
+        elapsed, loaded = json.loads(output.strip().splitlines()[-1])
+        times.append(elapsed)
+    return statistics.median(times), loaded
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--repeat', type=int, default=5, help='number of runs per module')
+    args = parser.parse_args()
+
+    print(f"{'module':<36}{'import [s]':>12}  heavy dependencies loaded")
+    for module in MODULES:
+        elapsed, loaded = measure(module, args.repeat)
+        print(f"{module:<36}{elapsed:>12.3f}  {', '.join(loaded) or '-'}")
+
+if __name__ == '__main__':
+    main()
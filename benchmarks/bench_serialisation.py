@@ -0,0 +1,87 @@
+"""Compare the payload size and encoding/decoding time of the standard
+plotly JSON with the typed-array serialisation from aper_package.serialisation.
+
+Usage:
+    python bench_serialisation.py                       # synthetic full-ring figure
+    python bench_serialisation.py line.json aper.tfs    # figure of a real machine
+    python bench_serialisation.py --html out_dir        # also write both HTML files
+
+Rendering time can only be measured in a browser: open the two HTML files
+written with --html and compare the time reported in the developer tools.
+"""
+import argparse
+import json
+import time
+import numpy as np
+import plotly.graph_objects as go
+
+from pathlib import Path
+import sys
+sys.path.append(str(Path(__file__).resolve().parent.parent))
+
+from aper_package.serialisation import figure_to_json, write_html
+
+def synthetic_figure(n: int = 30_000) -> go.Figure:
+    """A figure with the same number and size of traces as the full ring view."""
+    s = np.sort(np.random.default_rng(0).uniform(0, 26658.88, n))
+    fig = go.Figure()
+    for i in range(8):
+        y = 1e-3 * np.sin(s / 100 + i) + 1e-5 * np.random.default_rng(i).normal(size=n)
+        customdata = np.column_stack([y, y / 2e-4, y / 1e-4])
+        fig.add_trace(go.Scatter(x=s, y=y, customdata=customdata, mode='lines'))
+    return fig
+
+def machine_figure(line: str, aperture: str) -> go.Figure:
+    """Plot envelopes, beam positions and aperture of a machine."""
+    from aper_package.aperture_data import ApertureData
+    from aper_package.figure_data import plot_envelopes, plot_beam_positions, plot_aperture
+
+    data = ApertureData(line)
+    data.load_aperture(aperture)
+
+    fig = go.Figure()
+    for function in [plot_aperture, plot_beam_positions, plot_envelopes]:
+        fig.add_traces(function(data, 'horizontal')[1])
+    return fig
+
+def measure(function, repeat: int = 3) -> float:
+    """Best time of a few runs in seconds."""
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        function()
+        times.append(time.perf_counter() - start)
+    return min(times)
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('line', nargs='?', help='path to the line json file')
+    parser.add_argument('aperture', nargs='?', help='path to the aperture tfs file')
+    parser.add_argument('--html', help='directory to write the HTML files to')
+    args = parser.parse_args()
+
+    if args.line and args.aperture: fig = machine_figure(args.line, args.aperture)
+    else: fig = synthetic_figure()
+
+    methods = {
+        'plotly json': dict(typed_arrays=False),
+        'typed arrays float64': dict(typed_arrays=True, atol=0),
+        'typed arrays float32': dict(typed_arrays=True, atol=np.inf),
+        'typed arrays 0.1 mm': dict(typed_arrays=True),
+        }
+
+    print(f"{'method':<24}{'size [MB]':>12}{'encode [s]':>12}{'decode [s]':>12}")
+    for name, kwargs in methods.items():
+        payload = figure_to_json(fig, **kwargs)
+        encode = measure(lambda: figure_to_json(fig, **kwargs))
+        decode = measure(lambda: json.loads(payload))
+        print(f"{name:<24}{len(payload) / 1e6:>12.2f}{encode:>12.3f}{decode:>12.3f}")
+
+    if args.html:
+        directory = Path(args.html)
+        directory.mkdir(parents=True, exist_ok=True)
+        write_html(fig, str(directory / 'plotly_json.html'), typed_arrays=False)
+        write_html(fig, str(directory / 'typed_arrays.html'), typed_arrays=True)
+
+if __name__ == '__main__':
+    main()
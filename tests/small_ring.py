@@ -0,0 +1,42 @@
+"""A small ring with knobs named like the LHC ones, to run the fits and the reports without the full machine."""
+import xtrack as xt
+import pandas as pd
+
+from pathlib import Path
+from typing import Tuple
+
+def write_ring(directory: str) -> Tuple[Path, Path]:
+    """Save the lines of both beams as line_b1.json and line_b2.json in directory.
+
+    Each beam has 8 cells with BPMs at the quadrupoles, bpm.{i}f.b1 and bpm.{i}d.b1,
+    and orbit correctors mcb.{i}h.b1 and mcb.{i}v.b1. on_x1 kicks horizontally and
+    on_sep1 vertically at the first cell, on_x2h and on_sep2v at the fifth one.
+    """
+    paths = []
+    for beam in ['b1', 'b2']:
+        elements, names = [], []
+        for i in range(8):
+            names += [f'bpm.{i}f.{beam}', f'drift_{i}a', f'mcb.{i}h.{beam}', f'mcb.{i}v.{beam}', f'bpm.{i}d.{beam}', f'drift_{i}b']
+            elements += [
+                xt.Multipole(knl=[0, 0.01]), xt.Drift(length=10.), xt.Multipole(knl=[0]), 
+                xt.Multipole(ksl=[0]), xt.Multipole(knl=[0, -0.01]), xt.Drift(length=10.)]
+        line = xt.Line(
+            elements=elements + [xt.Cavity(voltage=8e6, frequency=100*299792458/160.)], 
+            element_names=names + ['acsca'])
+        line.particle_ref = xt.Particles(p0c=450e9, mass0=xt.PROTON_MASS_EV, q0=1)
+
+        for knob, element, attribute in [
+            ('on_x1', f'mcb.0h.{beam}', 'knl'), ('on_sep1', f'mcb.0v.{beam}', 'ksl'),
+            ('on_x2h', f'mcb.4h.{beam}', 'knl'), ('on_sep2v', f'mcb.4v.{beam}', 'ksl')]:
+            line.vars[knob] = 0
+            getattr(line.element_refs[element], attribute)[0] = line.vars[knob] * 1e-6
+
+        paths.append(Path(directory) / f'line_{beam}.json')
+        line.to_json(paths[-1])
+
+    return paths[0], paths[1]
+
+def bpm_orbit(aper_data: object) -> pd.DataFrame:
+    """The orbit of beam 1 at the BPMs, as a BPMData.data DataFrame."""
+    orbit = aper_data.twiss_orbit()[0]
+    return orbit.loc[orbit['name'].str.startswith('bpm'), ['name', 'x', 'y']].reset_index(drop=True)
@@ -1,4 +1,6 @@
 import unittest
+import os
+import tempfile
 import pandas as pd
 
 from pathlib import Path
@@ -126,5 +128,39 @@ class TestAperData(unittest.TestCase):
 
         pass
 
+class TestAperTolerance(unittest.TestCase):
+
+    def setUp(self):
+
+        # Only the aperture DataFrames are needed, no lines
+        self.data = ApertureData.__new__(ApertureData)
+        self.data.aper_b1 = pd.DataFrame({'NAME': ['MQ.B1'], 'APER_1': [0.02]})
+        self.data.aper_b2 = pd.DataFrame({'NAME': ['MQ.B2'], 'APER_1': [0.02]})
+
+    def test_beam_2_from_file_name(self):
+
+        with tempfile.TemporaryDirectory() as directory:
+            # b1 in the directory name must not be replaced
+            folder = Path(directory) / 'run_b1'
+            folder.mkdir()
+            (folder / 'tol.b1.madx').write_text('MQ.B1, APER_TOL={0.001, 0.002, 0.003};\n')
+            (folder / 'tol.b2.madx').write_text('MQ.B2, APER_TOL={0.004, 0.005, 0.006};\n')
+
+            self.data._load_aperture_tolerance(str(folder / 'tol.b1.madx'))
+
+        self.assertEqual(self.data.aper_b1['APER_TOL_1'].iloc[0], 0.001)
+        self.assertEqual(self.data.aper_b2['APER_TOL_1'].iloc[0], 0.004)
+
+    def test_default_independent_of_cwd(self):
+
+        cwd = os.getcwd()
+        with tempfile.TemporaryDirectory() as directory:
+            os.chdir(directory)
+            try: self.data._load_aperture_tolerance()
+            finally: os.chdir(cwd)
+
+        self.assertIn('APER_TOL_1', self.data.aper_b1)
+        self.assertIn('APER_TOL_1', self.data.aper_b2)
+
 if __name__ == '__main__':
     unittest.main()
\ No newline at end of file
@@ -0,0 +1,136 @@
+import unittest
+import tempfile
+import pandas as pd
+import tfs
+
+from pathlib import Path
+import sys
+sys.path.append(str(Path.cwd().parent))
+
+from aper_package.cli import parse_args, build_configurations, load_knobs, collimator_margins, main
+
+class TestCli(unittest.TestCase):
+
+    def test_build_configurations(self):
+
+        args = parse_args([
+            'inj_b1.json', 'top_b1.json', '--knobs', 'a.yaml', 'b.json',
+            '--aperture', 'all_optics_B1.tfs', '--n', '5', '--format', 'csv'
+            ])
+        configs = build_configurations(args)
+
+        self.assertEqual(
+            [config['name'] for config in configs],
+            ['inj_b1_a', 'inj_b1_b', 'top_b1_a', 'top_b1_b']
+            )
+        self.assertEqual(configs[0]['n'], 5)
+        self.assertEqual(configs[0]['aperture'], 'all_optics_B1.tfs')
+        self.assertIsNone(configs[0]['collimators'])
+
+    def test_load_knobs(self):
+
+        with tempfile.TemporaryDirectory() as directory:
+            path = Path(directory) / 'knobs.json'
+            path.write_text('{"on_x1": 160, "on_sep1": -2}')
+
+            self.assertEqual(load_knobs(str(path)), {'on_x1': 160., 'on_sep1': -2.})
+
+        self.assertEqual(load_knobs(None), {})
+
+    def test_collimator_margins(self):
+
+        col = pd.DataFrame({
+            'name': ['tcp.a'], 's': [10.], 'gap': [6.], 'x': [1e-3], 'y': [0.],
+            'sigma_x': [1e-3], 'sigma_y': [2e-3], 'top_gap_col': [7e-3], 'bottom_gap_col': [-5e-3]
+            })
+        data = type('Data', (), {'colx_b1': col, 'colx_b2': col, 'coly_b1': col, 'coly_b2': col})()
+
+        margins = collimator_margins(data, 4)
+
+        self.assertEqual(len(margins), 4)
+        self.assertAlmostEqual(margins['margin_top'].iloc[0], 2e-3)
+        self.assertAlmostEqual(margins['margin_bottom'].iloc[0], 2e-3)
+        self.assertAlmostEqual(margins['margin_top'].iloc[2], -1e-3)
+        self.assertEqual(margins['margin_sigma'].iloc[0], 2.)
+
+class TestCliRun(unittest.TestCase):
+
+    def write_inputs(self, directory):
+        """Save the small ring with its aperture, tolerances, collimators and two knob files."""
+        from small_ring import write_ring
+
+        directory = Path(directory)
+        line_b1, _ = write_ring(directory)
+
+        for beam, file_beam in [('b1', 'B1'), ('b2', 'B4')]:
+            names = [f'BPM.{i}{side}.{beam.upper()}' for i in range(8) for side in 'FD']
+            tfs.write(directory / f'aper_{file_beam}.tfs', pd.DataFrame({
+                'NAME': names, 'APER_1': 0.02, 'APER_2': 0.02, 'APER_3': 0.02, 'APER_4': 0.02, 'MECH_SEP': 0.
+                }))
+            (directory / f'tol.{beam}.madx').write_text(
+                ''.join(f'{name}, APER_TOL={{0.001, 0.0005, 0.0005}};\n' for name in names))
+
+        (directory / 'collimators.yaml').write_text(
+            'collimators:\n'
+            '  b1:\n'
+            '    bpm.2f.b1: { gap: 6, angle: 0, length: 1 }\n'
+            '    bpm.3f.b1: { gap: 8, angle: 90, length: 1 }\n'
+            '  b2:\n'
+            '    bpm.2f.b2: { gap: 6, angle: 0, length: 1 }\n')
+
+        (directory / 'knobs_a.yaml').write_text('on_x1: 100\n')
+        (directory / 'knobs_b.yaml').write_text('on_sep1: 50\n')
+
+        return directory, line_b1
+
+    def test_run_with_tolerances(self):
+
+        with tempfile.TemporaryDirectory() as directory:
+            directory, line_b1 = self.write_inputs(directory)
+            output = directory / 'reports'
+
+            # Two knob files, so the configurations run on separate processes
+            summaries = main([
+                str(line_b1), '--aperture', str(directory / 'aper_B1.tfs'),
+                '--tolerances', str(directory / 'tol.b1.madx'),
+                '--collimators', str(directory / 'collimators.yaml'),
+                '--knobs', str(directory / 'knobs_a.yaml'), str(directory / 'knobs_b.yaml'),
+                '--output', str(output), '--format', 'csv', '--workers', '2'
+                ])
+
+            self.assertEqual([summary['name'] for summary in summaries], ['line_b1_knobs_a', 'line_b1_knobs_b'])
+            for summary in summaries:
+                for column in ['n1_x_b1', 'n1_y_b1', 'n1_x_b2', 'n1_y_b2']:
+                    self.assertGreater(summary[column], 0)
+
+            self.assertTrue((output / 'summary.csv').exists())
+            n1 = pd.read_csv(output / 'line_b1_knobs_a' / 'n1.csv')
+            self.assertFalse(n1['n1_x'].isna().any())
+
+            margins = pd.read_csv(output / 'line_b1_knobs_a' / 'collimators.csv')
+            self.assertEqual(len(margins), 3)
+            self.assertEqual(sorted(margins['margin_sigma']), [2., 2., 4.])
+            # The jaws are centred on the orbit and open by more than the envelope
+            self.assertTrue((margins['margin_top'] > 0).all())
+            self.assertTrue((margins['margin_top'] - margins['margin_bottom']).abs().lt(1e-9).all())
+
+    def test_run_without_tolerances(self):
+
+        with tempfile.TemporaryDirectory() as directory:
+            directory, line_b1 = self.write_inputs(directory)
+            output = directory / 'reports'
+
+            summaries = main([
+                str(line_b1), '--aperture', str(directory / 'aper_B1.tfs'),
+                '--output', str(output), '--format', 'csv'
+                ])
+
+            # n1 is not defined without tolerances, only the envelopes are useful
+            self.assertEqual(summaries, [{'name': 'line_b1'}])
+            n1 = pd.read_csv(output / 'line_b1' / 'n1.csv')
+            self.assertTrue(n1['n1_x'].isna().all())
+            self.assertTrue((output / 'line_b1' / 'envelopes.csv').exists())
+            self.assertFalse((output / 'line_b1' / 'collimators.csv').exists())
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,46 @@
+import unittest
+import os
+import shutil
+import tempfile
+
+from pathlib import Path
+import sys
+home_path = str(Path.cwd().parent)
+sys.path.append(home_path)
+
+from aper_package.collimator_database import load_collimator_database
+
+class TestCollimatorDatabase(unittest.TestCase):
+
+    def setUp(self):
+        self.path = home_path+'/test_data/injection.yaml'
+
+    def test_get(self):
+
+        db = load_collimator_database(self.path)
+
+        colx_b1 = db.get('b1', 0)
+        self.assertEqual(list(colx_b1.columns), ['name', 'gap', 'angle'])
+        self.assertTrue((colx_b1['angle'] == 0).all())
+        self.assertFalse(colx_b1['gap'].isnull().any())
+        self.assertEqual(colx_b1.shape[0], 20)
+        self.assertEqual(db.get('b2', 90).shape[0], 10)
+
+        self.assertAlmostEqual(colx_b1[colx_b1['name']=='tcp.c6l7.b1']['gap'].values[0], 5.7, 6)
+
+    def test_cache(self):
+
+        with tempfile.TemporaryDirectory() as directory:
+            path = shutil.copy(self.path, directory)
+
+            # The file is only parsed once
+            db = load_collimator_database(path)
+            self.assertIs(load_collimator_database(path), db)
+
+            # Unless it changes
+            stat = os.stat(path)
+            os.utime(path, ns=(stat.st_atime_ns, stat.st_mtime_ns + 1_000_000_000))
+            self.assertIsNot(load_collimator_database(path), db)
+
+if __name__ == '__main__':
+    unittest.main()
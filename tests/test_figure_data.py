@@ -37,6 +37,7 @@ class TestPlotting(unittest.TestCase):
         self.assertEqual(len(traces[1]['x']), self.data.tw_b1.shape[0])
         self.assertEqual(len(traces[2]['y']), self.data.tw_b2.shape[0])
         self.assertEqual(len(traces[3]['y']), self.data.tw_b2.shape[0])
+        self.assertEqual(traces[0]['customdata'].shape, (self.data.tw_b1.shape[0], 3))
 
         vis, traces = plot_envelopes(self.data, 'vertical')
 
@@ -124,5 +125,170 @@ class TestPlotting(unittest.TestCase):
         self.assertTrue((traces[2]['x']==traces[3]['x']).all())
 
 
+class TestGeometry(unittest.TestCase):
+
+    def test_plot_machine_components(self):
+
+        elements = pd.DataFrame({
+            'NAME': ['MB.A', 'MQ.A', 'MQ.B', 'MQ.C'],
+            'KEYWORD': ['SBEND', 'QUADRUPOLE', 'QUADRUPOLE', 'QUADRUPOLE'],
+            'S': [10., 20., 30., 40.],
+            'L': [2., 1., 1., 1.],
+            'K1L': [0., 0.1, 0., -0.1]
+            })
+        data = type('Data', (), {'elements': elements})()
+
+        vis, traces = plot_machine_components(data)
+
+        self.assertEqual(len(traces), 10)
+        self.assertTrue(vis.all())
+
+        # Bends
+        np.testing.assert_array_equal(traces[0]['x'], [9, 9, 11, 11, np.nan])
+        np.testing.assert_array_equal(traces[0]['y'], [-0.5, 0.5, 0.5, -0.5, np.nan])
+        self.assertEqual(list(traces[1]['text']), ['MB.A'])
+
+        # Quadrupoles with K1L of 0 are skipped
+        np.testing.assert_array_equal(
+            traces[8]['x'], [19.5, 19.5, 20.5, 20.5, np.nan, 39.5, 39.5, 40.5, 40.5, np.nan])
+        np.testing.assert_array_equal(
+            traces[8]['y'], [0, 1, 1, 0, np.nan, 0, -1, -1, 0, np.nan])
+        np.testing.assert_array_equal(traces[9]['x'], [20, 40])
+        np.testing.assert_array_equal(traces[9]['y'], [0.5, -0.5])
+        self.assertEqual(list(traces[9]['text']), ['MQ.A', 'MQ.C'])
+
+        # No elements of this type
+        self.assertEqual(len(traces[2]['x']), 0)
+
+    def test_plot_collimators(self):
+
+        col = pd.DataFrame({
+            'name': ['tcp.a', 'tcp.b'],
+            's': [100., 200.],
+            'top_gap_col': [0.01, 0.02],
+            'bottom_gap_col': [-0.01, -0.03]
+            })
+        data = type('Data', (), {
+            'colx_b1': col, 'colx_b2': col.iloc[:1], 
+            'coly_b1': col, 'coly_b2': col
+            })()
+
+        vis, traces = plot_collimators(data, 'horizontal')
+
+        np.testing.assert_array_equal(vis, np.array([True, True, False, False]))
+        self.assertEqual(len(traces), 4)
+
+        np.testing.assert_array_equal(
+            traces[2]['x'], [99.5, 99.5, 100.5, 100.5, np.nan, 99.5, 99.5, 100.5, 100.5, np.nan])
+        np.testing.assert_array_equal(
+            traces[2]['y'], [0.01, 0.1, 0.1, 0.01, np.nan, -0.01, -0.1, -0.1, -0.01, np.nan])
+
+        self.assertEqual(len(traces[0]['x']), 20)
+        np.testing.assert_allclose(traces[1]['y'], [0.03, -0.03, 0.035, -0.04])
+        np.testing.assert_array_equal(traces[1]['x'], [100, 100, 200, 200])
+        self.assertEqual(list(traces[1]['text']), ['tcp.a', 'tcp.a', 'tcp.b', 'tcp.b'])
+
+    def test_downsample_trace(self):
+
+        x = np.linspace(0, 1000, 10001)
+        y = np.sin(x)
+        y[5000] = 5.
+        y[6000] = np.nan
+        trace = go.Scatter(x=x, y=y, text=x.astype(str), customdata=np.column_stack([x, y]))
+
+        reduced = downsample_trace(trace, [0, 1000], 100)
+
+        self.assertLessEqual(len(reduced.x), 401)
+        np.testing.assert_array_equal(reduced.text, reduced.x.astype(str))
+        np.testing.assert_array_equal(reduced.customdata[:, 0], reduced.x)
+        # Extremes, gaps and the ends are preserved
+        self.assertEqual(np.nanmax(reduced.y), 5.)
+        self.assertEqual(np.nanmin(reduced.y), np.nanmin(y))
+        self.assertTrue(np.isnan(reduced.y).any())
+        self.assertEqual((reduced.x[0], reduced.x[-1]), (0., 1000.))
+
+        # Zooming in shows all the points
+        zoomed = downsample_trace(trace, [100, 110], 100)
+        np.testing.assert_array_equal(zoomed.x, x[999:1102])
+
+        # Short traces are not changed
+        self.assertIs(downsample_trace(trace, [0, 1000], 5000), trace)
+
+    def test_aperture_polygon(self):
+
+        x, y = aperture_polygon(0.02, 0.015, 0.022, 0.022)
+
+        # Closed outline within both the rectangle and the ellipse
+        self.assertEqual((x[0], y[0]), (x[-1], y[-1]))
+        self.assertTrue(np.all(np.abs(x) <= 0.02 + 1e-12))
+        self.assertTrue(np.all(np.abs(y) <= 0.015 + 1e-12))
+        self.assertTrue(np.all((x / 0.022)**2 + (y / 0.022)**2 <= 1 + 1e-12))
+        # The sides of the rectangle are part of the outline
+        self.assertAlmostEqual(np.max(y), 0.015)
+        self.assertAlmostEqual(np.max(x), 0.02)
+        self.assertLess(len(x), 300)
+
+        # Repeated calls are memoised
+        self.assertIs(aperture_polygon(0.02, 0.015, 0.022, 0.022)[0], x)
+
+        # Without an ellipse the aperture is a rectangle
+        x, y = aperture_polygon(0.02, 0.015, 0., 0.)
+        self.assertEqual(set(np.abs(x)), {0., 0.02})
+        self.assertEqual(set(np.abs(y)), {0., 0.015})
+
+        trace = plot_2d_aperture(0.02, 0.015, 0.022, 0.022, 'Aperture')
+        self.assertEqual(trace.name, 'Aperture')
+
+    def test_cross_section_sweep(self):
+
+        tw = pd.DataFrame({
+            'name': [f'e{i}' for i in range(6)], 's': np.arange(6) * 10.,
+            'x': np.arange(6) * 1e-4, 'y': 0., 'sigma_x': 1e-4, 'sigma_y': 2e-4,
+            'betx': 100., 'bety': 50., 'dx': 1., 'dy': 0.
+            })
+        aper = pd.DataFrame({
+            'NAME': ['E0', 'E2', 'E4'], 'APER_1': 0.02, 'APER_2': 0.015, 'APER_3': 0.022, 'APER_4': 0.022,
+            'APER_TOL_1': 1e-3, 'APER_TOL_2': 1e-3, 'APER_TOL_3': 2e-3
+            })
+        data = type('Data', (), {
+            'tw_b1': tw, 'tw_b2': tw.assign(s=tw.s + 1), 'aper_b1': aper, 'aper_b2': aper.copy(), 
+            'epsilon': 1e-8, 'calculate_sigma_with_error': ApertureData.calculate_sigma_with_error
+            })()
+
+        df = cross_section_sweep('beam 1', data, 5, (5, 50), delta_co=1e-3)
+
+        self.assertEqual(df['name'].to_list(), ['e2', 'e4'])
+        np.testing.assert_allclose(df['x0'], [-3e-4, -1e-4])
+        np.testing.assert_allclose(df['APER_1_tol'], [0.017, 0.017])
+        np.testing.assert_allclose(df['APER_2_tol'], [0.011, 0.011])
+
+        # A range going through s = 0 keeps the order along the beam
+        df = cross_section_sweep('beam 1', data, 5, (30, 10))
+        self.assertEqual(df['name'].to_list(), ['e4', 'e0'])
+
+        fig = generate_2d_sweep((0, 50), 'both', data, 5, show_errors=True)
+        self.assertEqual([frame.name for frame in fig.frames], ['e0', 'e2', 'e4'])
+        self.assertEqual(len(fig.frames[0].data), 10)
+        self.assertEqual(len(fig.layout.sliders[0].steps), 3)
+
+    def test_plot_2d_envelope(self):
+
+        envelope, outline = plot_2d_envelope(-1., 1., -2., 2., 'blue', 'Envelope')
+
+        np.testing.assert_array_equal(envelope.x, [-1., 1., 1., -1., -1.])
+        np.testing.assert_array_equal(envelope.y, [-2., -2., 2., 2., -2.])
+        self.assertEqual(len(outline.x), 400)
+        self.assertEqual((outline.x.min(), outline.x.max()), (-1., 1.))
+
+        # Many envelopes are combined into one NaN-separated trace
+        envelope, outline = plot_2d_envelope(
+            np.array([-1., -3.]), np.array([1., 3.]), np.array([-2., -4.]), np.array([2., 4.]), 
+            'blue', 'Envelopes')
+
+        self.assertEqual(len(envelope.x), 12)
+        self.assertTrue(np.isnan(envelope.x[5]))
+        np.testing.assert_array_equal(envelope.x[6:11], [-3., 3., 3., -3., -3.])
+        self.assertEqual(len(outline.y), 802)
+
 if __name__ == '__main__':
     unittest.main()
\ No newline at end of file
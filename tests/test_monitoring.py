@@ -0,0 +1,153 @@
+import unittest
+import tempfile
+from datetime import datetime
+import numpy as np
+import pandas as pd
+
+from pathlib import Path
+import sys
+sys.path.append(str(Path.cwd().parent))
+
+from aper_package.monitoring import OrbitMonitor
+from aper_package.timber_data import BPMData
+from aper_package.logging_backend import ReplayBackend
+
+class TestMonitoring(unittest.TestCase):
+
+    def setUp(self):
+        self.time = datetime(2023, 4, 21, 10, 53, 15)
+        t = self.time.timestamp()
+
+        # Orbit of a linear model for a crossing angle changing every second
+        self.response = np.array([1e-6, 3e-6])
+        self.angles = [100., 120., 140.]
+
+        self.directory = tempfile.TemporaryDirectory()
+        backend = ReplayBackend(self.directory.name)
+        backend.write(
+            'BFC.LHC:OrbitAcq:positionsH', [t, t+1, t+2], [self.response*a*1e6 for a in self.angles])
+        backend.write('BFC.LHC:OrbitAcq:positionsV', [t, t+1, t+2], [[0., 0.]]*3)
+        backend.write('BFC.LHC:Mappings:fBPMNames_h', [t], [['BPM.1', 'BPM.3']])
+        self.bpm_data = BPMData(backend, label=type('Label', (), {'value': ''})())
+
+        tw = pd.DataFrame({'name': ['bpm.1', 'bpm.3'], 's': [1., 3.], 'x': [0., 0.], 'y': [0., 0.]})
+        response, self.orbits = self.response, []
+
+        class Aperture:
+            knobs = pd.DataFrame({'knob': ['on_x1'], 'current value': [0.]})
+            values = {}
+            def change_knob(aperture, knob, value): aperture.values[knob] = value
+            def twiss_orbit(aperture):
+                self.orbits.append(aperture.values['on_x1'])
+                orbit = tw.assign(x=response*aperture.values['on_x1'])
+                return orbit, orbit.iloc[:0]
+
+        self.aper_data = Aperture()
+
+        # A clock advanced only by waiting
+        self.now = 0.
+        def sleep(seconds): self.now += seconds
+        self.clock, self.sleep = lambda: self.now, sleep
+
+    def tearDown(self):
+        self.directory.cleanup()
+
+    def test_run(self):
+
+        results = []
+        monitor = OrbitMonitor(
+            self.bpm_data, self.aper_data, ['on_x1'], period=1.0, start_time=self.time,
+            callback=results.append, clock=self.clock, sleep=self.sleep)
+        monitor.run(count=3)
+
+        # Each acquisition is followed exactly with one step of the linear fit
+        np.testing.assert_allclose([r['values']['on_x1'] for r in results], self.angles)
+        self.assertEqual([r['time'] for r in results], [self.time + pd.Timedelta(seconds=i) for i in range(3)])
+        # The response is computed once (2 orbits), then one orbit per update
+        self.assertEqual(len(self.orbits), 2 + 3)
+        self.assertAlmostEqual(self.aper_data.values['on_x1'], 140.)
+
+    def test_bpms_change(self):
+
+        # One BPM drops out and another one comes back, the count stays the same
+        t = self.time.timestamp()
+        response = np.array([1e-6, 2e-6, 3e-6])
+        backend = ReplayBackend(Path(self.directory.name) / 'change')
+        backend.write(
+            'BFC.LHC:OrbitAcq:positionsH', [t, t+1], [response*[1, 1, 0]*100e6, response*[0, 1, 1]*120e6])
+        backend.write('BFC.LHC:OrbitAcq:positionsV', [t, t+1], [[0., 0., 0.]]*2)
+        backend.write('BFC.LHC:Mappings:fBPMNames_h', [t], [['BPM.1', 'BPM.2', 'BPM.3']])
+        bpm_data = BPMData(backend, label=type('Label', (), {'value': ''})())
+
+        tw = pd.DataFrame({'name': ['bpm.1', 'bpm.2', 'bpm.3'], 's': [1., 2., 3.], 'x': 0., 'y': 0.})
+        orbits = []
+        class Aperture:
+            knobs = pd.DataFrame({'knob': ['on_x1'], 'current value': [0.]})
+            values = {}
+            def change_knob(aperture, knob, value): aperture.values[knob] = value
+            def twiss_orbit(aperture):
+                orbits.append(aperture.values['on_x1'])
+                orbit = tw.assign(x=response*aperture.values['on_x1'])
+                return orbit, orbit.iloc[:0]
+
+        results = []
+        monitor = OrbitMonitor(
+            bpm_data, Aperture(), ['on_x1'], start_time=self.time,
+            callback=results.append, clock=self.clock, sleep=self.sleep)
+        monitor.run(count=2)
+
+        # The response is computed again for the new BPMs
+        np.testing.assert_allclose([r['values']['on_x1'] for r in results], [100., 120.])
+        self.assertEqual(list(monitor.response_names), ['bpm.2', 'bpm.3'])
+        # Once found changed, the orbit is computed again with the new response
+        self.assertEqual(len(orbits), (2 + 1) + (1 + 2 + 1))
+
+    def test_failed_update(self):
+
+        # The orbit can't be computed for the second update
+        twiss_orbit = type(self.aper_data).twiss_orbit
+        def failing(aperture):
+            if len(self.orbits) == 3: 
+                self.orbits.append(None)
+                raise np.linalg.LinAlgError('Singular matrix')
+            return twiss_orbit(aperture)
+        type(self.aper_data).twiss_orbit = failing
+
+        label = type('Label', (), {'value': ''})()
+        results = []
+        monitor = OrbitMonitor(
+            self.bpm_data, self.aper_data, ['on_x1'], period=1.0, start_time=self.time,
+            callback=results.append, clock=self.clock, sleep=self.sleep, label=label)
+        monitor.run(count=3)
+
+        # The failure is reported and the cadence kept
+        self.assertEqual(len(monitor.errors), 1)
+        self.assertIn('Singular matrix', label.value)
+        self.assertEqual([r['time'] for r in results], [self.time, self.time + pd.Timedelta(seconds=2)])
+        self.assertEqual(self.now, 2.)
+
+    def test_failed_load(self):
+
+        monitor = OrbitMonitor(
+            self.bpm_data, self.aper_data, ['on_x1'], start_time=self.time, clock=self.clock)
+        self.assertIsNotNone(monitor.update())
+
+        # The previous acquisition is not fitted again
+        class Unavailable:
+            def get(self, *args): raise ConnectionError('No connection')
+        self.bpm_data.ldb = Unavailable()
+
+        self.assertIsNone(monitor.update())
+        self.assertIsNone(self.bpm_data.data)
+        self.assertEqual(len(monitor.history), 1)
+
+    def test_live(self):
+
+        # Without a start time the last logged acquisition is used
+        monitor = OrbitMonitor(self.bpm_data, self.aper_data, ['on_x1'])
+        result = monitor.update()
+
+        self.assertAlmostEqual(result['values']['on_x1'], self.angles[-1])
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,91 @@
+import unittest
+import tempfile
+import pandas as pd
+
+from pathlib import Path
+import sys
+sys.path.append(str(Path.cwd().parent))
+
+from aper_package import parallel
+from aper_package.parallel import snapshot, apply_settings
+
+class TestParallel(unittest.TestCase):
+
+    def setUp(self):
+
+        def knobs(names, initial, current):
+            return pd.DataFrame({'knob': names, 'initial value': initial, 'current value': current})
+
+        def change_knob(data, knob, value):
+            data.line_b1.vars[knob] = data.line_b2.vars[knob] = value
+        def change_acb_knob(data, knob, value, beam):
+            (data.line_b1 if beam == 'beam 1' else data.line_b2).vars[knob] = value
+
+        empty = knobs([], [], [])
+        self.data = type('Data', (), {
+            'change_knob': change_knob, 'change_acb_knob': change_acb_knob,
+            'knobs': knobs(['on_x1', 'on_sep1'], [160., 0.], [150., 0.]),
+            'acbh_knobs_b1': knobs(['acbh12.r1b1'], [0.], [1e-6]),
+            'acbv_knobs_b1': empty, 'acbh_knobs_b2': empty, 'acbv_knobs_b2': empty,
+            'first_element': 'ip3',
+            'line_b1': type('Line', (), {'vars': {}})(),
+            'line_b2': type('Line', (), {'vars': {}})(),
+            })()
+
+    def test_snapshot(self):
+
+        state = snapshot(self.data)
+
+        # Only the changed knobs are kept
+        self.assertEqual(state['settings'], [('on_x1', 150., None), ('acbh12.r1b1', 1e-6, 'beam 1')])
+        self.assertEqual(state['first_element'], 'ip3')
+
+    def test_apply_settings(self):
+
+        apply_settings(self.data, snapshot(self.data)['settings'])
+
+        self.assertEqual(self.data.line_b1.vars, {'on_x1': 150., 'acbh12.r1b1': 1e-6})
+        self.assertEqual(self.data.line_b2.vars, {'on_x1': 150.})
+
+class TestWorker(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        from aper_package.aperture_data import ApertureData
+        from small_ring import write_ring
+
+        cls.directory = tempfile.TemporaryDirectory()
+        cls.label = type('Label', (), {'value': ''})()
+        cls.data = ApertureData(*write_ring(cls.directory.name), label=cls.label)
+        cls.data.change_knob('on_x1', 70)
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.directory.cleanup()
+
+    def test_fit_knob(self):
+
+        parallel._init_worker(self.data.path_b1, self.data.path_b2, snapshot(self.data))
+        worker = parallel._aperture_data
+
+        # The knob DataFrame and the lines of the worker agree with the parent
+        self.assertEqual(worker.knobs.set_index('knob').at['on_x1', 'current value'], 70)
+        self.assertEqual(worker.line_b1.vv.get('on_x1'), 70)
+
+        starts = []
+        class Fit:
+            def least_squares_fit(self, aper_data, init_angle, knob, *args):
+                starts.append(init_angle)
+                aper_data.change_knob(knob, 123)
+                return 123, 0
+
+        self.assertEqual(parallel._fit_knob(Fit(), 'on_x1', 'horizontal', None, (-500, 500), True), (123, 0))
+
+        # The fit starts from the parent value and the worker is brought back to it
+        self.assertEqual(starts, [70])
+        self.assertEqual(worker.knobs.set_index('knob').at['on_x1', 'current value'], 70)
+        self.assertEqual(worker.line_b1.vv.get('on_x1'), 70)
+        self.assertEqual(worker.line_b2.vv.get('on_x1'), 70)
+
+if __name__ == '__main__':
+    unittest.main()
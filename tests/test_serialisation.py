@@ -0,0 +1,57 @@
+import unittest
+import json
+import numpy as np
+import plotly.graph_objects as go
+
+from pathlib import Path
+import sys
+sys.path.append(str(Path.cwd().parent))
+
+from aper_package.serialisation import (
+    to_numeric_array, compact_figure, figure_to_json, decode_typed_array)
+
+class TestSerialisation(unittest.TestCase):
+
+    def setUp(self):
+        self.x = np.linspace(0, 26658.88, 5000)
+        self.y = np.sin(self.x / 100) * 1e-3
+        self.y[10] = np.nan
+        self.fig = go.Figure(go.Scatter(
+            x=self.x, y=self.y, customdata=np.column_stack([self.y, self.y * 2]), name='orbit'))
+
+    def test_to_numeric_array(self):
+
+        self.assertEqual(to_numeric_array(self.y).dtype, np.float32)
+        # s around the ring would be off by up to a millimetre in float32
+        self.assertEqual(to_numeric_array(self.x).dtype, np.float64)
+        self.assertEqual(to_numeric_array(self.x, atol=1e-2).dtype, np.float32)
+        self.assertEqual(to_numeric_array(list(range(5000))).dtype, np.int16)
+        # Short arrays and strings are not converted
+        self.assertIsNone(to_numeric_array(self.x[:10]))
+        self.assertIsNone(to_numeric_array(self.x.astype(str)))
+
+    def test_figure_to_json(self):
+
+        data = json.loads(figure_to_json(self.fig))['data'][0]
+
+        self.assertEqual(data['name'], 'orbit')
+        self.assertEqual(data['x']['dtype'], 'f8')
+        self.assertEqual(data['y']['dtype'], 'f4')
+        np.testing.assert_array_equal(decode_typed_array(data['x']), self.x)
+        np.testing.assert_allclose(decode_typed_array(data['y']), self.y, rtol=1e-7)
+        self.assertEqual(decode_typed_array(data['customdata']).shape, (5000, 2))
+
+        # The standard serialisation is still available
+        data = json.loads(figure_to_json(self.fig, typed_arrays=False))['data'][0]
+        self.assertEqual(len(data['x']), 5000)
+
+    def test_compact_figure(self):
+
+        compact_figure(self.fig)
+
+        self.assertEqual(self.fig.data[0].x.dtype, np.float64)
+        self.assertEqual(self.fig.data[0].y.dtype, np.float32)
+        self.assertEqual(self.fig.data[0].customdata.dtype, np.float32)
+
+if __name__ == '__main__':
+    unittest.main()
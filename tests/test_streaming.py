@@ -0,0 +1,60 @@
+import unittest
+import time
+import numpy as np
+
+from pathlib import Path
+import sys
+sys.path.append(str(Path.cwd().parent))
+
+from aper_package.streaming import OrbitRingBuffer, OrbitPublisher, OrbitSubscriber
+
+class TestStreaming(unittest.TestCase):
+
+    def test_ring_buffer(self):
+
+        buffer = OrbitRingBuffer(['BPM.1', 'BPM.2', 'BPM.3'], capacity=4)
+        for i in range(6):
+            buffer.push(float(i), np.full(3, i*1e-3), np.full(3, -i*1e-3))
+
+        times, x, y = buffer.window(3)
+        np.testing.assert_array_equal(times, [3., 4., 5.])
+        np.testing.assert_array_equal(x[:, 0], [3e-3, 4e-3, 5e-3])
+
+        # The windows are read-only views of the buffer, not copies
+        self.assertTrue(np.shares_memory(x, buffer._x))
+        self.assertFalse(x.flags.writeable)
+
+        # Only the stored acquisitions are returned
+        self.assertEqual(len(buffer.window()[0]), 4)
+
+        # Acquisitions in another order, with an unknown BPM and a missing one
+        columns = buffer.column_indices(['bpm.3', 'bpm.9', 'bpm.1'])
+        buffer.push(6., np.array([3., 9., 1.]), np.zeros(3), columns)
+        np.testing.assert_array_equal(buffer.latest()['x'], [1., np.nan, 3.])
+        self.assertEqual(buffer.latest()['name'].to_list(), ['bpm.1', 'bpm.2', 'bpm.3'])
+
+    def test_publish_subscribe(self):
+
+        publisher = OrbitPublisher(['BPM.2', 'BPM.1'])
+        buffer = OrbitRingBuffer(['bpm.1', 'bpm.2'], capacity=10)
+        subscriber = OrbitSubscriber('localhost', publisher.port, buffer)
+        subscriber.start()
+
+        # Wait for the subscriber to be registered
+        while not publisher.subscribers: time.sleep(0.01)
+        for i in range(3):
+            publisher.publish(float(i), np.array([2., 1.])*i, np.array([-2., -1.])*i)
+
+        deadline = time.time() + 5
+        while buffer.count < 3 and time.time() < deadline: time.sleep(0.01)
+
+        publisher.close()
+        subscriber.close()
+
+        times, x, y = buffer.window()
+        np.testing.assert_array_equal(times, [0., 1., 2.])
+        np.testing.assert_array_equal(x[-1], [2., 4.])
+        np.testing.assert_array_equal(y[-1], [-2., -4.])
+
+if __name__ == '__main__':
+    unittest.main()
@@ -1,23 +1,466 @@
 import unittest
-from datetime import datetime
+import tempfile
+import pickle
+from datetime import datetime, timedelta
+import numpy as np
 import pandas as pd
 
 from pathlib import Path
 import sys
 sys.path.append(str(Path.cwd().parent))
 
-from aper_package.timber_data import BPMData, CollimatorsData
+from aper_package.timber_data import (
+    BPMData, CollimatorsData, ir_knobs, time_grid, average_acquisitions, bpm_quality,
+    resampling_summary, ir_knob_planes)
+from aper_package.logging_backend import LoggingBackend, ReplayBackend
 
 class TestTimberData(unittest.TestCase):
-    
+
     def setUp(self):
         time = datetime(2023, 4, 21, 10, 53, 15)
+        self.time = time
+
+        # Record a few variables to replay them offline
+        self.directory = tempfile.TemporaryDirectory()
+        self.backend = ReplayBackend(self.directory.name)
+
+        t = time.timestamp()
+        self.backend.write(
+            'BFC.LHC:OrbitAcq:positionsH', [t, t+0.5], [[100., -200., 300.], [0., 0., 0.]])
+        self.backend.write(
+            'BFC.LHC:OrbitAcq:positionsV', [t, t+0.5], [[-10., 20., -30.], [0., 0., 0.]])
+        self.backend.write(
+            'BFC.LHC:Mappings:fBPMNames_h', [t], [['BPM.1', 'BPMWF.2', 'BPM.3']])
+
+        self.backend.write('TCP.C6L7.B1:MEAS_LVDT_GD', [t], [2.5])
+        self.backend.write('TCTPV.4R2.B2:MEAS_LVDT_GD', [t], [12.])
+
+        # Minimal twiss data to assign positions
+        tw = pd.DataFrame({
+            'name': ['bpm.1', 'bpmwf.2', 'bpm.3', 'tcp.c6l7.b1', 'tctpv.4r2.b2'],
+            's': [1., 2., 3., 4., 5.],
+            'x': [0., 0., 0., 1e-3, 0.],
+            'y': [0., 0., 0., 0., -1e-3]
+            })
+        self.twiss = type('Twiss', (), {'tw_b1': tw, 'tw_b2': tw})()
+
+    def tearDown(self):
+        self.directory.cleanup()
+
+    def test_replay(self):
+
+        t = self.time.timestamp()
+        data = self.backend.get(
+            ['BFC.LHC:OrbitAcq:positionsH', 'missing'], self.time, self.time+timedelta(seconds=1))
+
+        self.assertNotIn('missing', data)
+        np.testing.assert_array_equal(data['BFC.LHC:OrbitAcq:positionsH'][0], [t, t+0.5])
+
+        # Without an end time the last value before the start is returned
+        data = ReplayBackend(self.directory.name).get(
+            'BFC.LHC:OrbitAcq:positionsH', self.time+timedelta(seconds=10))
+        np.testing.assert_array_equal(data['BFC.LHC:OrbitAcq:positionsH'][1], [[0., 0., 0.]])
+
+    def test_incomplete_backend(self):
+
+        class Backend(LoggingBackend): pass
+
+        # A backend without get fails when it is created, not on the first fetch
+        with self.assertRaises(TypeError): Backend()
 
     def test_BPM(self):
-        pass
-    
+
+        bpm_data = BPMData(self.backend)
+        bpm_data.load_data(self.time)
+
+        self.assertEqual(bpm_data.data['name'].to_list(), ['bpm.1', 'bpmwf.2', 'bpm.3'])
+        np.testing.assert_allclose(bpm_data.data['x'], [1e-4, -2e-4, 3e-4])
+        np.testing.assert_allclose(bpm_data.data['y'], [-1e-5, 2e-5, -3e-5])
+
+        bpm_data.process(self.twiss)
+        self.assertEqual(bpm_data.b1['s'].to_list(), [1., 2., 3.])
+
     def test_collimators(self):
-        pass
+
+        collimator_data = CollimatorsData(
+            self.backend, yaml_path=str(Path.cwd().parent)+'/test_data/injection.yaml')
+        collimator_data.load_data(self.time)
+
+        self.assertEqual(collimator_data.colx_b1['name'].to_list(), ['tcp.c6l7.b1'])
+        self.assertEqual(collimator_data.coly_b2['name'].to_list(), ['tctpv.4r2.b2'])
+        self.assertTrue(collimator_data.colx_b2.empty)
+        self.assertIn(('b2', 'TCTPH.4R8.B2:MEAS_LVDT_GD'), collimator_data.missing_variables)
+        self.assertNotIn(('b1', 'TCP.C6L7.B1:MEAS_LVDT_GD'), collimator_data.missing_variables)
+
+        # Fetching the beams separately gives the same result
+        separate = CollimatorsData(
+            self.backend, yaml_path=str(Path.cwd().parent)+'/test_data/injection.yaml')
+        separate.load_data(self.time, combined=False)
+        pd.testing.assert_frame_equal(separate.coly_b2, collimator_data.coly_b2)
+
+        collimator_data.process(self.twiss)
+        self.assertAlmostEqual(collimator_data.colx_b1['top_gap_col'].iloc[0], 3.5e-3)
+        self.assertAlmostEqual(collimator_data.coly_b2['bottom_gap_col'].iloc[0], -13e-3)
+
+    def test_collimator_time_series(self):
+
+        t = self.time.timestamp()
+        # The gap is logged before the interval and changes after 2 seconds
+        self.backend.write('TCP.C6L7.B1:MEAS_LVDT_GD', [t-10, t+2], [2.5, 1.5])
+
+        collimator_data = CollimatorsData(
+            self.backend, yaml_path=str(Path.cwd().parent)+'/test_data/injection.yaml')
+        collimator_data.load_time_series(self.time, self.time+timedelta(seconds=4))
+
+        self.assertEqual(collimator_data.gaps.shape, (5, len(collimator_data.collimators)))
+        column = collimator_data.collimators['name'].to_list().index('tcp.c6l7.b1')
+        np.testing.assert_allclose(collimator_data.gaps[:, column], [2.5e-3]*2 + [1.5e-3]*3)
+
+        collimator_data.process(self.twiss)
+        self.assertAlmostEqual(collimator_data.colx_b1['top_gap_col'].iloc[0], 3.5e-3)
+
+        # Changing the time does not need to process again
+        collimator_data.select_time(3)
+        self.assertAlmostEqual(collimator_data.colx_b1['top_gap_col'].iloc[0], 2.5e-3)
+        self.assertAlmostEqual(collimator_data.coly_b2['bottom_gap_col'].iloc[0], -13e-3)
+
+    def test_process_cache(self):
+
+        bpm_data = BPMData(self.backend)
+        bpm_data.load_data(self.time)
+
+        self.twiss.twiss_version = 1
+        bpm_data.process(self.twiss)
+        processed = bpm_data.b1
+
+        # The same twiss is not merged again
+        bpm_data.process(self.twiss)
+        self.assertIs(bpm_data.b1, processed)
+
+        # A retwiss or a cycle invalidates the results
+        self.twiss.twiss_version = 2
+        bpm_data.process(self.twiss)
+        self.assertIsNot(bpm_data.b1, processed)
+
+        # So does loading new data
+        processed = bpm_data.b1
+        bpm_data.load_data(self.time)
+        bpm_data.process(self.twiss)
+        self.assertIsNot(bpm_data.b1, processed)
+
+    def test_pickle_after_process(self):
+
+        bpm_data = BPMData(self.backend)
+        bpm_data.load_data(self.time, acquisitions=2)
+
+        # The twiss stands in for an ApertureData object with its lines
+        self.twiss.lines = np.zeros(10**6)
+        bpm_data.process(self.twiss)
+
+        # Copies sent to the workers of a pool only carry the BPM data
+        state = pickle.dumps(bpm_data)
+        self.assertLess(len(state), 20000)
+
+        copy = pickle.loads(state)
+        self.assertIsNone(copy.processed_with)
+        self.assertFalse(hasattr(copy, 'b1'))
+        self.assertFalse(hasattr(copy, 'readings'))
+        pd.testing.assert_frame_equal(copy.data, bpm_data.data)
+        pd.testing.assert_frame_equal(copy.quality, bpm_data.quality)
+
+        # The quality of other data, e.g. in batch_fit, is assessed again in the worker
+        bpm_data.data = bpm_data.data.iloc[:2]
+        copy = pickle.loads(pickle.dumps(bpm_data))
+        self.assertFalse(hasattr(copy, 'quality'))
+        self.assertEqual(copy._fit_data()['name'].to_list(), ['bpm.1'])
+
+    def test_least_squares_fit(self):
+
+        bpm_data = BPMData(self.backend)
+        bpm_data.load_data(self.time)
+
+        # Linear orbit response to a knob, the measured data corresponds to 150
+        tw = self.twiss.tw_b1
+        response = np.array([1e-4, 1e-4, 3e-4, 0., 0.]) / 150
+        counts = {'orbit': 0, 'twiss': 0}
+
+        class Aperture:
+            def change_knob(self, knob, value): self.value = value
+            def twiss_orbit(self):
+                counts['orbit'] += 1
+                orbit = tw.assign(x=response*float(np.squeeze(self.value)))
+                return orbit, orbit.iloc[:0]
+            def twiss(self): counts['twiss'] += 1
+
+        angle, _ = bpm_data.least_squares_fit(Aperture(), 10, 'on_x1', 'horizontal')
+
+        self.assertAlmostEqual(angle, 150, delta=0.5)
+        # The loaded data is not modified by the fit
+        self.assertEqual(len(bpm_data.data), 3)
+        # Only the orbit is computed while fitting, the full twiss once at the end
+        self.assertGreater(counts['orbit'], 1)
+        self.assertEqual(counts['twiss'], 1)
+
+    def test_resampled_fit(self):
+
+        bpm_data = BPMData(self.backend)
+        bpm_data.load_data(self.time, acquisitions=2)
+
+        # The first acquisition corresponds to 150 and the second to 0
+        tw = self.twiss.tw_b1
+        response = np.array([1e-4, 1e-4, 3e-4, 0., 0.]) / 150
+
+        class Aperture:
+            def change_knob(self, knob, value): self.value = value
+            def twiss_orbit(self):
+                orbit = tw.assign(x=response*float(np.squeeze(self.value)))
+                return orbit, orbit.iloc[:0]
+            def twiss(self): pass
+
+        _, _, summary = bpm_data.least_squares_fit(
+            Aperture(), 10, 'on_x1', 'horizontal', 
+            resampling='jackknife', resample_over='acquisitions')
+
+        np.testing.assert_allclose(bpm_data.resampled_estimates['on_x1'], [0, 150], atol=0.5)
+        self.assertAlmostEqual(summary.at['on_x1', 'std'], 75, delta=0.5)
+        self.assertEqual(summary.at['on_x1', 'samples'], 2)
+
+        # Every BPM agrees on the knob value, the bootstrap has no spread
+        _, _, summary = bpm_data.least_squares_fit(
+            Aperture(), 10, 'on_x1', 'horizontal', resampling='bootstrap', n_resamples=20, seed=1)
+
+        self.assertEqual(summary.at['on_x1', 'samples'], 20)
+        self.assertAlmostEqual(summary.at['on_x1', 'std'], 0, delta=0.5)
+        # The resample weights are only set on the copies sent to the workers
+        self.assertIsNone(bpm_data.resample_weights)
+
+    def test_resampled_fit_pool(self):
+
+        from aper_package.aperture_data import ApertureData
+        from small_ring import write_ring, bpm_orbit
+
+        label = type('Label', (), {'value': ''})()
+
+        with tempfile.TemporaryDirectory() as directory:
+            aper_data = ApertureData(*write_ring(directory), label=label)
+
+            # Noisy BPM data for a crossing angle of 80
+            aper_data.change_knob('on_x1', 80)
+            bpm_data = BPMData(self.backend, label=label)
+            orbit = bpm_orbit(aper_data)
+            bpm_data.data = orbit.assign(x=orbit['x'] + np.random.default_rng(0).normal(0, 1e-4, len(orbit)))
+            aper_data.change_knob('on_x1', 0)
+
+            _, _, linearised = bpm_data.least_squares_fit(
+                aper_data, 70, 'on_x1', 'horizontal', resampling='jackknife')
+            linearised_estimates = bpm_data.resampled_estimates['on_x1']
+
+            # Every resample fitted again in a worker, starting from the best fit
+            _, _, pooled = bpm_data.least_squares_fit(
+                aper_data, 70, 'on_x1', 'horizontal', resampling='jackknife', workers=1)
+
+        np.testing.assert_allclose(bpm_data.resampled_estimates['on_x1'], linearised_estimates, atol=1e-3)
+        self.assertAlmostEqual(pooled.at['on_x1', 'std'], linearised.at['on_x1', 'std'], delta=1e-3)
+        self.assertGreater(linearised.at['on_x1', 'std'], 0)
+
+    def test_resampling_summary(self):
+
+        estimates = np.array([[1., 10.], [2., 20.], [3., 30.]])
+        summary = resampling_summary(estimates, [2., 20.], 'bootstrap', ['a', 'b'])
+
+        np.testing.assert_allclose(summary['mean'], [2., 20.])
+        np.testing.assert_allclose(summary['std'], [1., 10.])
+        self.assertTrue((summary['ci_low'] < summary['estimate']).all())
+
+        summary = resampling_summary(estimates, [2., 20.], 'jackknife', ['a', 'b'])
+        np.testing.assert_allclose(summary['std'], np.sqrt(2/3 * 2) * np.array([1., 10.]))
+        np.testing.assert_allclose(summary['ci_high'] - summary['estimate'], 1.96 * summary['std'], rtol=1e-3)
+
+        with self.assertRaises(ValueError): resampling_summary(estimates, [2., 20.], 'median', ['a', 'b'])
+
+    def test_joint_least_squares_fit(self):
+
+        bpm_data = BPMData(self.backend)
+        bpm_data.load_data(self.time)
+
+        # Linear orbit response to a crossing and a separation knob, both 100 in the data
+        tw = self.twiss.tw_b1
+        response_x = np.array([1e-6, 0., 3e-6, 0., 0.])
+        response_y = np.array([-1e-7, 0., -3e-7, 0., 0.])
+        counts = {'orbit': 0}
+
+        class Aperture:
+            knobs = pd.DataFrame({'knob': ['on_x1', 'on_sep1'], 'current value': [0., 0.]})
+            values = {}
+            def change_knob(self, knob, value): self.values[knob] = value
+            def twiss_orbit(self):
+                counts['orbit'] += 1
+                orbit = tw.assign(
+                    x=response_x*self.values['on_x1'], y=response_y*self.values['on_sep1'])
+                return orbit, orbit.iloc[:0]
+            def twiss(self): pass
+
+        values, uncertainties, covariance = bpm_data.joint_least_squares_fit(
+            Aperture(), ['on_x1', 'on_sep1'])
+
+        np.testing.assert_allclose(values, [100., 100.])
+        self.assertEqual(list(uncertainties.index), ['on_x1', 'on_sep1'])
+        self.assertEqual(covariance.shape, (2, 2))
+        # The response matrix is computed once, then one orbit per iteration
+        self.assertEqual(counts['orbit'], 3 + 2)
+
+    def test_ir_knobs(self):
+
+        knobs = ['on_x1', 'on_sep8v', 'on_x2h', 'on_o1', 'on_x15', 'on_disp', 'on_sep1']
+        self.assertEqual(
+            ir_knobs(knobs), 
+            [('IR1', 'on_sep1'), ('IR1', 'on_x1'), ('IR2', 'on_x2h'), ('IR8', 'on_sep8v')])
+
+    def test_ir_knob_planes(self):
+
+        fits = ir_knob_planes(['on_x1', 'on_x2h', 'on_sep8v'], ('horizontal', 'vertical'))
+        self.assertEqual(fits, [
+            ('IR1', 'on_x1', 'horizontal'), ('IR1', 'on_x1', 'vertical'),
+            ('IR2', 'on_x2h', 'horizontal'), ('IR8', 'on_sep8v', 'vertical')])
+
+        # Knobs of the other plane are not fitted at all
+        self.assertEqual(ir_knob_planes(['on_x2h', 'on_sep8v'], ('vertical',)), [('IR8', 'on_sep8v', 'vertical')])
+
+    def test_wrapped_s_range(self):
+
+        bpm_data = BPMData(self.backend)
+        bpm_data.load_data(self.time)
+
+        # A range across the start of the ring, e.g. around IP1
+        merged = bpm_data._merge_twiss_and_bpm(self.twiss.tw_b1, (2.5, 1.5))
+        self.assertEqual(merged['name'].to_list(), ['bpm.1', 'bpm.3'])
+
+        # A copy sent to another process keeps the data but not the backend
+        copy = pickle.loads(pickle.dumps(bpm_data))
+        pd.testing.assert_frame_equal(copy.data, bpm_data.data)
+        self.assertFalse(hasattr(copy, 'ldb'))
+
+    def test_load_series(self):
+
+        bpm_data = BPMData(self.backend)
+        times = time_grid(self.time - timedelta(seconds=1), self.time + timedelta(seconds=1), 0.5)
+
+        self.assertEqual(len(times), 5)
+
+        series = bpm_data.load_series(times)
+
+        # Only timestamps with an acquisition within a second
+        t = self.time.timestamp()
+        self.assertEqual(sorted(series), [t-1, t-0.5, t, t+0.5])
+        np.testing.assert_allclose(series[t-1]['x'], [1e-4, -2e-4, 3e-4])
+        np.testing.assert_allclose(series[t+0.5]['y'], [0., 0., 0.])
+        self.assertEqual(series[t]['name'].to_list(), ['bpm.1', 'bpmwf.2', 'bpm.3'])
+
+    def test_batch_fit_skips_done(self):
+
+        bpm_data = BPMData(self.backend)
+        t = self.time.timestamp()
+
+        with tempfile.TemporaryDirectory() as directory:
+            pd.DataFrame({
+                'time': [t], 'knob': ['on_x1'], 'plane': ['horizontal'], 'value': [150.], 'uncertainty': [0.5]
+                }).to_csv(Path(directory) / f'on_x1_horizontal_{int(t*1e3)}.csv', index=False)
+
+            # Nothing is left to fit so neither data nor lines are needed
+            results = bpm_data.batch_fit(
+                None, [self.time], 'on_x1', 'horizontal', directory, file_format='csv')
+
+        self.assertEqual(results['value'].to_list(), [150.])
+
+    def test_batch_fit(self):
+
+        from aper_package.aperture_data import ApertureData
+        from small_ring import write_ring, bpm_orbit
+
+        label = type('Label', (), {'value': ''})()
+
+        with tempfile.TemporaryDirectory() as directory:
+            aper_data = ApertureData(*write_ring(directory), label=label)
+
+            # The orbit for a crossing angle of 80, and a timestamp where all BPMs are dead
+            aper_data.change_knob('on_x1', 80)
+            orbit = bpm_orbit(aper_data)
+            aper_data.change_knob('on_x1', 70)
+
+            t = self.time.timestamp()
+            backend = ReplayBackend(Path(directory) / 'replay')
+            backend.write('BFC.LHC:OrbitAcq:positionsH', [t, t+10], [orbit['x']*1e6, orbit['x']*np.nan])
+            backend.write('BFC.LHC:OrbitAcq:positionsV', [t, t+10], [orbit['y']*1e6, orbit['y']*np.nan])
+            backend.write('BFC.LHC:Mappings:fBPMNames_h', [t], [orbit['name'].str.upper().to_numpy(dtype=str)])
+
+            bpm_data = BPMData(backend, label=label)
+            times = [self.time, self.time + timedelta(seconds=10)]
+            output = Path(directory) / 'output'
+            results = bpm_data.batch_fit(
+                aper_data, times, 'on_x1', 'horizontal', output, file_format='csv', workers=1)
+
+            # The failed fit is reported and the other one saved
+            self.assertEqual(len(list(output.glob('*.csv'))), 1)
+            self.assertEqual(results['time'].to_list(), [t])
+            self.assertAlmostEqual(results['value'].iloc[0], 80, delta=0.5)
+            self.assertIn(f'1 timestamps failed: {times[1]}', label.value)
+
+            with self.assertRaises(ValueError):
+                bpm_data.batch_fit(aper_data, times, 'on_x1', 'horizontal', output, file_format='xlsx')
+
+    def test_average_acquisitions(self):
+
+        bpm_data = BPMData(self.backend)
+        bpm_data.load_data(self.time, acquisitions=2)
+
+        self.assertEqual(bpm_data.acquisitions, 2)
+        np.testing.assert_allclose(bpm_data.data['x'], [0.5e-4, -1e-4, 1.5e-4])
+        np.testing.assert_allclose(bpm_data.data['x_rms'], np.sqrt(2)*np.array([0.5e-4, 1e-4, 1.5e-4]))
+
+        mean, rms = average_acquisitions(np.array([[1., np.nan, 2.], [3., np.nan, np.nan]]))
+        np.testing.assert_array_equal(mean, [2., np.nan, 2.])
+        np.testing.assert_array_equal(rms, [np.sqrt(2), np.nan, np.nan])
+
+    def test_bpm_quality(self):
+
+        rng = np.random.default_rng(0)
+        data = pd.DataFrame({
+            'name': [f'bpm.{i}' for i in range(10)] + ['bpmwf.a', 'bpm.dead', 'bpm.nan', 'bpm.far', 'bpm.noisy'],
+            'x': list(rng.normal(0, 1e-3, 10)) + [1e-3, 0., np.nan, 0.05, 1e-3],
+            'y': list(rng.normal(0, 1e-3, 10)) + [1e-3, 0., 1e-3, 1e-3, 1e-3],
+            'x_rms': list(rng.uniform(5e-6, 1e-5, 10)) + [1e-5, 0., 1e-5, 1e-5, 1e-3],
+            'y_rms': list(rng.uniform(5e-6, 1e-5, 10)) + [1e-5, 0., 1e-5, 1e-5, 1e-5],
+            })
+
+        quality = bpm_quality(data).set_index('name')
+
+        self.assertTrue(quality.at['bpmwf.a', 'excluded'])
+        self.assertTrue(quality.at['bpm.dead', 'dead'])
+        self.assertTrue(quality.at['bpm.nan', 'dead'])
+        # A large position is a real bump, only the noise is compared
+        self.assertFalse(quality.at['bpm.far', 'outlier'])
+        self.assertTrue(quality.at['bpm.noisy', 'outlier'])
+        self.assertEqual(quality['mask'].sum(), 11)
+        # Quieter BPMs get a larger weight
+        self.assertAlmostEqual(quality.loc[quality['mask'], 'weight_x'].mean(), 1)
+        self.assertEqual(
+            quality.loc[quality['mask'], 'weight_x'].idxmax(), 
+            data.loc[data['x_rms'].iloc[:10].idxmin(), 'name'])
+
+    def test_bpm_quality_keeps_bumps(self):
+
+        # Arc BPMs around zero and the crossing and separation bumps around an IP
+        rng = np.random.default_rng(1)
+        bump = [3e-3, -5e-3, 7e-3, -7e-3, 5e-3, -3e-3]
+        data = pd.DataFrame({
+            'name': [f'bpm.arc{i}' for i in range(500)] + [f'bpm.ir{i}' for i in range(6)],
+            'x': list(rng.normal(0, 2e-4, 500)) + bump,
+            'y': list(rng.normal(0, 2e-4, 500)) + bump[::-1],
+            })
+
+        quality = bpm_quality(data)
+
+        self.assertTrue(quality['mask'].all())
 
 if __name__ == '__main__':
-    unittest.main()
\ No newline at end of file
+    unittest.main()